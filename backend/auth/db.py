@@ -0,0 +1,374 @@
+"""
+Пулы соединений с PostgreSQL, живущие на уровне модуля между тёплыми вызовами функции:
+primary для записи и реплики для чтения с учётом отставания и read-your-writes.
+
+Read-your-writes между экземплярами функции держится на позиции WAL: ответ на запись несёт X-Write-Lsn,
+клиент возвращает его в X-Min-Lsn, и чтение идёт на реплику, только если она уже проиграла WAL до этой позиции
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import psycopg2
+import psycopg2.extensions
+
+from instrument import TracedCursor, phase
+
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '2'))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', '1'))
+REPLICA_RETRY_AFTER = float(os.environ.get('REPLICA_RETRY_AFTER', '10'))
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '5'))
+MAX_TRACKED_WRITERS = 10000
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    pool = None
+    replica = False
+
+
+class ConnectionPool:
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 5,
+                 timeout: float = 5.0, check_after: float = 30.0, replica: bool = False):
+        self.dsn = dsn
+        self.replica = replica
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._stats = {'hits': 0, 'misses': 0, 'resets': 0, 'waits': 0, 'wait_time_ms': 0.0}
+
+    def warm_up(self):
+        with self._lock:
+            missing = self.min_size - len(self._idle)
+        for _ in range(missing):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def acquire(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No free database connection after {self.timeout}s')
+
+        # С этого места слот занят: любой сбой до возврата соединения обязан его отдать, иначе пул усыхает
+        try:
+            waited_ms = (time.monotonic() - started) * 1000
+            with self._lock:
+                self._stats['wait_time_ms'] += waited_ms
+                if waited_ms >= 1:
+                    self._stats['waits'] += 1
+
+            conn = self._take_idle()
+            if conn is not None:
+                self._count('hits')
+                return conn
+            self._count('misses')
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.closed:
+                self._count('resets')
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            self._discard(conn)
+            self._count('resets')
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['min_size'] = self.min_size
+        stats['max_size'] = self.max_size
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _connect(self) -> PooledConnection:
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, cursor_factory=TracedCursor)
+        conn.pool = self
+        conn.replica = self.replica
+        return conn
+
+    def _take_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, last_used = self._idle.pop()
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+            self._count('resets')
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute('SELECT 1')
+            finally:
+                cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+
+class ReplicaRouter:
+    def __init__(self, pools: list, max_lag: float = REPLICA_MAX_LAG_SECONDS,
+                 check_interval: float = REPLICA_CHECK_INTERVAL, retry_after: float = REPLICA_RETRY_AFTER,
+                 sticky_seconds: float = READ_YOUR_WRITES_SECONDS):
+        self.pools = pools
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.sticky_seconds = sticky_seconds
+        self._lag = [None] * len(pools)
+        self._checked_at = [0.0] * len(pools)
+        self._down_until = [0.0] * len(pools)
+        self._next = 0
+        self._writes = {}
+        self._lock = threading.Lock()
+        self._replayed = [None] * len(pools)
+        self._stats = {'replica_reads': 0, 'primary_reads': 0, 'sticky': 0, 'lagging': 0, 'behind': 0, 'failures': 0}
+
+    def note_write(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[user_id] = now
+            if len(self._writes) > MAX_TRACKED_WRITERS:
+                cutoff = now - self.sticky_seconds
+                self._writes = {key: at for key, at in self._writes.items() if at > cutoff}
+
+    def acquire(self, user_id: int = None, min_lsn: int = None):
+        now = time.monotonic()
+        with self._lock:
+            if user_id is not None and now - self._writes.get(user_id, float('-inf')) < self.sticky_seconds:
+                self._stats['sticky'] += 1
+                self._stats['primary_reads'] += 1
+                return None
+            start, self._next = self._next, (self._next + 1) % len(self.pools)
+
+        for offset in range(len(self.pools)):
+            index = (start + offset) % len(self.pools)
+            if self._down_until[index] > now:
+                continue
+            conn = self._try_acquire(index, now, min_lsn)
+            if conn is not None:
+                self._count('replica_reads')
+                return conn
+        self._count('primary_reads')
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        now = time.monotonic()
+        stats['replicas'] = [
+            {'lag': lag, 'down': down_until > now, 'pool': pool.stats()}
+            for pool, lag, down_until in zip(self.pools, self._lag, self._down_until)
+        ]
+        return stats
+
+    def _try_acquire(self, index: int, now: float, min_lsn: int = None):
+        pool = self.pools[index]
+        try:
+            conn = pool.acquire()
+        except (psycopg2.Error, PoolTimeout):
+            self._mark_down(index, now)
+            return None
+        try:
+            with self._lock:
+                due = now - self._checked_at[index] >= self.check_interval
+                replayed = self._replayed[index]
+            # Закэшированная позиция только отстаёт от настоящей: перемеряем, если её не хватает для метки клиента
+            if due or (min_lsn is not None and replayed is not None and replayed < min_lsn):
+                lag, replayed = measure_replica(conn)
+                with self._lock:
+                    self._lag[index], self._replayed[index], self._checked_at[index] = lag, replayed, now
+        except Exception:
+            pool.release(conn)
+            self._mark_down(index, now)
+            return None
+        with self._lock:
+            lag = self._lag[index]
+        if lag is None or lag > self.max_lag:
+            pool.release(conn)
+            self._count('lagging')
+            return None
+        if min_lsn is not None and replayed is not None and replayed < min_lsn:
+            pool.release(conn)
+            self._count('behind')
+            return None
+        return conn
+
+    def _mark_down(self, index: int, now: float):
+        with self._lock:
+            self._down_until[index] = now + self.retry_after
+            self._checked_at[index] = 0.0
+            self._stats['failures'] += 1
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+
+def measure_replica(conn) -> tuple:
+    # Отставание в секундах и проигранная позиция WAL. Сервер не в recovery (например, подписчик логической
+    # репликации) считаем догнавшим: его позиция WAL несравнима с позицией primary, поэтому вместо неё None
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                END,
+                CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()::text END"""
+        )
+        lag, replayed = cur.fetchone()
+        return float(lag), parse_lsn(replayed)
+    finally:
+        cur.close()
+
+def parse_lsn(text: str):
+    # '16/B374D848' -> число: позиции WAL сравниваются как 64-битные смещения
+    try:
+        high, low = text.split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Consistency:
+    __slots__ = ('min_lsn', 'write_lsn')
+
+    def __init__(self, min_lsn: str = None):
+        self.min_lsn = parse_lsn(min_lsn)
+        self.write_lsn = None
+
+
+_consistency = ContextVar('consistency', default=None)
+
+@contextmanager
+def consistency(min_lsn: str = None):
+    # Метка клиента действует на все чтения вызова, а позиция записи собирается для ответа
+    state = Consistency(min_lsn)
+    token = _consistency.set(state)
+    try:
+        yield state
+    finally:
+        _consistency.reset(token)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_replicas = None
+
+def pool_settings() -> dict:
+    return {
+        'min_size': int(os.environ.get('DB_POOL_MIN', '1')),
+        'max_size': int(os.environ.get('DB_POOL_MAX', '5')),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '5')),
+        'check_after': float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+    }
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(os.environ['DATABASE_URL'], **pool_settings())
+                pool.warm_up()
+                _pool = pool
+    return _pool
+
+def get_replica_router():
+    global _replicas
+    if _replicas is None:
+        dsns = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+        with _pool_lock:
+            if _replicas is None:
+                # Пулы реплик открываются лениво, при первом чтении
+                pools = [ConnectionPool(dsn, replica=True, **{**pool_settings(), 'min_size': 0}) for dsn in dsns]
+                _replicas = ReplicaRouter(pools) if pools else False
+    return _replicas or None
+
+def get_connection():
+    with phase('connect'):
+        return get_pool().acquire()
+
+def get_read_connection(user_id: int = None):
+    router = get_replica_router()
+    if router is not None:
+        state = _consistency.get()
+        with phase('connect'):
+            conn = router.acquire(user_id, state.min_lsn if state is not None else None)
+        if conn is not None:
+            return conn
+    return get_connection()
+
+def switch_to_primary(conn, cur) -> tuple:
+    # Сначала берём primary: если это не удалось, вызывающий код по-прежнему владеет исходным соединением
+    primary = get_connection()
+    cur.close()
+    release_connection(conn)
+    return primary, primary.cursor()
+
+def note_write(cur, user_id: int):
+    # Вызывается после commit на том же соединении с primary: позиция WAL уже включает запись
+    router = get_replica_router()
+    if router is None:
+        return
+    router.note_write(user_id)
+    state = _consistency.get()
+    if state is not None:
+        cur.execute('SELECT pg_current_wal_lsn()::text')
+        state.write_lsn = cur.fetchone()[0]
+
+def release_connection(conn):
+    (getattr(conn, 'pool', None) or get_pool()).release(conn)
+
+def pool_stats() -> dict:
+    return get_pool().stats() if _pool is not None else {}
+
+def replica_stats() -> dict:
+    router = get_replica_router()
+    return router.stats() if router is not None else {}
@@ -1,120 +1,86 @@
 """
 Функция авторизации: отправка и проверка SMS-кодов
 """
-import json
 import os
-import psycopg2
+import re
 from datetime import datetime, timedelta
 import random
-import jwt
-import requests
+from api import Request, Router, error_response, json_response
+from db import get_connection, release_connection
+from ratelimit import maybe_purge, take_token
+from sms import SMS_INLINE_DELIVERY, deliver_inline, enqueue_sms
+from tokens import issue_token
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
-    try:
-        body = json.loads(event.get('body', '{}'))
-        action = body.get('action')
-        
-        if action == 'send_code':
-            return send_verification_code(body)
-        elif action == 'verify_code':
-            return verify_code(body)
-        else:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+# (область, ёмкость корзины, пополнение токенов в секунду)
+SEND_CODE_LIMITS = (('phone', 3, 1 / 60), ('ip', 20, 20 / 3600))
+VERIFY_CODE_LIMITS = (('phone', 5, 1 / 60), ('ip', 50, 50 / 3600))
 
-def send_verification_code(body: dict) -> dict:
-    phone = body.get('phone', '').strip()
+handler = Router('auth', allow_headers='Content-Type', authenticated=False)
+
+@handler.route('POST', 'send_code')
+def send_verification_code(request: Request) -> dict:
+    phone = normalize_phone(str(request.body.get('phone') or ''))
     
     if not phone:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Phone is required'}),
-            'isBase64Encoded': False
-        }
+        return error_response(400, 'Phone is required')
     
     code = str(random.randint(100000, 999999))
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
+        limited = check_rate_limits(cur, 'send_code', SEND_CODE_LIMITS, phone, request.source_ip)
+        conn.commit()
+        if limited:
+            return limited
+        
+        maybe_purge(cur)
+        
         expires_at = datetime.now() + timedelta(minutes=5)
         
         cur.execute(
             f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.auth_codes (phone, code, expires_at) VALUES (%s, %s, %s)",
             (phone, code, expires_at)
         )
-        conn.commit()
         
         sms_api_key = os.environ.get('SMS_API_KEY', '')
         if sms_api_key:
-            send_sms(phone, f'Ваш код подтверждения: {code}', sms_api_key)
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'success': True,
-                'message': 'Code sent',
-                'debug_code': code if not sms_api_key else None
-            }),
-            'isBase64Encoded': False
-        }
+            enqueue_sms(cur, phone, f'Ваш код подтверждения: {code}')
+        
+        conn.commit()
+        
+        if sms_api_key and SMS_INLINE_DELIVERY:
+            deliver_inline(sms_api_key)
+        
+        return json_response({
+            'success': True,
+            'message': 'Code sent',
+            'debug_code': code if not sms_api_key else None
+        })
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
-def verify_code(body: dict) -> dict:
-    phone = body.get('phone', '').strip()
-    code = body.get('code', '').strip()
-    username = body.get('username', '').strip()
+@handler.route('POST', 'verify_code')
+def verify_code(request: Request) -> dict:
+    body = request.body
+    phone = normalize_phone(str(body.get('phone') or ''))
+    code = str(body.get('code') or '').strip()
+    username = str(body.get('username') or '').strip()
     
     if not phone or not code:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Phone and code are required'}),
-            'isBase64Encoded': False
-        }
+        return error_response(400, 'Phone and code are required')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
+        limited = check_rate_limits(cur, 'verify_code', VERIFY_CODE_LIMITS, phone, request.source_ip)
+        conn.commit()
+        if limited:
+            return limited
+        
         cur.execute(
             f"""SELECT id, expires_at, is_used FROM {os.environ['MAIN_DB_SCHEMA']}.auth_codes 
                 WHERE phone = %s AND code = %s 
@@ -124,30 +90,15 @@ def verify_code(body: dict) -> dict:
         result = cur.fetchone()
         
         if not result:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Invalid code'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Invalid code')
         
         code_id, expires_at, is_used = result
         
         if is_used:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Code already used'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Code already used')
         
         if datetime.now() > expires_at:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Code expired'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Code expired')
         
         cur.execute(
             f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.auth_codes SET is_used = TRUE WHERE id = %s",
@@ -155,8 +106,8 @@ def verify_code(body: dict) -> dict:
         )
         
         cur.execute(
-            f"SELECT id, username FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE phone = %s",
-            (phone,)
+            f"SELECT id, username FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE phone_digits = %s ORDER BY id LIMIT 1",
+            (phone[1:],)
         )
         user = cur.fetchone()
         
@@ -179,39 +130,35 @@ def verify_code(body: dict) -> dict:
         
         conn.commit()
         
-        jwt_secret = os.environ.get('JWT_SECRET', 'default-secret-key')
-        token = jwt.encode(
-            {'user_id': user_id, 'phone': phone, 'exp': datetime.utcnow() + timedelta(days=30)},
-            jwt_secret,
-            algorithm='HS256'
+        token = issue_token(
+            {'user_id': user_id, 'phone': phone, 'exp': datetime.utcnow() + timedelta(days=30)}
         )
         
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'success': True,
-                'token': token,
-                'user': {'id': user_id, 'phone': phone, 'username': username}
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response({
+            'success': True,
+            'token': token,
+            'user': {'id': user_id, 'phone': phone, 'username': username}
+        })
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
-def send_sms(phone: str, message: str, api_key: str):
-    try:
-        response = requests.post(
-            'https://smsc.ru/sys/send.php',
-            data={
-                'login': api_key.split(':')[0] if ':' in api_key else api_key,
-                'psw': api_key.split(':')[1] if ':' in api_key else '',
-                'phones': phone,
-                'mes': message,
-                'fmt': 3
-            },
-            timeout=10
-        )
-    except:
-        pass
+def normalize_phone(phone: str) -> str:
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return '+' + digits if digits else ''
+
+def check_rate_limits(cur, action: str, limits: tuple, phone: str, source_ip: str):
+    for scope, capacity, refill_per_second in limits:
+        subject = phone if scope == 'phone' else source_ip
+        if not subject:
+            continue
+        allowed, retry_after = take_token(cur, f'{action}:{scope}:{subject}', capacity, refill_per_second)
+        if not allowed:
+            return json_response(
+                {'error': 'Too many requests', 'retry_after': retry_after},
+                429,
+                headers={'Retry-After': str(retry_after)}
+            )
+    return None
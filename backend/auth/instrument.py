@@ -0,0 +1,184 @@
+"""
+Инструментирование вызовов: время и число строк каждого запроса к базе, таймеры фаз, EXPLAIN медленных запросов и JSON-строка лога
+"""
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import psycopg2.extensions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '1') != '0'
+INSTRUMENT_LOG = os.environ.get('INSTRUMENT_LOG', 'stdout')
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+# EXPLAIN идёт синхронно в конце вызова и удлиняет его ответ: по умолчанию выключен, включается долей запросов
+SLOW_EXPLAIN_RATE = float(os.environ.get('SLOW_EXPLAIN_RATE', '0'))
+SLOW_STATEMENTS_LOGGED = 5
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+_current = ContextVar('trace', default=None)
+
+
+class Trace:
+    __slots__ = ('function', 'request_id', 'started', 'phase', 'phases', 'statements', 'fields')
+
+    def __init__(self, function: str, request_id: str):
+        self.function = function
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.phase = 'handler'
+        self.phases = {}
+        self.statements = []
+        self.fields = {}
+
+    def record(self, query, params, elapsed: float, rows: int):
+        self.statements.append((query, params, elapsed, rows, self.phase))
+
+    def summary(self) -> dict:
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        db_ms = sum(statement[2] for statement in self.statements) * 1000
+        record = {
+            'function': self.function,
+            'request_id': self.request_id,
+            **self.fields,
+            'duration_ms': round(duration_ms, 3),
+            'db_ms': round(db_ms, 3),
+            'queries': len(self.statements),
+            'rows': sum(max(statement[3], 0) for statement in self.statements),
+            'phases': {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        }
+        # Ожидание long-poll — норма, а не медленный запрос
+        if duration_ms - self.phases.get('wait', 0.0) * 1000 >= SLOW_REQUEST_MS:
+            record['slow'] = True
+            record['statements'] = [
+                {'sql': statement_text(query)[:500], 'ms': round(elapsed * 1000, 3), 'rows': rows, 'phase': name}
+                for query, _, elapsed, rows, name in self.slowest()
+            ]
+        return record
+
+    def slowest(self) -> list:
+        return sorted(self.statements, key=lambda statement: -statement[2])[:SLOW_STATEMENTS_LOGGED]
+
+
+class TracedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        trace = _current.get()
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            trace.record(query, vars, time.perf_counter() - started, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        trace = _current.get()
+        if trace is None:
+            return super().executemany(query, vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            trace.record(query, None, time.perf_counter() - started, self.rowcount)
+
+
+class phase:
+    # Класс, а не @contextmanager: фаза открывается несколько раз за вызов, генератор заметно дороже
+    __slots__ = ('name', 'trace', 'previous', 'started')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = trace = _current.get()
+        if trace is not None:
+            self.previous, trace.phase = trace.phase, self.name
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        trace = self.trace
+        if trace is not None:
+            trace.phases[self.name] = trace.phases.get(self.name, 0.0) + time.perf_counter() - self.started
+            trace.phase = self.previous
+
+
+@contextmanager
+def tracing(function: str, request_id: str):
+    if not INSTRUMENTATION:
+        yield None
+        return
+    trace = Trace(function, request_id)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        finish(trace)
+
+def annotate(**fields):
+    trace = _current.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+def record_exception(error: BaseException):
+    trace = _current.get()
+    if trace is not None:
+        trace.fields['error'] = error_details(error)
+
+def log_error(source: str, error: BaseException, **fields):
+    # Для фоновых задач вне вызова: та же JSON-строка, что у вызовов, только без трассы
+    emit({'source': source, **fields, 'error': error_details(error)})
+
+def error_details(error: BaseException) -> dict:
+    return {
+        'type': type(error).__name__,
+        'message': str(error)[:1000],
+        'traceback': traceback.format_exception(type(error), error, error.__traceback__)[-5:]
+    }
+
+def finish(trace: Trace):
+    record = trace.summary()
+    if record.get('slow') and trace.statements and random.random() < SLOW_EXPLAIN_RATE:
+        record['plan'] = explain(trace.slowest()[0])
+    emit(record)
+
+def explain(statement) -> object:
+    query, params = statement[0], statement[1]
+    text = statement_text(query)
+    if not text.lstrip().lower().startswith(EXPLAINABLE):
+        return None
+    # Импорт здесь: db сам зависит от этого модуля
+    from db import get_connection, release_connection
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # Без ANALYZE: запрос только планируется, записи не повторяются
+        cur.execute('EXPLAIN (FORMAT JSON) ' + text, params)
+        return cur.fetchone()[0]
+    except psycopg2.Error as e:
+        return {'error': str(e)[:500]}
+    finally:
+        cur.close()
+        release_connection(conn)
+
+def statement_text(query) -> str:
+    return query.decode() if isinstance(query, bytes) else str(query)
+
+def emit(record: dict):
+    if INSTRUMENT_LOG == 'off':
+        return
+    stream = sys.stderr if INSTRUMENT_LOG == 'stderr' else sys.stdout
+    if orjson is not None:
+        line = orjson.dumps(record, default=str).decode()
+    else:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+    stream.write(line + '\n')
@@ -0,0 +1,199 @@
+"""
+Очередь отправки SMS: outbox-таблица и воркер с пакетной отправкой, повторами и статусами доставки.
+Функция auth кладёт строку в outbox и шлёт NOTIFY, а отправляет постоянный воркер: в self-hosted шлюзе он
+запускается вместе с приложением, отдельно — `python sms.py`. Поток внутри облачной функции для этого не годится:
+между вызовами среда выполнения замораживает экземпляр. Пока у облачного развёртывания нет воркера,
+send_code сам отправляет одну небольшую пачку сразу после коммита (SMS_INLINE_DELIVERY=1, по умолчанию);
+там, где воркер запущен, это выключается через SMS_INLINE_DELIVERY=0.
+"""
+import os
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import requests
+from psycopg2.extras import execute_values
+
+from db import get_connection, release_connection
+from instrument import log_error
+
+SMS_GATEWAY_URL = os.environ.get('SMS_GATEWAY_URL', 'https://smsc.ru/sys/send.php')
+SMS_BATCH_SIZE = int(os.environ.get('SMS_BATCH_SIZE', '50'))
+SMS_MAX_ATTEMPTS = int(os.environ.get('SMS_MAX_ATTEMPTS', '5'))
+SMS_WORKER_THREADS = int(os.environ.get('SMS_WORKER_THREADS', '4'))
+SMS_INLINE_DELIVERY = os.environ.get('SMS_INLINE_DELIVERY', '1') == '1'
+SMS_INLINE_BATCH_SIZE = int(os.environ.get('SMS_INLINE_BATCH_SIZE', '5'))
+SMS_LEASE_SECONDS = 60
+SMS_CHANNEL = 'sms_outbox'
+
+_inline = None
+
+
+class SmsDeliveryError(Exception):
+    pass
+
+
+def enqueue_sms(cur, phone: str, message: str):
+    cur.execute(
+        f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.sms_outbox (phone, message) VALUES (%s, %s)",
+        (phone, message)
+    )
+    # Уведомление уходит вместе с коммитом строки и будит воркер без ожидания очередного опроса
+    cur.execute('SELECT pg_notify(%s, %s)', (SMS_CHANNEL, ''))
+
+def deliver(session: requests.Session, phone: str, message: str, api_key: str):
+    response = session.post(
+        SMS_GATEWAY_URL,
+        data={
+            'login': api_key.split(':')[0] if ':' in api_key else api_key,
+            'psw': api_key.split(':')[1] if ':' in api_key else '',
+            'phones': phone,
+            'mes': message,
+            'fmt': 3
+        },
+        timeout=10
+    )
+    response.raise_for_status()
+    result = response.json()
+    if 'error' in result:
+        raise SmsDeliveryError(f"{result.get('error_code', '')} {result['error']}".strip())
+
+def retry_delay(attempts: int) -> int:
+    return min(2 ** attempts * 5, 600)
+
+def process_outbox(session: requests.Session, api_key: str, executor: ThreadPoolExecutor,
+                   batch_size: int = SMS_BATCH_SIZE) -> int:
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            f"""UPDATE {os.environ['MAIN_DB_SCHEMA']}.sms_outbox
+                SET attempts = attempts + 1, next_attempt_at = NOW() + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM {os.environ['MAIN_DB_SCHEMA']}.sms_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, phone, message, attempts""",
+            (SMS_LEASE_SECONDS, batch_size)
+        )
+        claimed = cur.fetchall()
+        conn.commit()
+
+        if not claimed:
+            return 0
+
+        def send(row):
+            outbox_id, phone, message, attempts = row
+            try:
+                deliver(session, phone, message, api_key)
+                return (outbox_id, 'sent', None, 0)
+            except (requests.RequestException, ValueError, SmsDeliveryError) as e:
+                status = 'failed' if attempts >= SMS_MAX_ATTEMPTS else 'pending'
+                return (outbox_id, status, str(e)[:500], retry_delay(attempts))
+
+        results = list(executor.map(send, claimed))
+
+        execute_values(
+            cur,
+            f"""UPDATE {os.environ['MAIN_DB_SCHEMA']}.sms_outbox o
+                SET status = r.status,
+                    last_error = r.last_error,
+                    sent_at = CASE WHEN r.status = 'sent' THEN NOW() ELSE o.sent_at END,
+                    next_attempt_at = NOW() + make_interval(secs => r.delay)
+                FROM (VALUES %s) AS r(id, status, last_error, delay)
+                WHERE o.id = r.id""",
+            results,
+            template='(%s, %s, %s, %s::integer)'
+        )
+        conn.commit()
+        return len(claimed)
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def deliver_inline(api_key: str) -> int:
+    # Одна пачка в пределах запроса: строки остаются в outbox, так что сбой здесь только откладывает отправку до повтора
+    global _inline
+    if _inline is None:
+        _inline = (requests.Session(), ThreadPoolExecutor(max_workers=SMS_WORKER_THREADS))
+    session, executor = _inline
+    try:
+        return process_outbox(session, api_key, executor, SMS_INLINE_BATCH_SIZE)
+    except Exception as e:
+        log_error('sms-inline', e)
+        return 0
+
+
+class SmsWorker:
+    def __init__(self, api_key: str, poll_interval: float = 5.0):
+        self.api_key = api_key
+        self.poll_interval = poll_interval
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=SMS_WORKER_THREADS)
+        self._conn = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                self.drain()
+                self.wait()
+        finally:
+            self._close()
+
+    def stop(self):
+        # Воркер выходит после текущего ожидания, то есть не позже чем через poll_interval
+        self._stopping.set()
+
+    def wait(self):
+        # Просыпаемся по NOTIFY из enqueue_sms, а без него — раз в poll_interval: так подхватываются и повторы
+        try:
+            if self._conn is None or self._conn.closed:
+                self._listen()
+            select.select([self._conn], [], [], self.poll_interval)
+            self._conn.poll()
+            self._conn.notifies.clear()
+        except psycopg2.Error as e:
+            log_error('sms-worker', e)
+            self._close()
+            time.sleep(self.poll_interval)
+
+    def drain(self) -> int:
+        sent = 0
+        try:
+            while True:
+                claimed = process_outbox(self.session, self.api_key, self.executor)
+                sent += claimed
+                if claimed < SMS_BATCH_SIZE:
+                    return sent
+        except Exception as e:
+            log_error('sms-worker', e, sent=sent)
+            return sent
+
+    def _listen(self):
+        self._conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        self._conn.autocommit = True
+        cur = self._conn.cursor()
+        try:
+            cur.execute(f'LISTEN {SMS_CHANNEL}')
+        finally:
+            cur.close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+
+if __name__ == '__main__':
+    SmsWorker(os.environ['SMS_API_KEY']).run()
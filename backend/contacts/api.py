@@ -0,0 +1,181 @@
+"""
+Общий HTTP-слой функций: готовые заголовки, табличная маршрутизация, быстрый JSON и единая обработка ошибок
+"""
+import base64
+import json
+import os
+import uuid
+
+import jwt
+
+from db import consistency
+from instrument import annotate, phase, record_exception, tracing
+from tokens import verify_token
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None and os.environ.get('JSON_BACKEND', 'orjson') == 'orjson':
+    JSON_BACKEND = 'orjson'
+
+    def dumps(payload) -> str:
+        return orjson.dumps(payload).decode()
+
+    loads = orjson.loads
+else:
+    JSON_BACKEND = 'json'
+    dumps = json.dumps
+    loads = json.loads
+
+JSON_HEADERS = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    __slots__ = ('event', 'method', 'headers', 'query', 'body', 'user_id', 'source_ip')
+
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.headers = event.get('headers') or {}
+        self.query = event.get('queryStringParameters') or {}
+        self.body = {}
+        self.user_id = None
+        identity = (event.get('requestContext') or {}).get('identity') or {}
+        # Только адрес от платформы: X-Forwarded-For задаёт сам клиент, и по нему лимиты обходились бы подменой
+        self.source_ip = identity.get('sourceIp') or ''
+
+
+def json_response(payload, status: int = 200, headers: dict = None) -> dict:
+    return {
+        'statusCode': status,
+        'headers': JSON_HEADERS if headers is None else {**JSON_HEADERS, **headers},
+        'body': encode(payload),
+        'isBase64Encoded': False
+    }
+
+def encode(payload) -> str:
+    with phase('encode'):
+        return dumps(payload)
+
+def error_response(status: int, message: str) -> dict:
+    return json_response({'error': message}, status)
+
+def empty_response(status: int, headers: dict) -> dict:
+    return {'statusCode': status, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+
+def binary_response(data: bytes, status: int = 200, headers: dict = None) -> dict:
+    return {
+        'statusCode': status,
+        'headers': {'Access-Control-Allow-Origin': '*', **(headers or {})},
+        'body': base64.b64encode(data).decode(),
+        'isBase64Encoded': True
+    }
+
+
+class Router:
+    def __init__(self, name: str, allow_headers: str = 'Content-Type, Authorization', expose_headers: str = None,
+                 authenticated: bool = True):
+        self.name = name
+        self.allow_headers = allow_headers
+        self.expose_headers = expose_headers
+        self.authenticated = authenticated
+        self.routes = {}
+        self.methods = set()
+        self.preflight = None
+
+    def route(self, method: str, action: str = None):
+        def register(fn):
+            self.routes[(method, action)] = fn
+            self.methods.add(method)
+            self.preflight = self._build_preflight()
+            return fn
+        return register
+
+    def __call__(self, event: dict, context) -> dict:
+        request_id = getattr(context, 'request_id', None) or uuid.uuid4().hex
+        min_lsn = (event.get('headers') or {}).get('x-min-lsn')
+        with tracing(self.name, request_id), consistency(min_lsn) as state:
+            response = self.dispatch(event, request_id)
+            if state.write_lsn:
+                response['headers'] = with_write_lsn(response['headers'], state.write_lsn)
+            annotate(status=response['statusCode'])
+            return response
+
+    def dispatch(self, event: dict, request_id: str) -> dict:
+        request = Request(event)
+        annotate(method=request.method)
+
+        if request.method == 'OPTIONS':
+            return self.preflight
+
+        try:
+            if self.authenticated:
+                with phase('auth'):
+                    request.user_id = authenticate(request)
+                annotate(user_id=request.user_id)
+
+            if request.method == 'POST':
+                request.body = parse_body(event)
+                action = request.body.get('action')
+            else:
+                action = request.query.get('view')
+            annotate(action=action)
+
+            fn = self.routes.get((request.method, action)) or self.routes.get((request.method, None))
+            if fn is None:
+                if request.method in self.methods:
+                    return error_response(400, 'Invalid action')
+                return error_response(405, 'Method not allowed')
+
+            return fn(request)
+        except ApiError as e:
+            return error_response(e.status, e.message)
+        except jwt.ExpiredSignatureError:
+            return error_response(401, 'Token expired')
+        except jwt.InvalidTokenError:
+            return error_response(401, 'Invalid token')
+        except Exception as e:
+            # Текст исключения уходит в лог вызова, клиенту — только идентификатор для поиска
+            record_exception(e)
+            return json_response({'error': 'Internal server error', 'request_id': request_id}, 500)
+
+    def _build_preflight(self) -> dict:
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': ', '.join(sorted(self.methods) + ['OPTIONS']),
+            'Access-Control-Allow-Headers': f'{self.allow_headers}, X-Min-Lsn'
+        }
+        if self.expose_headers:
+            headers['Access-Control-Expose-Headers'] = self.expose_headers
+        return empty_response(200, headers)
+
+
+def with_write_lsn(headers: dict, lsn: str) -> dict:
+    # Позицию записи клиент возвращает в X-Min-Lsn, и другой экземпляр функции не прочитает с отставшей реплики
+    exposed = ', '.join(filter(None, (headers.get('Access-Control-Expose-Headers'), 'X-Write-Lsn')))
+    return {**headers, 'X-Write-Lsn': lsn, 'Access-Control-Expose-Headers': exposed}
+
+def parse_body(event: dict) -> dict:
+    raw = event.get('body') or '{}'
+    try:
+        body = loads(raw)
+    except ValueError:
+        raise ApiError(400, 'Invalid JSON body')
+    if not isinstance(body, dict):
+        raise ApiError(400, 'JSON body must be an object')
+    return body
+
+def authenticate(request: Request) -> int:
+    token = request.headers.get('authorization', '').replace('Bearer ', '')
+    if not token:
+        raise ApiError(401, 'Unauthorized')
+    return verify_token(token)['user_id']
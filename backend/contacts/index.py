@@ -3,187 +3,462 @@
 """
 import json
 import os
-import psycopg2
-import jwt
+import re
+from datetime import datetime
+from psycopg2.extras import execute_values
+from api import Request, Router, error_response, json_response
+from db import get_connection, get_read_connection, note_write, release_connection
+from presence import PRESENCE_ONLINE_WINDOW, fetch_presence
+from ratelimit import take_token
 
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    try:
-        token = event.get('headers', {}).get('authorization', '').replace('Bearer ', '')
-        if not token:
-            return {
-                'statusCode': 401,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Unauthorized'}),
-                'isBase64Encoded': False
-            }
-        
-        jwt_secret = os.environ.get('JWT_SECRET', 'default-secret-key')
-        payload = jwt.decode(token, jwt_secret, algorithms=['HS256'])
-        user_id = payload['user_id']
-        
-        if method == 'POST':
-            return add_contact(user_id, event)
-        elif method == 'GET':
-            return get_contacts(user_id)
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    except jwt.ExpiredSignatureError:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Token expired'}),
-            'isBase64Encoded': False
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+MEMBERSHIP_CHANNEL = 'chat_membership'
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_OFFSET = 200
+MIN_QUERY_LENGTH = 3
+MAX_SYNC_CONTACTS = 5000
+# (ёмкость корзины, пополнение в секунду) в номерах: полная книга дважды, дальше — её объём в сутки
+SYNC_CONTACTS_LIMIT = (2 * MAX_SYNC_CONTACTS, MAX_SYNC_CONTACTS / 86400)
+MAX_PRESENCE_IDS = 500
+
+handler = Router('contacts')
 
-def add_contact(user_id: int, event: dict) -> dict:
-    body = json.loads(event.get('body', '{}'))
-    contact_phone = body.get('phone', '').strip()
+@handler.route('POST')
+def add_contact(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    contact_phone = normalize_phone(str(body.get('phone') or ''))
     
     if not contact_phone:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Phone is required'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        return error_response(400, 'Phone is required')
+    
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
-            f"SELECT id, username, avatar_url FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE phone = %s",
-            (contact_phone,)
+            f"""SELECT id, username, avatar_url FROM {os.environ['MAIN_DB_SCHEMA']}.users
+                WHERE phone_digits = %s ORDER BY id LIMIT 1""",
+            (contact_phone[1:],)
         )
         contact = cur.fetchone()
         
         if not contact:
-            return {
-                'statusCode': 404,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'User not found'}),
-                'isBase64Encoded': False
-            }
+            return error_response(404, 'User not found')
         
         contact_id, username, avatar_url = contact
         
         if contact_id == user_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Cannot add yourself'}),
-                'isBase64Encoded': False
+            return error_response(400, 'Cannot add yourself')
+        
+        chat_by_contact, _ = get_or_create_direct_chats(cur, user_id, [contact_id])
+        chat_id = chat_by_contact[contact_id]
+        
+        conn.commit()
+        note_write(cur, user_id)
+        
+        return json_response({
+            'success': True,
+            'chat_id': chat_id,
+            'contact': {
+                'id': contact_id,
+                'username': username,
+                'phone': contact_phone,
+                'avatar_url': avatar_url
             }
+        })
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('POST', 'sync_contacts')
+def sync_contacts(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    raw_phones = body.get('phones') or []
+    raw_hashes = body.get('phone_hashes') or []
+    
+    if not isinstance(raw_phones, list) or not isinstance(raw_hashes, list):
+        return error_response(400, 'phones and phone_hashes must be arrays')
+    
+    if len(raw_phones) + len(raw_hashes) > MAX_SYNC_CONTACTS:
+        return error_response(400, f'At most {MAX_SYNC_CONTACTS} contacts per request')
+    
+    # Ответ возвращает номер или хэш в том виде, в каком их прислал клиент
+    by_digits = {}
+    for raw in raw_phones:
+        digits = normalize_phone(str(raw))[1:]
+        if digits:
+            by_digits.setdefault(digits, str(raw))
+    by_hash = {}
+    for raw in raw_hashes:
+        phone_hash = str(raw).strip().lower()
+        if re.fullmatch(r'[0-9a-f]{64}', phone_hash):
+            by_hash.setdefault(phone_hash, str(raw))
+    
+    if not by_digits and not by_hash:
+        return json_response({'matches': [], 'created_chats': 0})
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Каждый номер — токен: без лимита синхронизация перебором выдавала бы, чьи это номера
+        allowed, retry_after = take_token(
+            cur, f'sync_contacts:user:{user_id}', *SYNC_CONTACTS_LIMIT, cost=len(by_digits) + len(by_hash)
+        )
+        conn.commit()
+        if not allowed:
+            return json_response(
+                {'error': 'Too many requests', 'retry_after': retry_after},
+                429,
+                headers={'Retry-After': str(retry_after)}
+            )
         
         cur.execute(
-            f"""SELECT chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants 
-                WHERE user_id = %s AND chat_id IN (
-                    SELECT chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants 
-                    WHERE user_id = %s
-                )""",
-            (user_id, contact_id)
+            f"""SELECT DISTINCT ON (phone_digits) id, username, phone, avatar_url, last_seen, phone_digits,
+                    encode(sha256(phone_digits::bytea), 'hex')
+                FROM {os.environ['MAIN_DB_SCHEMA']}.users
+                WHERE (phone_digits = ANY(%s::text[]) OR encode(sha256(phone_digits::bytea), 'hex') = ANY(%s::text[]))
+                    AND id <> %s
+                ORDER BY phone_digits, id""",
+            (list(by_digits), list(by_hash), user_id)
         )
-        existing_chat = cur.fetchone()
+        contacts = cur.fetchall()
         
-        if existing_chat:
-            chat_id = existing_chat[0]
-        else:
-            cur.execute(
-                f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chats DEFAULT VALUES RETURNING id"
-            )
-            chat_id = cur.fetchone()[0]
-            
-            cur.execute(
-                f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chat_participants (chat_id, user_id) VALUES (%s, %s)",
-                (chat_id, user_id)
-            )
-            cur.execute(
-                f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chat_participants (chat_id, user_id) VALUES (%s, %s)",
-                (chat_id, contact_id)
-            )
+        if not contacts:
+            return json_response({'matches': [], 'created_chats': 0})
+        
+        chat_by_contact, created = get_or_create_direct_chats(cur, user_id, [row[0] for row in contacts])
         
         conn.commit()
+        note_write(cur, user_id)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'success': True,
-                'chat_id': chat_id,
+        matches = []
+        for contact_id, username, phone, avatar_url, last_seen, digits, phone_hash in contacts:
+            matches.append({
+                'query': by_digits.get(digits) or by_hash.get(phone_hash),
+                'chat_id': chat_by_contact[contact_id],
+                'created': contact_id in created,
                 'contact': {
                     'id': contact_id,
                     'username': username,
-                    'phone': contact_phone,
-                    'avatar_url': avatar_url
+                    'phone': phone,
+                    'avatar_url': avatar_url,
+                    'last_seen': last_seen.isoformat() if last_seen else None
                 }
-            }),
-            'isBase64Encoded': False
-        }
+            })
+        
+        return json_response({'matches': matches, 'created_chats': len(created)})
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('GET', 'search')
+def search_users(request: Request) -> dict:
+    query_params = request.query
+    query = str(query_params.get('q') or '').strip()
+    
+    try:
+        limit = max(1, min(int(query_params.get('limit') or SEARCH_PAGE_SIZE), SEARCH_PAGE_SIZE * 5))
+        offset = max(0, min(int(query_params.get('offset') or 0), MAX_SEARCH_OFFSET))
+    except ValueError:
+        return error_response(400, 'limit and offset must be integers')
+    
+    if len(query) < MIN_QUERY_LENGTH:
+        return error_response(400, f'Query must be at least {MIN_QUERY_LENGTH} characters')
+    
+    conn = get_read_connection(request.user_id)
+    cur = conn.cursor()
+    
+    try:
+        phone_query = bool(re.fullmatch(r'[+\d\s()-]+', query))
+        if phone_query:
+            digits = normalize_phone(query)[1:]
+            if not query.startswith('+') and digits.startswith('8'):
+                digits = '7' + digits[1:]
+            # Только полный номер: поиск по префиксу позволял перебором выгрузить номера всех пользователей
+            cur.execute(
+                f"""SELECT id, username, phone, avatar_url, last_seen
+                    FROM {os.environ['MAIN_DB_SCHEMA']}.users
+                    WHERE phone_digits = %s AND id <> %s
+                    ORDER BY id
+                    LIMIT 1""",
+                (digits, request.user_id)
+            )
+        else:
+            needle = query.lower()
+            cur.execute(
+                f"""SELECT id, username, phone, avatar_url, last_seen
+                    FROM {os.environ['MAIN_DB_SCHEMA']}.users
+                    WHERE (lower(username) LIKE %(prefix)s OR lower(username) %% %(needle)s) AND id <> %(user_id)s
+                    ORDER BY lower(username) LIKE %(prefix)s DESC, similarity(lower(username), %(needle)s) DESC, id
+                    LIMIT %(limit)s OFFSET %(offset)s""",
+                {
+                    'prefix': escape_like(needle) + '%',
+                    'needle': needle,
+                    'user_id': request.user_id,
+                    'limit': limit + 1,
+                    'offset': offset
+                }
+            )
+        rows = cur.fetchall()
+        
+        users = []
+        for contact_id, username, phone, avatar_url, last_seen in rows[:limit]:
+            users.append({
+                'id': contact_id,
+                'username': username,
+                # Номер, найденный по имени, искавшему неизвестен: показываем только его края
+                'phone': phone if phone_query else mask_phone(phone),
+                'avatar_url': avatar_url,
+                'last_seen': last_seen.isoformat() if last_seen else None
+            })
+        
+        has_more = len(rows) > limit and offset + limit <= MAX_SEARCH_OFFSET
+        
+        return json_response({
+            'users': users,
+            'next_offset': offset + limit if has_more else None
+        })
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
-def get_contacts(user_id: int) -> dict:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+def get_or_create_direct_chats(cur, user_id: int, contact_ids: list) -> tuple:
+    cur.execute(
+        f"""SELECT user_low, user_high, chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.direct_chats
+            WHERE (user_low = %(user_id)s AND user_high = ANY(%(contact_ids)s::integer[]))
+                OR (user_high = %(user_id)s AND user_low = ANY(%(contact_ids)s::integer[]))""",
+        {'user_id': user_id, 'contact_ids': contact_ids}
+    )
+    chat_by_contact = {}
+    for user_low, user_high, chat_id in cur.fetchall():
+        chat_by_contact[user_high if user_low == user_id else user_low] = chat_id
+    
+    # Один порядок вставки пар у всех транзакций: параллельные синхронизации не захватят строки крест-накрест
+    missing = sorted(contact_id for contact_id in contact_ids if contact_id not in chat_by_contact)
+    if not missing:
+        return chat_by_contact, set()
+    
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chats (created_at)
+            SELECT CURRENT_TIMESTAMP FROM generate_series(1, %s)
+            RETURNING id""",
+        (len(missing),)
+    )
+    proposed = dict(zip(missing, [row[0] for row in cur.fetchall()]))
+    
+    # При встречном добавлении ON CONFLICT вернёт чат, созданный параллельной транзакцией
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.direct_chats AS d (user_low, user_high, chat_id)
+            SELECT * FROM unnest(%s::integer[], %s::integer[], %s::integer[])
+            ON CONFLICT (user_low, user_high) DO UPDATE SET chat_id = d.chat_id
+            RETURNING user_low, user_high, chat_id""",
+        (
+            [min(user_id, contact_id) for contact_id in missing],
+            [max(user_id, contact_id) for contact_id in missing],
+            [proposed[contact_id] for contact_id in missing]
+        )
+    )
+    for user_low, user_high, chat_id in cur.fetchall():
+        chat_by_contact[user_high if user_low == user_id else user_low] = chat_id
+    
+    created = {contact_id for contact_id in missing if chat_by_contact[contact_id] == proposed[contact_id]}
+    orphans = [proposed[contact_id] for contact_id in missing if contact_id not in created]
+    if orphans:
+        cur.execute(
+            f"DELETE FROM {os.environ['MAIN_DB_SCHEMA']}.chats WHERE id = ANY(%s::integer[])",
+            (orphans,)
+        )
+    
+    if created:
+        participants = []
+        for contact_id in sorted(created):
+            participants.append((proposed[contact_id], user_id))
+            participants.append((proposed[contact_id], contact_id))
+        execute_values(
+            cur,
+            f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chat_participants (chat_id, user_id) VALUES %s",
+            participants,
+            page_size=1000
+        )
+        notify_membership_changes(cur, [(proposed[contact_id], [user_id, contact_id]) for contact_id in created])
+    
+    return chat_by_contact, created
+
+def mask_phone(phone: str) -> str:
+    if len(phone) <= 4:
+        return '*' * len(phone)
+    return phone[:2] + '*' * (len(phone) - 4) + phone[-2:]
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def notify_membership_changes(cur, changes: list):
+    # Кэш членства в функции messages сбрасывает эти записи после коммита транзакции
+    cur.execute(
+        "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+        (MEMBERSHIP_CHANNEL, [json.dumps({'chat_id': chat_id, 'user_ids': user_ids}) for chat_id, user_ids in changes])
+    )
+
+@handler.route('GET')
+def get_contacts(request: Request) -> dict:
+    user_id = request.user_id
+    conn = get_read_connection(user_id)
     cur = conn.cursor()
     
     try:
+        # presence — UNLOGGED-таблица, на реплике её нет: там берём только users.last_seen, а онлайн — с primary
+        if conn.replica:
+            seen, online, presence_join = 'u.last_seen', 'FALSE', ''
+        else:
+            seen = 'GREATEST(u.last_seen, p.last_seen)'
+            online = 'COALESCE(p.last_seen > NOW() - make_interval(secs => %(window)s), FALSE)'
+            presence_join = f"LEFT JOIN {os.environ['MAIN_DB_SCHEMA']}.presence p ON p.user_id = u.id"
         cur.execute(
-            f"""SELECT DISTINCT u.id, u.username, u.phone, u.avatar_url, u.last_seen, cp.chat_id
+            f"""SELECT DISTINCT u.id, u.username, u.phone, u.avatar_url,
+                    {seen} AS seen,
+                    {online},
+                    cp.chat_id
                 FROM {os.environ['MAIN_DB_SCHEMA']}.users u
                 JOIN {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp ON u.id = cp.user_id
+                {presence_join}
                 WHERE cp.chat_id IN (
                     SELECT chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants 
-                    WHERE user_id = %s
-                ) AND u.id != %s
-                ORDER BY u.last_seen DESC""",
-            (user_id, user_id)
+                    WHERE user_id = %(user_id)s
+                ) AND u.id != %(user_id)s
+                ORDER BY seen DESC""",
+            {'window': PRESENCE_ONLINE_WINDOW, 'user_id': user_id}
         )
+        rows = cur.fetchall()
+        
+        if conn.replica and rows:
+            rows = overlay_presence(rows)
         
         contacts = []
-        for row in cur.fetchall():
-            contact_id, username, phone, avatar_url, last_seen, chat_id = row
+        for row in rows:
+            contact_id, username, phone, avatar_url, last_seen, online, chat_id = row
             contacts.append({
                 'id': contact_id,
                 'username': username,
                 'phone': phone,
                 'avatar_url': avatar_url,
                 'last_seen': last_seen.isoformat() if last_seen else None,
+                'online': online,
                 'chat_id': chat_id
             })
         
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'contacts': contacts}),
-            'isBase64Encoded': False
-        }
+        return json_response({'contacts': contacts})
+    finally:
+        cur.close()
+        release_connection(conn)
+
+def overlay_presence(rows: list) -> list:
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        presence = fetch_presence(cur, {row[0] for row in rows})
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    merged = []
+    for contact_id, username, phone, avatar_url, last_seen, _, chat_id in rows:
+        last_seen, online = presence.get(contact_id, (last_seen, False))
+        merged.append((contact_id, username, phone, avatar_url, last_seen, online, chat_id))
+    # Тот же порядок, что у ORDER BY seen DESC: NULL первыми
+    merged.sort(key=lambda row: (row[4] is None, row[4] or datetime.min), reverse=True)
+    return merged
+
+@handler.route('GET', 'chats')
+def get_chat_list(request: Request) -> dict:
+    user_id = request.user_id
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            f"""SELECT c.id, cp.unread_count,
+                    m.id, m.sender_id, m.content, m.created_at,
+                    peer.id, peer.username, peer.phone, peer.avatar_url, peer.last_seen, peer.online
+                FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+                JOIN {os.environ['MAIN_DB_SCHEMA']}.chats c ON c.id = cp.chat_id
+                LEFT JOIN {os.environ['MAIN_DB_SCHEMA']}.messages m ON m.id = c.last_message_id AND m.created_at = c.last_message_at
+                LEFT JOIN LATERAL (
+                    SELECT u.id, u.username, u.phone, u.avatar_url,
+                        GREATEST(u.last_seen, p.last_seen) AS last_seen,
+                        COALESCE(p.last_seen > NOW() - make_interval(secs => %s), FALSE) AS online
+                    FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants op
+                    JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON u.id = op.user_id
+                    LEFT JOIN {os.environ['MAIN_DB_SCHEMA']}.presence p ON p.user_id = u.id
+                    WHERE op.chat_id = c.id AND op.user_id <> cp.user_id
+                    LIMIT 1
+                ) peer ON TRUE
+                WHERE cp.user_id = %s
+                ORDER BY c.last_message_at DESC NULLS LAST, c.id DESC""",
+            (PRESENCE_ONLINE_WINDOW, user_id)
+        )
+        
+        chats = []
+        for row in cur.fetchall():
+            chat_id, unread_count, message_id, sender_id, content, created_at = row[:6]
+            peer_id, peer_username, peer_phone, peer_avatar_url, peer_last_seen, peer_online = row[6:]
+            chats.append({
+                'chat_id': chat_id,
+                'unread_count': unread_count,
+                'last_message': {
+                    'id': message_id,
+                    'sender_id': sender_id,
+                    'content': content,
+                    'created_at': created_at.isoformat(),
+                    'is_mine': sender_id == user_id
+                } if message_id else None,
+                'contact': {
+                    'id': peer_id,
+                    'username': peer_username,
+                    'phone': peer_phone,
+                    'avatar_url': peer_avatar_url,
+                    'last_seen': peer_last_seen.isoformat() if peer_last_seen else None,
+                    'online': peer_online
+                } if peer_id else None
+            })
+        
+        return json_response({'chats': chats})
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('GET', 'presence')
+def get_presence(request: Request) -> dict:
+    try:
+        user_ids = sorted({int(v) for v in str(request.query.get('ids') or '').split(',') if v.strip()})
+    except ValueError:
+        return error_response(400, 'ids must be a comma-separated list of integers')
+    
+    if not user_ids:
+        return error_response(400, 'ids is required')
+    
+    if len(user_ids) > MAX_PRESENCE_IDS:
+        return error_response(400, f'At most {MAX_PRESENCE_IDS} ids per request')
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        presence = []
+        for presence_user_id, (last_seen, online) in sorted(fetch_presence(cur, user_ids).items()):
+            presence.append({
+                'user_id': presence_user_id,
+                'online': online,
+                'last_seen': last_seen.isoformat() if last_seen else None
+            })
+        
+        return json_response({'presence': presence})
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+def normalize_phone(phone: str) -> str:
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return '+' + digits if digits else ''
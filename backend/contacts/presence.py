@@ -0,0 +1,125 @@
+"""
+Присутствие пользователей: пульс в UNLOGGED-таблице presence и редкий сброс last_seen в users.
+Сброс — отдельная задача по расписанию (`python presence.py` или триггер по таймеру, вызывающий flush()),
+а не часть запроса: пакетный UPDATE users не должен удлинять транзакцию отправителя и ронять её своими ошибками.
+"""
+import os
+import threading
+import time
+
+from db import get_connection, release_connection
+from instrument import log_error
+
+PRESENCE_WRITE_INTERVAL = float(os.environ.get('PRESENCE_WRITE_INTERVAL', '30'))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '60'))
+PRESENCE_ONLINE_WINDOW = float(os.environ.get('PRESENCE_ONLINE_WINDOW', '90'))
+PRESENCE_FLUSH_BATCH = int(os.environ.get('PRESENCE_FLUSH_BATCH', '5000'))
+PRESENCE_FLUSH_LOCK = 7301
+
+
+class PresenceTracker:
+    def __init__(self, write_interval: float = 30.0, max_size: int = 10000):
+        self.write_interval = write_interval
+        self.max_size = max_size
+        self._written = {}
+        self._lock = threading.Lock()
+        self._stats = {'touches': 0, 'writes': 0, 'flushes': 0, 'flushed_users': 0}
+
+    def should_write(self, user_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._stats['touches'] += 1
+            written_at = self._written.get(user_id)
+            if written_at is not None and now - written_at < self.write_interval:
+                return False
+            if len(self._written) >= self.max_size:
+                self._written = {k: v for k, v in self._written.items() if now - v < self.write_interval}
+            self._written[user_id] = now
+            self._stats['writes'] += 1
+            return True
+
+    def record_flush(self, users: int):
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['flushed_users'] += users
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._written)
+        return stats
+
+
+_tracker = PresenceTracker(PRESENCE_WRITE_INTERVAL)
+
+def touch(cur, user_id: int):
+    if _tracker.should_write(user_id):
+        cur.execute(
+            f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.presence (user_id, last_seen)
+                VALUES (%s, NOW())
+                ON CONFLICT (user_id) DO UPDATE SET last_seen = EXCLUDED.last_seen""",
+            (user_id,)
+        )
+
+def flush_presence(cur, batch_size: int = PRESENCE_FLUSH_BATCH) -> int:
+    # Активному пользователю users.last_seen пишется не чаще раза за интервал, последнее значение — после затихания пульса
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PRESENCE_FLUSH_LOCK,))
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute(
+        f"""UPDATE {os.environ['MAIN_DB_SCHEMA']}.users u
+            SET last_seen = p.last_seen
+            FROM (
+                SELECT p.user_id, p.last_seen
+                FROM {os.environ['MAIN_DB_SCHEMA']}.presence p
+                JOIN {os.environ['MAIN_DB_SCHEMA']}.users pu ON pu.id = p.user_id
+                WHERE pu.last_seen IS NULL OR (
+                    p.last_seen > pu.last_seen
+                    AND (p.last_seen >= pu.last_seen + make_interval(secs => %(interval)s)
+                        OR p.last_seen < NOW() - make_interval(secs => %(interval)s))
+                )
+                LIMIT %(batch_size)s
+            ) p
+            WHERE u.id = p.user_id""",
+        {'interval': PRESENCE_FLUSH_INTERVAL, 'batch_size': batch_size}
+    )
+    flushed = cur.rowcount
+    cur.execute(
+        f"""DELETE FROM {os.environ['MAIN_DB_SCHEMA']}.presence p
+            USING {os.environ['MAIN_DB_SCHEMA']}.users u
+            WHERE u.id = p.user_id AND p.last_seen <= u.last_seen AND p.last_seen < NOW() - INTERVAL '1 day'"""
+    )
+    return flushed
+
+def flush():
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        flushed = flush_presence(cur)
+        conn.commit()
+        _tracker.record_flush(flushed)
+    except Exception as e:
+        log_error('presence-flush', e)
+    finally:
+        cur.close()
+        release_connection(conn)
+
+def fetch_presence(cur, user_ids) -> dict:
+    cur.execute(
+        f"""SELECT u.id, GREATEST(u.last_seen, p.last_seen),
+                COALESCE(p.last_seen > NOW() - make_interval(secs => %s), FALSE)
+            FROM {os.environ['MAIN_DB_SCHEMA']}.users u
+            LEFT JOIN {os.environ['MAIN_DB_SCHEMA']}.presence p ON p.user_id = u.id
+            WHERE u.id = ANY(%s::integer[])""",
+        (PRESENCE_ONLINE_WINDOW, list(user_ids))
+    )
+    return {user_id: (last_seen, online) for user_id, last_seen, online in cur.fetchall()}
+
+def presence_stats() -> dict:
+    return _tracker.stats()
+
+
+if __name__ == '__main__':
+    while True:
+        flush()
+        time.sleep(PRESENCE_FLUSH_INTERVAL)
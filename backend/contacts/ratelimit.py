@@ -0,0 +1,45 @@
+"""
+Token bucket в PostgreSQL: одна атомарная upsert-операция на проверку, общая для всех экземпляров функции
+"""
+import math
+import os
+import random
+
+
+def take_token(cur, key: str, capacity: float, refill_per_second: float, cost: float = 1) -> tuple:
+    level = "LEAST(%(capacity)s, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at) * %(rate)s)"
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.rate_limits AS r (key, tokens, allowed, updated_at)
+            VALUES (%(key)s, %(capacity)s - %(cost)s, TRUE, NOW())
+            ON CONFLICT (key) DO UPDATE SET
+                allowed = {level} >= %(cost)s,
+                tokens = CASE WHEN {level} >= %(cost)s THEN {level} - %(cost)s ELSE {level} END,
+                updated_at = NOW()
+            RETURNING r.allowed, r.tokens""",
+        {'key': key, 'capacity': capacity, 'rate': refill_per_second, 'cost': cost}
+    )
+    allowed, tokens = cur.fetchone()
+    retry_after = 0 if allowed else math.ceil((cost - tokens) / refill_per_second)
+    return allowed, retry_after
+
+def maybe_purge(cur, probability: float = 0.01, batch_size: int = 1000):
+    if random.random() >= probability:
+        return
+    cur.execute(
+        f"""DELETE FROM {os.environ['MAIN_DB_SCHEMA']}.auth_codes
+            WHERE id IN (
+                SELECT id FROM {os.environ['MAIN_DB_SCHEMA']}.auth_codes
+                WHERE expires_at < NOW() - INTERVAL '1 hour'
+                LIMIT %s
+            )""",
+        (batch_size,)
+    )
+    cur.execute(
+        f"""DELETE FROM {os.environ['MAIN_DB_SCHEMA']}.rate_limits
+            WHERE key IN (
+                SELECT key FROM {os.environ['MAIN_DB_SCHEMA']}.rate_limits
+                WHERE updated_at < NOW() - INTERVAL '1 day'
+                LIMIT %s
+            )""",
+        (batch_size,)
+    )
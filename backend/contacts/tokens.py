@@ -0,0 +1,82 @@
+"""
+Выпуск и проверка JWT (HS256) с ротацией ключей и кэшем уже проверенных токенов
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+
+def _load_secrets() -> list:
+    secrets = [s.strip() for s in os.environ.get('JWT_SECRETS', '').split(',') if s.strip()]
+    if not secrets:
+        secrets = [os.environ.get('JWT_SECRET', 'default-secret-key')]
+    return secrets
+
+
+class TokenVerifier:
+    def __init__(self, secrets: list, max_size: int = 10000):
+        self.secrets = list(secrets)
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def issue(self, payload: dict) -> str:
+        return jwt.encode(payload, self.secrets[0], algorithm='HS256')
+
+    def verify(self, token: str) -> dict:
+        key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._cache.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return payload
+                del self._cache[key]
+            self._stats['misses'] += 1
+
+        payload = self._decode(token)
+        expires_at = payload.get('exp')
+
+        with self._lock:
+            self._cache[key] = (payload, expires_at)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self._stats['evictions'] += 1
+        return payload
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        stats['max_size'] = self.max_size
+        stats['keys'] = len(self.secrets)
+        return stats
+
+    def _decode(self, token: str) -> dict:
+        for secret in self.secrets[:-1]:
+            try:
+                return jwt.decode(token, secret, algorithms=['HS256'])
+            except jwt.InvalidSignatureError:
+                continue
+        return jwt.decode(token, self.secrets[-1], algorithms=['HS256'])
+
+
+_verifier = TokenVerifier(_load_secrets(), max_size=int(os.environ.get('TOKEN_CACHE_SIZE', '10000')))
+
+def issue_token(payload: dict) -> str:
+    return _verifier.issue(payload)
+
+def verify_token(token: str) -> dict:
+    return _verifier.verify(token)
+
+def token_cache_stats() -> dict:
+    return _verifier.stats()
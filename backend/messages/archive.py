@@ -0,0 +1,286 @@
+"""
+Архивация старых месячных секций messages в сжатые сегменты по чатам и чтение архива при листании истории
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import time
+from datetime import date, datetime
+
+import psycopg2.errors
+from psycopg2.extras import execute_values
+
+from db import get_connection, release_connection
+
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get('ARCHIVE_SEGMENT_SIZE', '1000'))
+DETACH_LOCK_TIMEOUT = os.environ.get('ARCHIVE_DETACH_LOCK_TIMEOUT', '2s')
+DETACH_ATTEMPTS = 5
+PARTITION_NAME = re.compile(r'^messages_(\d{4})_(\d{2})$')
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f'messages_{month:%Y_%m}'
+
+def list_partitions(cur) -> dict:
+    cur.execute(
+        """SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = %s AND p.relname = 'messages'""",
+        (os.environ['MAIN_DB_SCHEMA'],)
+    )
+    partitions = {}
+    for (name,) in cur.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[name] = date(int(match.group(1)), int(match.group(2)), 1)
+    return partitions
+
+def missing_partitions(cur, months_ahead: int = 3) -> list:
+    # Только чтение: какие месяцы нужно создать и какие из них придётся забрать из DEFAULT
+    existing = list_partitions(cur)
+    current = date.today().replace(day=1)
+    # Пока задача не запускалась, строки месяцев без секции копятся в DEFAULT, и CREATE ... PARTITION OF на них падает
+    cur.execute(f"SELECT DISTINCT date_trunc('month', created_at)::date FROM {os.environ['MAIN_DB_SCHEMA']}.messages_default")
+    stranded = {month for (month,) in cur.fetchall()}
+    months = sorted({add_months(current, offset) for offset in range(months_ahead + 1)} | stranded)
+    return [(month, month in stranded) for month in months if partition_name(month) not in existing]
+
+def ensure_partitions(cur, months_ahead: int = 3) -> list:
+    created = []
+    for month, stranded in missing_partitions(cur, months_ahead):
+        if stranded:
+            move_from_default(cur, month)
+        else:
+            cur.execute(
+                f"""CREATE TABLE {os.environ['MAIN_DB_SCHEMA']}.{partition_name(month)}
+                    PARTITION OF {os.environ['MAIN_DB_SCHEMA']}.messages
+                    FOR VALUES FROM (%s) TO (%s)""",
+                (month, add_months(month, 1))
+            )
+        created.append(partition_name(month))
+    return created
+
+def move_from_default(cur, month: date):
+    schema, name = os.environ['MAIN_DB_SCHEMA'], partition_name(month)
+    bounds = (month, add_months(month, 1))
+    # CHECK с границами секции избавляет ATTACH от повторной проверки всех строк
+    cur.execute(
+        f"""CREATE TABLE {schema}.{name} (
+                LIKE {schema}.messages INCLUDING DEFAULTS INCLUDING GENERATED,
+                CONSTRAINT {name}_bounds CHECK (created_at >= %s AND created_at < %s)
+            )""",
+        bounds
+    )
+    cur.execute(
+        f"""WITH moved AS (
+                DELETE FROM {schema}.messages_default
+                WHERE created_at >= %s AND created_at < %s
+                RETURNING id, chat_id, sender_id, content, created_at
+            )
+            INSERT INTO {schema}.{name} (id, chat_id, sender_id, content, created_at)
+            SELECT id, chat_id, sender_id, content, created_at FROM moved""",
+        bounds
+    )
+    cur.execute(f'ALTER TABLE {schema}.messages ATTACH PARTITION {schema}.{name} FOR VALUES FROM (%s) TO (%s)', bounds)
+    cur.execute(f'ALTER TABLE {schema}.{name} DROP CONSTRAINT {name}_bounds')
+
+def archivable_partitions(cur, keep_months: int) -> list:
+    cutoff = add_months(date.today().replace(day=1), -keep_months)
+    return sorted(name for name, month in list_partitions(cur).items() if add_months(month, 1) <= cutoff)
+
+def encode_segment(rows: list) -> bytes:
+    return gzip.compress(json.dumps(
+        [[msg_id, sender_id, content, created_at.isoformat()] for msg_id, sender_id, content, created_at in rows],
+        ensure_ascii=False
+    ).encode())
+
+def decode_segment(payload) -> list:
+    return [
+        (msg_id, sender_id, content, datetime.fromisoformat(created_at))
+        for msg_id, sender_id, content, created_at in json.loads(gzip.decompress(bytes(payload)))
+    ]
+
+def archive_partition(conn, name: str, export_dir: str = None) -> dict:
+    schema = os.environ['MAIN_DB_SCHEMA']
+    cur = conn.cursor()
+    source = conn.cursor(name=f'archive_{name}')
+    export = gzip.open(os.path.join(export_dir, f'{name}.jsonl.gz'), 'wt', encoding='utf-8') if export_dir else None
+    stats = {'partition': name, 'messages': 0, 'segments': 0}
+
+    try:
+        # Секция остаётся присоединённой, пока строятся сегменты: SHARE на ней самой не мешает ни чтению истории,
+        # ни вставкам в текущие месяцы, а сегменты до коммита никому не видны, так что дублей при листании нет
+        cur.execute(f'LOCK TABLE {schema}.{name} IN SHARE MODE')
+        source.execute(f'SELECT chat_id, id, sender_id, content, created_at FROM {schema}.{name} ORDER BY chat_id, id')
+
+        segments = []
+        chat_id, rows = None, []
+
+        def close_segment():
+            segments.append((chat_id, rows[0][0], rows[-1][0], name, len(rows), encode_segment(rows)))
+            stats['segments'] += 1
+
+        for row_chat_id, msg_id, sender_id, content, created_at in source:
+            if rows and (row_chat_id != chat_id or len(rows) >= ARCHIVE_SEGMENT_SIZE):
+                close_segment()
+                rows = []
+            chat_id = row_chat_id
+            rows.append((msg_id, sender_id, content, created_at))
+            stats['messages'] += 1
+            if export is not None:
+                export.write(json.dumps({
+                    'id': msg_id,
+                    'chat_id': row_chat_id,
+                    'sender_id': sender_id,
+                    'content': content,
+                    'created_at': created_at.isoformat()
+                }, ensure_ascii=False) + '\n')
+            if len(segments) >= 100:
+                insert_segments(cur, segments)
+                segments = []
+        if rows:
+            close_segment()
+        insert_segments(cur, segments)
+
+        source.close()
+        detach_partition(cur, name)
+        cur.execute(f'DROP TABLE {schema}.{name}')
+        return stats
+    finally:
+        if export is not None:
+            export.close()
+        cur.close()
+
+def detach_partition(cur, name: str):
+    schema = os.environ['MAIN_DB_SCHEMA']
+    # DETACH берёт ACCESS EXCLUSIVE на messages до коммита: ждём его недолго и повторяем, а не копим очередь за собой
+    for attempt in range(DETACH_ATTEMPTS):
+        cur.execute('SAVEPOINT detach_partition')
+        try:
+            cur.execute("SELECT set_config('lock_timeout', %s, true)", (DETACH_LOCK_TIMEOUT,))
+            cur.execute(f'ALTER TABLE {schema}.messages DETACH PARTITION {schema}.{name}')
+        except psycopg2.errors.LockNotAvailable:
+            cur.execute('ROLLBACK TO SAVEPOINT detach_partition')
+            if attempt == DETACH_ATTEMPTS - 1:
+                raise
+            time.sleep(attempt + 1)
+            continue
+        cur.execute('RELEASE SAVEPOINT detach_partition')
+        return
+
+def insert_segments(cur, segments: list):
+    if not segments:
+        return
+    execute_values(
+        cur,
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.message_archive
+            (chat_id, min_id, max_id, partition_name, message_count, payload)
+            VALUES %s
+            ON CONFLICT (chat_id, max_id) DO NOTHING""",
+        segments
+    )
+
+def read_archived(cur, chat_id: int, user_id: int, before_id: int = None, after_id: int = None, limit: int = 50) -> list:
+    # Сначала только заголовки сегментов: их мало, а payload читаем лишь для тех, что покрывают страницу
+    if after_id is not None:
+        cur.execute(
+            f"""SELECT min_id, max_id, message_count FROM {os.environ['MAIN_DB_SCHEMA']}.message_archive
+                WHERE chat_id = %s AND max_id > %s
+                ORDER BY max_id ASC""",
+            (chat_id, after_id)
+        )
+    else:
+        cur.execute(
+            f"""SELECT min_id, max_id, message_count FROM {os.environ['MAIN_DB_SCHEMA']}.message_archive
+                WHERE chat_id = %s AND (%s::bigint IS NULL OR min_id < %s)
+                ORDER BY max_id DESC""",
+            (chat_id, before_id, before_id)
+        )
+    keys, covered = [], 0
+    for min_id, max_id, message_count in cur.fetchall():
+        keys.append(max_id)
+        # Сегмент, через который проходит курсор, покрывает страницу лишь частично
+        if (after_id is not None and min_id > after_id) or (after_id is None and (before_id is None or max_id < before_id)):
+            covered += message_count
+        if covered >= limit:
+            break
+
+    if not keys:
+        return []
+
+    cur.execute(
+        f"""SELECT payload FROM {os.environ['MAIN_DB_SCHEMA']}.message_archive
+            WHERE chat_id = %s AND max_id = ANY(%s::bigint[])""",
+        (chat_id, keys)
+    )
+    rows = [row for (payload,) in cur.fetchall() for row in decode_segment(payload)]
+    if after_id is not None:
+        rows = sorted((row for row in rows if row[0] > after_id), key=lambda row: row[0])[:limit]
+    else:
+        rows = sorted((row for row in rows if before_id is None or row[0] < before_id), key=lambda row: -row[0])[:limit]
+
+    if not rows:
+        return []
+
+    cur.execute(
+        f"""SELECT COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id <> %s), 0),
+                   COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id = %s), 0)
+            FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+            WHERE chat_id = %s""",
+        (user_id, user_id, chat_id)
+    )
+    read_up_to, my_read_up_to = cur.fetchone()
+    cur.execute(
+        f"SELECT id, username FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE id = ANY(%s::integer[])",
+        (sorted({row[1] for row in rows}),)
+    )
+    usernames = dict(cur.fetchall())
+
+    return [
+        (msg_id, sender_id, content, created_at, usernames.get(sender_id),
+         msg_id <= (read_up_to if sender_id == user_id else my_read_up_to))
+        for msg_id, sender_id, content, created_at in rows
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Создание будущих секций messages и архивация старых')
+    parser.add_argument('--keep-months', type=int, default=12)
+    parser.add_argument('--months-ahead', type=int, default=3)
+    parser.add_argument('--export-dir')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # В пробном запуске ничего не создаётся и не переносится: печатается только план
+        if args.dry_run:
+            planned = [partition_name(month) for month, _ in missing_partitions(cur, args.months_ahead)]
+            print(json.dumps({'would_create': planned, 'archivable': archivable_partitions(cur, args.keep_months)}))
+            conn.rollback()
+            return
+        created = ensure_partitions(cur, args.months_ahead)
+        conn.commit()
+        targets = archivable_partitions(cur, args.keep_months)
+        print(json.dumps({'created': created, 'archivable': targets}))
+        # Каждая секция архивируется в своей транзакции: сбой оставит её присоединённой и без сегментов
+        for name in targets:
+            print(json.dumps(archive_partition(conn, name, args.export_dir)))
+            conn.commit()
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+if __name__ == '__main__':
+    main()
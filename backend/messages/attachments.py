@@ -0,0 +1,559 @@
+"""
+Вложения: подключаемое хранилище blob-ов, возобновляемая загрузка по частям с адресацией по SHA-256 и превью вне запроса.
+
+Хранилище задаётся окружением:
+    BLOB_STORE_BUCKET    бакет S3-совместимого хранилища (обязателен; нужен boto3 и его обычные AWS_* ключи)
+    BLOB_STORE_ENDPOINT  адрес хранилища, если это не AWS S3
+    BLOB_STORE=local     blob-ы на локальном диске в BLOB_STORE_PATH (по умолчанию /tmp/blobs) — только для разработки
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import secrets
+import time
+
+from psycopg2.extras import execute_values
+
+from api import ApiError
+from db import get_connection, release_connection
+from instrument import log_error
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get('ATTACHMENT_CHUNK_SIZE', str(1024 * 1024)))
+MAX_ATTACHMENT_SIZE = int(os.environ.get('MAX_ATTACHMENT_SIZE', str(50 * 1024 * 1024)))
+MAX_RANGE_BYTES = int(os.environ.get('MAX_RANGE_BYTES', str(2 * 1024 * 1024)))
+UPLOAD_TTL_HOURS = int(os.environ.get('UPLOAD_TTL_HOURS', '24'))
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_BATCH_SIZE = 20
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Показываются в браузере только медиа; SVG и всё остальное может нести скрипт и отдаётся файлом
+INLINE_CONTENT_TYPE = re.compile(r'^(image/(?!svg)|video/|audio/)[a-z0-9.+-]+$')
+
+
+class BlobStore:
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def read(self, key: str, start: int = 0, end: int = None) -> bytes:
+        raise NotImplementedError
+
+    def size(self, key: str):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def write_stream(self, key: str, chunks):
+        self.put(key, b''.join(chunks))
+
+    def rename(self, source: str, target: str):
+        self.put(target, self.read(source))
+        self.delete(source)
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def put(self, key: str, data: bytes):
+        self.write_stream(key, [data])
+
+    def read(self, key: str, start: int = 0, end: int = None) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(-1 if end is None else end - start)
+
+    def size(self, key: str):
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def write_stream(self, key: str, chunks):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Запись во временный файл и os.replace: читатель никогда не увидит недописанный blob
+        temp = f'{path}.{secrets.token_hex(4)}.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def rename(self, source: str, target: str):
+        path = self._path(target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._path(source), path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket: str, endpoint_url: str = None):
+        if boto3 is None:
+            raise RuntimeError('BLOB_STORE=s3 requires boto3')
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def read(self, key: str, start: int = 0, end: int = None) -> bytes:
+        byte_range = f'bytes={start}-{"" if end is None else end - 1}'
+        return self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)['Body'].read()
+
+    def size(self, key: str):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def rename(self, source: str, target: str):
+        self.client.copy_object(Bucket=self.bucket, Key=target, CopySource={'Bucket': self.bucket, 'Key': source})
+        self.delete(source)
+
+
+_store = None
+
+def get_blob_store() -> BlobStore:
+    global _store
+    if _store is None:
+        # Локальный диск у каждого экземпляра функции свой и временный: он годится только для разработки и тестов
+        if os.environ.get('BLOB_STORE', 's3') == 'local':
+            _store = LocalBlobStore(os.environ.get('BLOB_STORE_PATH', '/tmp/blobs'))
+        elif not os.environ.get('BLOB_STORE_BUCKET') or boto3 is None:
+            # Ошибка развёртывания, а не запроса: клиент получает 503, причина — в логе
+            log_error('blob-store', RuntimeError('BLOB_STORE_BUCKET and boto3 are required; BLOB_STORE=local is for development only'))
+            raise ApiError(503, 'Attachment storage is not configured')
+        else:
+            _store = S3BlobStore(os.environ['BLOB_STORE_BUCKET'], os.environ.get('BLOB_STORE_ENDPOINT'))
+    return _store
+
+def blob_key(sha256: str) -> str:
+    return f'blobs/{sha256[:2]}/{sha256}'
+
+def chunk_key(upload_id: str, index: int) -> str:
+    return f'uploads/{upload_id}/{index:06d}'
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    return max(1, math.ceil(size / chunk_size))
+
+
+def start_upload(cur, user_id: int, filename: str, content_type: str, size: int, sha256: str = None) -> dict:
+    if not filename or size < 0 or size > MAX_ATTACHMENT_SIZE:
+        raise ApiError(400, f'filename is required and size must be at most {MAX_ATTACHMENT_SIZE} bytes')
+    if sha256 is not None and not SHA256.match(sha256):
+        raise ApiError(400, 'sha256 must be 64 lowercase hex characters')
+
+    # Повторная загрузка не нужна, только если пользователь уже видит вложение с этим содержимым:
+    # иначе знание одного хеша давало бы доступ к чужому файлу
+    if sha256 is not None and blob_accessible(cur, user_id, sha256, size):
+        return {'upload_id': None, 'attachment': create_attachment(cur, user_id, sha256, filename, content_type, size)}
+
+    upload_id = secrets.token_hex(16)
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.uploads
+            (id, user_id, filename, content_type, size, chunk_size, sha256, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() + make_interval(hours => %s))""",
+        (upload_id, user_id, filename, content_type, size, ATTACHMENT_CHUNK_SIZE, sha256, UPLOAD_TTL_HOURS)
+    )
+    return {
+        'upload_id': upload_id,
+        'chunk_size': ATTACHMENT_CHUNK_SIZE,
+        'chunks': chunk_count(size, ATTACHMENT_CHUNK_SIZE),
+        'attachment': None
+    }
+
+def blob_accessible(cur, user_id: int, sha256: str, size: int) -> bool:
+    cur.execute(
+        f"""SELECT 1 FROM {os.environ['MAIN_DB_SCHEMA']}.attachments a
+            WHERE a.sha256 = %(sha256)s AND a.size = %(size)s AND (
+                a.uploader_id = %(user_id)s OR EXISTS (
+                    SELECT 1 FROM {os.environ['MAIN_DB_SCHEMA']}.message_attachments ma
+                    JOIN {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+                        ON cp.chat_id = ma.chat_id AND cp.user_id = %(user_id)s
+                    WHERE ma.attachment_id = a.id
+                )
+            )
+            LIMIT 1""",
+        {'sha256': sha256, 'size': size, 'user_id': user_id}
+    )
+    return cur.fetchone() is not None
+
+def load_upload(cur, user_id: int, upload_id: str, lock: bool = False) -> tuple:
+    cur.execute(
+        f"""SELECT filename, content_type, size, chunk_size, sha256
+            FROM {os.environ['MAIN_DB_SCHEMA']}.uploads
+            WHERE id = %s AND user_id = %s AND expires_at > NOW()
+            {'FOR UPDATE' if lock else ''}""",
+        (upload_id, user_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise ApiError(404, 'Upload not found or expired')
+    return row
+
+def store_chunk(cur, user_id: int, upload_id: str, index: int, data: bytes) -> dict:
+    _, _, size, chunk_size, _ = load_upload(cur, user_id, upload_id)
+    chunks = chunk_count(size, chunk_size)
+    if not 0 <= index < chunks:
+        raise ApiError(400, f'index must be between 0 and {chunks - 1}')
+    expected = min(chunk_size, size - index * chunk_size)
+    if len(data) != expected:
+        raise ApiError(400, f'Chunk {index} must be {expected} bytes')
+
+    get_blob_store().put(chunk_key(upload_id, index), data)
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.upload_chunks (upload_id, chunk_index, size)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (upload_id, chunk_index) DO UPDATE SET size = EXCLUDED.size""",
+        (upload_id, index, len(data))
+    )
+    cur.execute(
+        f"SELECT COUNT(*) FROM {os.environ['MAIN_DB_SCHEMA']}.upload_chunks WHERE upload_id = %s",
+        (upload_id,)
+    )
+    return {'upload_id': upload_id, 'received': cur.fetchone()[0], 'chunks': chunks}
+
+def upload_status(cur, user_id: int, upload_id: str) -> dict:
+    _, _, size, chunk_size, _ = load_upload(cur, user_id, upload_id)
+    cur.execute(
+        f"""SELECT chunk_index FROM {os.environ['MAIN_DB_SCHEMA']}.upload_chunks
+            WHERE upload_id = %s ORDER BY chunk_index""",
+        (upload_id,)
+    )
+    return {
+        'upload_id': upload_id,
+        'chunk_size': chunk_size,
+        'chunks': chunk_count(size, chunk_size),
+        'received': [row[0] for row in cur.fetchall()]
+    }
+
+def complete_upload(conn, user_id: int, upload_id: str) -> dict:
+    store = get_blob_store()
+    assembled = f'uploads/{upload_id}/assembled'
+    cur = conn.cursor()
+    try:
+        filename, content_type, size, chunk_size, expected_sha256 = load_upload(cur, user_id, upload_id, lock=True)
+        chunks = chunk_count(size, chunk_size)
+        cur.execute(
+            f"SELECT COUNT(*) FROM {os.environ['MAIN_DB_SCHEMA']}.upload_chunks WHERE upload_id = %s",
+            (upload_id,)
+        )
+        received = cur.fetchone()[0]
+        if received < chunks:
+            raise ApiError(409, f'Received {received} of {chunks} chunks')
+
+        hasher = hashlib.sha256()
+        assembled_size = 0
+
+        def assemble():
+            nonlocal assembled_size
+            for index in range(chunks):
+                data = store.read(chunk_key(upload_id, index))
+                hasher.update(data)
+                assembled_size += len(data)
+                yield data
+
+        store.write_stream(assembled, assemble())
+        sha256 = hasher.hexdigest()
+
+        if assembled_size != size or (expected_sha256 and expected_sha256 != sha256):
+            store.delete(assembled)
+            raise ApiError(422, 'Uploaded content does not match the declared size or sha256')
+
+        cur.execute(
+            f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.blobs (sha256, size) VALUES (%s, %s)
+                ON CONFLICT (sha256) DO NOTHING""",
+            (sha256, size)
+        )
+        attachment = create_attachment(cur, user_id, sha256, filename, content_type, size)
+        cur.execute(f"DELETE FROM {os.environ['MAIN_DB_SCHEMA']}.uploads WHERE id = %s", (upload_id,))
+        conn.commit()
+    finally:
+        cur.close()
+
+    # Файлы переносятся только после коммита: откат не оставит в хранилище blob без строки. Если перенос сорвётся,
+    # строка останется без файла, и следующая загрузка того же содержимого его восполнит
+    if store.size(blob_key(sha256)) is None:
+        store.rename(assembled, blob_key(sha256))
+    else:
+        store.delete(assembled)
+    for index in range(chunks):
+        store.delete(chunk_key(upload_id, index))
+    return attachment
+
+def create_attachment(cur, user_id: int, sha256: str, filename: str, content_type: str, size: int) -> dict:
+    # Превью того же содержимого уже могло быть сделано для другого вложения — берём его
+    cur.execute(
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.attachments
+            (uploader_id, sha256, filename, content_type, size, thumbnail_sha256, thumbnail_status)
+            SELECT %(user_id)s, %(sha256)s, %(filename)s, %(content_type)s, %(size)s, t.thumbnail_sha256,
+                CASE WHEN t.thumbnail_sha256 IS NOT NULL THEN 'ready'
+                     WHEN %(content_type)s LIKE 'image/%%' THEN 'pending'
+                     ELSE 'none' END
+            FROM (SELECT 1) one
+            LEFT JOIN LATERAL (
+                SELECT thumbnail_sha256 FROM {os.environ['MAIN_DB_SCHEMA']}.attachments
+                WHERE sha256 = %(sha256)s AND thumbnail_status = 'ready'
+                LIMIT 1
+            ) t ON TRUE
+            RETURNING id, thumbnail_status""",
+        {'user_id': user_id, 'sha256': sha256, 'filename': filename[:255], 'content_type': content_type[:127], 'size': size}
+    )
+    attachment_id, thumbnail_status = cur.fetchone()
+    return attachment_meta(attachment_id, filename[:255], content_type[:127], size, sha256, thumbnail_status)
+
+def attachment_meta(attachment_id: int, filename: str, content_type: str, size: int, sha256: str,
+                    thumbnail_status: str) -> dict:
+    return {
+        'id': attachment_id,
+        'filename': filename,
+        'content_type': content_type,
+        'size': size,
+        'sha256': sha256,
+        'thumbnail': thumbnail_status == 'ready'
+    }
+
+
+def accessible_attachments(cur, user_id: int, attachment_ids: list) -> set:
+    # Своё вложение или вложение из сообщения в чате, где пользователь участник: так работает пересылка
+    cur.execute(
+        f"""SELECT a.id FROM {os.environ['MAIN_DB_SCHEMA']}.attachments a
+            WHERE a.id = ANY(%(ids)s::bigint[]) AND (
+                a.uploader_id = %(user_id)s OR EXISTS (
+                    SELECT 1 FROM {os.environ['MAIN_DB_SCHEMA']}.message_attachments ma
+                    JOIN {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+                        ON cp.chat_id = ma.chat_id AND cp.user_id = %(user_id)s
+                    WHERE ma.attachment_id = a.id
+                )
+            )""",
+        {'ids': attachment_ids, 'user_id': user_id}
+    )
+    return {row[0] for row in cur.fetchall()}
+
+def attach_to_message(cur, chat_id: int, message_id: int, attachment_ids: list):
+    execute_values(
+        cur,
+        f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.message_attachments
+            (message_id, position, chat_id, attachment_id) VALUES %s""",
+        [(message_id, position, chat_id, attachment_id) for position, attachment_id in enumerate(attachment_ids)]
+    )
+
+def fetch_message_attachments(cur, message_ids: list) -> dict:
+    if not message_ids:
+        return {}
+    cur.execute(
+        f"""SELECT ma.message_id, a.id, a.filename, a.content_type, a.size, a.sha256, a.thumbnail_status
+            FROM {os.environ['MAIN_DB_SCHEMA']}.message_attachments ma
+            JOIN {os.environ['MAIN_DB_SCHEMA']}.attachments a ON a.id = ma.attachment_id
+            WHERE ma.message_id = ANY(%s::bigint[])
+            ORDER BY ma.message_id, ma.position""",
+        (list(message_ids),)
+    )
+    by_message = {}
+    for message_id, attachment_id, filename, content_type, size, sha256, thumbnail_status in cur.fetchall():
+        by_message.setdefault(message_id, []).append(
+            attachment_meta(attachment_id, filename, content_type, size, sha256, thumbnail_status)
+        )
+    return by_message
+
+def parse_range(header: str, size: int) -> tuple:
+    # Без Range отдаём файл целиком, а большой файл по одному ответу функции не передать — клиент должен запросить диапазон
+    if not header:
+        if size > MAX_RANGE_BYTES:
+            raise ApiError(400, f'Range header is required for attachments over {MAX_RANGE_BYTES} bytes')
+        return 0, size, False
+    match = RANGE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        raise ApiError(416, 'Only a single bytes=start-end range is supported')
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+    else:
+        start, end = max(0, size - int(match.group(2))), size
+    if start >= size or start >= end:
+        raise ApiError(416, 'Range not satisfiable')
+    # Ответ функции ограничен по размеру: длинный диапазон отдаём частями, клиент продолжит по Content-Range
+    return start, min(end, start + MAX_RANGE_BYTES), True
+
+def inline_content_type(content_type: str) -> bool:
+    return INLINE_CONTENT_TYPE.match(content_type) is not None
+
+def find_attachment_blob(cur, user_id: int, attachment_id: int, thumbnail: bool = False) -> dict:
+    if attachment_id not in accessible_attachments(cur, user_id, [attachment_id]):
+        raise ApiError(404, 'Attachment not found')
+    cur.execute(
+        f"""SELECT a.filename, a.content_type, b.sha256, b.size
+            FROM {os.environ['MAIN_DB_SCHEMA']}.attachments a
+            JOIN {os.environ['MAIN_DB_SCHEMA']}.blobs b
+                ON b.sha256 = CASE WHEN %s THEN a.thumbnail_sha256 ELSE a.sha256 END
+            WHERE a.id = %s""",
+        (thumbnail, attachment_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise ApiError(404, 'Thumbnail not ready')
+    filename, content_type, sha256, size = row
+    return {
+        'filename': filename,
+        'content_type': 'image/jpeg' if thumbnail else content_type,
+        'sha256': sha256,
+        'size': size
+    }
+
+def read_blob(sha256: str, start: int, end: int) -> bytes:
+    return get_blob_store().read(blob_key(sha256), start, end) if end > start else b''
+
+
+def make_thumbnail(data: bytes) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail(THUMBNAIL_SIZE)
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+def generate_thumbnails(conn, batch_size: int = THUMBNAIL_BATCH_SIZE) -> int:
+    schema = os.environ['MAIN_DB_SCHEMA']
+    store = get_blob_store()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""SELECT id, sha256 FROM {schema}.attachments
+                WHERE thumbnail_status = 'pending'
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED""",
+            (batch_size,)
+        )
+        claimed = cur.fetchall()
+        done = {}
+        for attachment_id, sha256 in claimed:
+            if sha256 not in done:
+                done[sha256] = None
+                if Image is not None:
+                    try:
+                        thumbnail = make_thumbnail(store.read(blob_key(sha256)))
+                        thumbnail_sha256 = hashlib.sha256(thumbnail).hexdigest()
+                        cur.execute(
+                            f"""INSERT INTO {schema}.blobs (sha256, size) VALUES (%s, %s)
+                                ON CONFLICT (sha256) DO NOTHING RETURNING sha256""",
+                            (thumbnail_sha256, len(thumbnail))
+                        )
+                        if cur.fetchone() is not None:
+                            store.put(blob_key(thumbnail_sha256), thumbnail)
+                        done[sha256] = thumbnail_sha256
+                    except Exception as e:
+                        log_error('thumbnail', e, attachment=attachment_id)
+            cur.execute(
+                f"""UPDATE {schema}.attachments
+                    SET thumbnail_sha256 = %s, thumbnail_status = %s
+                    WHERE id = %s""",
+                (done[sha256], 'ready' if done[sha256] else 'failed', attachment_id)
+            )
+        conn.commit()
+        return len(claimed)
+    finally:
+        cur.close()
+
+def collect_garbage(conn) -> dict:
+    schema = os.environ['MAIN_DB_SCHEMA']
+    store = get_blob_store()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""DELETE FROM {schema}.uploads u
+                WHERE expires_at < NOW()
+                RETURNING id, (SELECT array_agg(chunk_index) FROM {schema}.upload_chunks c WHERE c.upload_id = u.id)""",
+        )
+        expired = cur.fetchall()
+        # Загруженные, но так и не отправленные вложения живут столько же, сколько незавершённая загрузка
+        cur.execute(
+            f"""DELETE FROM {schema}.attachments a
+                WHERE created_at < NOW() - make_interval(hours => %s)
+                    AND NOT EXISTS (SELECT 1 FROM {schema}.message_attachments ma WHERE ma.attachment_id = a.id)""",
+            (UPLOAD_TTL_HOURS,)
+        )
+        orphaned = cur.rowcount
+        cur.execute(
+            f"""DELETE FROM {schema}.blobs b
+                WHERE created_at < NOW() - make_interval(hours => %s)
+                    AND NOT EXISTS (SELECT 1 FROM {schema}.attachments a WHERE a.sha256 = b.sha256)
+                    AND NOT EXISTS (SELECT 1 FROM {schema}.attachments a WHERE a.thumbnail_sha256 = b.sha256)
+                RETURNING sha256""",
+            (UPLOAD_TTL_HOURS,)
+        )
+        blobs = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    finally:
+        cur.close()
+
+    # Файлы удаляются только после коммита: откат не оставит строку без содержимого
+    for upload_id, indexes in expired:
+        for index in indexes or []:
+            store.delete(chunk_key(upload_id, index))
+        store.delete(f'uploads/{upload_id}/assembled')
+    for sha256 in blobs:
+        store.delete(blob_key(sha256))
+    return {'expired_uploads': len(expired), 'orphaned_attachments': orphaned, 'deleted_blobs': len(blobs)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Превью вложений и уборка незавершённых загрузок и ничейных blob-ов')
+    parser.add_argument('--loop', type=float, help='повторять каждые N секунд')
+    parser.add_argument('--skip-gc', action='store_true')
+    args = parser.parse_args()
+
+    while True:
+        conn = get_connection()
+        try:
+            generated = 0
+            while True:
+                claimed = generate_thumbnails(conn)
+                generated += claimed
+                if claimed < THUMBNAIL_BATCH_SIZE:
+                    break
+            report = {'thumbnails': generated}
+            if not args.skip_gc:
+                report.update(collect_garbage(conn))
+            print(json.dumps(report))
+        finally:
+            release_connection(conn)
+        if not args.loop:
+            return
+        time.sleep(args.loop)
+
+
+if __name__ == '__main__':
+    main()
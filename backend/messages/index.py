@@ -1,96 +1,72 @@
 """
 Функция обмена сообщениями: отправка, получение, история чата
 """
+import base64
+import hashlib
 import json
 import os
+import select
+import time
+from urllib.parse import quote
 import psycopg2
-import jwt
-from datetime import datetime
-
-def handler(event: dict, context) -> dict:
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    try:
-        token = event.get('headers', {}).get('authorization', '').replace('Bearer ', '')
-        if not token:
-            return {
-                'statusCode': 401,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Unauthorized'}),
-                'isBase64Encoded': False
-            }
-        
-        jwt_secret = os.environ.get('JWT_SECRET', 'default-secret-key')
-        payload = jwt.decode(token, jwt_secret, algorithms=['HS256'])
-        user_id = payload['user_id']
-        
-        if method == 'POST':
-            return send_message(user_id, event)
-        elif method == 'GET':
-            return get_messages(user_id, event)
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    except jwt.ExpiredSignatureError:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Token expired'}),
-            'isBase64Encoded': False
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
-
-def send_message(user_id: int, event: dict) -> dict:
-    body = json.loads(event.get('body', '{}'))
-    chat_id = body.get('chat_id')
-    content = body.get('content', '').strip()
-    
-    if not chat_id or not content:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'chat_id and content are required'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+from psycopg2.extras import execute_values
+from api import ApiError, Request, Router, binary_response, empty_response, error_response, json_response
+from archive import read_archived
+from attachments import (
+    MAX_ATTACHMENTS_PER_MESSAGE, accessible_attachments, attach_to_message, complete_upload,
+    fetch_message_attachments, find_attachment_blob, inline_content_type, parse_range, read_blob, start_upload,
+    store_chunk, upload_status
+)
+from db import get_connection, get_read_connection, note_write, release_connection, switch_to_primary
+from instrument import phase
+from membership import filter_participant_chats, is_participant
+from presence import touch
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_WAIT_SECONDS = 25
+MAX_BATCH_SIZE = 1000
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_QUERY_LENGTH = 200
+SEARCH_HEADLINE_OPTIONS = 'StartSel=**, StopSel=**, MaxWords=20, MinWords=8, MaxFragments=2'
+
+handler = Router(
+    'messages',
+    allow_headers='Content-Type, Authorization, If-None-Match, Range',
+    expose_headers='ETag, Content-Range, Accept-Ranges'
+)
+
+@handler.route('POST')
+def send_message(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    content = str(body.get('content') or '').strip()
+    
+    try:
+        chat_id = int(body['chat_id']) if body.get('chat_id') else None
+    except (ValueError, TypeError):
+        raise ApiError(400, 'chat_id must be an integer')
+    
+    try:
+        attachment_ids = list(dict.fromkeys(int(attachment_id) for attachment_id in body.get('attachment_ids') or []))
+    except (ValueError, TypeError):
+        return error_response(400, 'attachment_ids must be a list of integers')
+    
+    if not chat_id or not (content or attachment_ids):
+        return error_response(400, 'chat_id and content or attachment_ids are required')
+    
+    if len(attachment_ids) > MAX_ATTACHMENTS_PER_MESSAGE:
+        return error_response(400, f'At most {MAX_ATTACHMENTS_PER_MESSAGE} attachments per message')
+    
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute(
-            f"""SELECT 1 FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants 
-                WHERE chat_id = %s AND user_id = %s""",
-            (chat_id, user_id)
-        )
-        if not cur.fetchone():
-            return {
-                'statusCode': 403,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Not a participant of this chat'}),
-                'isBase64Encoded': False
-            }
+        if not is_participant(cur, chat_id, user_id):
+            return error_response(403, 'Not a participant of this chat')
+        
+        # Пересылка — это ссылка на то же вложение: повторно загружать или копировать содержимое не нужно
+        if attachment_ids and len(accessible_attachments(cur, user_id, attachment_ids)) != len(attachment_ids):
+            return error_response(404, 'Attachment not found')
         
         cur.execute(
             f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.messages 
@@ -100,73 +76,153 @@ def send_message(user_id: int, event: dict) -> dict:
         )
         message_id, created_at = cur.fetchone()
         
+        attachments = []
+        if attachment_ids:
+            attach_to_message(cur, chat_id, message_id, attachment_ids)
+            attachments = fetch_message_attachments(cur, [message_id])[message_id]
+        
+        update_chat_summaries(cur, user_id, {chat_id: (message_id, created_at, 1)})
+        
+        touch(cur, user_id)
+        
         cur.execute(
-            f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.users SET last_seen = NOW() WHERE id = %s",
-            (user_id,)
+            "SELECT pg_notify(%s, %s)",
+            (chat_channel(chat_id), json.dumps({'chat_id': chat_id, 'id': message_id, 'sender_id': user_id}))
         )
         
         conn.commit()
+        note_write(cur, user_id)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'success': True,
-                'message': {
-                    'id': message_id,
-                    'chat_id': chat_id,
-                    'sender_id': user_id,
-                    'content': content,
-                    'created_at': created_at.isoformat()
-                }
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response({
+            'success': True,
+            'message': {
+                'id': message_id,
+                'chat_id': chat_id,
+                'sender_id': user_id,
+                'content': content,
+                'created_at': created_at.isoformat(),
+                'attachments': attachments
+            }
+        })
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
-def get_messages(user_id: int, event: dict) -> dict:
-    query_params = event.get('queryStringParameters') or {}
+@handler.route('GET')
+def get_messages(request: Request) -> dict:
+    user_id, query_params = request.user_id, request.query
     chat_id = query_params.get('chat_id')
     
     if not chat_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'chat_id is required'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        return error_response(400, 'chat_id is required')
+    
+    try:
+        chat_id = int(chat_id)
+        before_id = int(query_params['before_id']) if query_params.get('before_id') else None
+        after_id = int(query_params['after_id']) if query_params.get('after_id') else None
+        limit = int(query_params.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        return error_response(400, 'chat_id, before_id, after_id and limit must be integers')
+    
+    if before_id is not None and after_id is not None:
+        return error_response(400, 'Use either before_id or after_id')
+    
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
+    conn = get_read_connection(user_id)
     cur = conn.cursor()
     
     try:
-        cur.execute(
-            f"""SELECT 1 FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants 
-                WHERE chat_id = %s AND user_id = %s""",
-            (chat_id, user_id)
-        )
-        if not cur.fetchone():
-            return {
-                'statusCode': 403,
-                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Not a participant of this chat'}),
-                'isBase64Encoded': False
-            }
+        with phase('membership'):
+            allowed = is_participant(cur, chat_id, user_id, cache_negative=not conn.replica)
+            if not allowed and conn.replica:
+                # Реплика могла ещё не получить только что созданный чат: отказ перепроверяем на primary
+                conn, cur = switch_to_primary(conn, cur)
+                allowed = is_participant(cur, chat_id, user_id)
+            if not allowed:
+                return error_response(403, 'Not a participant of this chat')
         
-        cur.execute(
-            f"""SELECT m.id, m.sender_id, m.content, m.created_at, m.is_read, u.username
-                FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
-                JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON m.sender_id = u.id
-                WHERE m.chat_id = %s
-                ORDER BY m.created_at ASC""",
-            (chat_id,)
-        )
+        with phase('history'):
+            if after_id is not None:
+                cur.execute(
+                    f"""WITH w AS (
+                            SELECT COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id <> %(user_id)s), 0) AS read_up_to,
+                                   COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id = %(user_id)s), 0) AS my_read_up_to,
+                                   (SELECT MAX(max_id) FROM {os.environ['MAIN_DB_SCHEMA']}.message_archive
+                                    WHERE chat_id = %(chat_id)s) AS archived_up_to
+                            FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+                            WHERE chat_id = %(chat_id)s
+                        )
+                        SELECT m.id, m.sender_id, m.content, m.created_at, m.username,
+                            m.id <= CASE WHEN m.sender_id = %(user_id)s THEN w.read_up_to ELSE w.my_read_up_to END,
+                            w.archived_up_to
+                        FROM w
+                        LEFT JOIN LATERAL (
+                            SELECT m.id, m.sender_id, m.content, m.created_at, u.username
+                            FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                            JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON m.sender_id = u.id
+                            WHERE m.chat_id = %(chat_id)s AND m.id > %(after_id)s
+                            ORDER BY m.id ASC
+                            LIMIT %(limit)s
+                        ) m ON TRUE
+                        ORDER BY m.id ASC""",
+                    {'user_id': user_id, 'chat_id': chat_id, 'after_id': after_id, 'limit': limit + 1}
+                )
+                rows = cur.fetchall()
+            else:
+                cur.execute(
+                    f"""WITH w AS (
+                            SELECT COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id <> %(user_id)s), 0) AS read_up_to,
+                                   COALESCE(MAX(last_read_message_id) FILTER (WHERE user_id = %(user_id)s), 0) AS my_read_up_to,
+                                   (SELECT MAX(max_id) FROM {os.environ['MAIN_DB_SCHEMA']}.message_archive
+                                    WHERE chat_id = %(chat_id)s) AS archived_up_to
+                            FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+                            WHERE chat_id = %(chat_id)s
+                        )
+                        SELECT m.id, m.sender_id, m.content, m.created_at, m.username,
+                            m.id <= CASE WHEN m.sender_id = %(user_id)s THEN w.read_up_to ELSE w.my_read_up_to END,
+                            w.archived_up_to
+                        FROM w
+                        LEFT JOIN LATERAL (
+                            SELECT m.id, m.sender_id, m.content, m.created_at, u.username
+                            FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                            JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON m.sender_id = u.id
+                            WHERE m.chat_id = %(chat_id)s AND (%(before_id)s::bigint IS NULL OR m.id < %(before_id)s)
+                            ORDER BY m.id DESC
+                            LIMIT %(limit)s
+                        ) m ON TRUE
+                        ORDER BY m.id DESC""",
+                    {'user_id': user_id, 'chat_id': chat_id, 'before_id': before_id, 'limit': limit + 1}
+                )
+                rows = cur.fetchall()
+            
+            # LATERAL отдаёт строку и для пустой страницы: из неё берём только границу архива чата
+            archived_up_to = rows[0][6]
+            rows = [row[:6] for row in rows if row[0] is not None]
+        
+        # Старые месяцы лежат в message_archive: туда идём, только если курсор заходит в заархивированный диапазон чата
+        with phase('archive'):
+            if archived_up_to is not None and after_id is not None and after_id < archived_up_to:
+                rows = (read_archived(cur, chat_id, user_id, after_id=after_id, limit=limit + 1) + rows)[:limit + 1]
+            elif archived_up_to is not None and after_id is None and len(rows) <= limit:
+                rows += read_archived(cur, chat_id, user_id, before_id=rows[-1][0] if rows else before_id,
+                                      limit=limit + 1 - len(rows))
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after_id is None:
+            rows.reverse()
+        
+        next_cursor = None
+        if has_more and rows:
+            next_cursor = rows[-1][0] if after_id is not None else rows[0][0]
+        
+        with phase('attachments'):
+            attachments = fetch_message_attachments(cur, [row[0] for row in rows])
         
         messages = []
-        for row in cur.fetchall():
-            msg_id, sender_id, content, created_at, is_read, sender_username = row
+        for row in rows:
+            msg_id, sender_id, content, created_at, sender_username, is_read = row
             messages.append({
                 'id': msg_id,
                 'sender_id': sender_id,
@@ -174,15 +230,617 @@ def get_messages(user_id: int, event: dict) -> dict:
                 'content': content,
                 'created_at': created_at.isoformat(),
                 'is_read': is_read,
+                'is_mine': sender_id == user_id,
+                'attachments': attachments.get(msg_id, [])
+            })
+        
+        return json_response({
+            'messages': messages,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        })
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('GET', 'search')
+def search_messages(request: Request) -> dict:
+    user_id, query_params = request.user_id, request.query
+    query = str(query_params.get('q') or '').strip()
+    sort = query_params.get('sort') or 'relevance'
+    
+    if not query or len(query) > MAX_SEARCH_QUERY_LENGTH:
+        return error_response(400, f'q is required and must be at most {MAX_SEARCH_QUERY_LENGTH} characters')
+    
+    if sort not in ('relevance', 'recent'):
+        return error_response(400, 'sort must be relevance or recent')
+    
+    try:
+        chat_id = int(query_params['chat_id']) if query_params.get('chat_id') else None
+        limit = max(1, min(int(query_params.get('limit') or SEARCH_PAGE_SIZE), MAX_PAGE_SIZE))
+        cursor_rank, cursor_id = decode_search_cursor(query_params['cursor']) if query_params.get('cursor') else (None, None)
+    except (ValueError, TypeError):
+        return error_response(400, 'Invalid chat_id, limit or cursor')
+    
+    conn = get_read_connection(user_id)
+    cur = conn.cursor()
+    
+    try:
+        if chat_id is not None:
+            allowed = is_participant(cur, chat_id, user_id, cache_negative=not conn.replica)
+            if not allowed and conn.replica:
+                conn, cur = switch_to_primary(conn, cur)
+                allowed = is_participant(cur, chat_id, user_id)
+            if not allowed:
+                return error_response(403, 'Not a participant of this chat')
+        
+        if chat_id is not None:
+            scope = 'm.chat_id = %(chat_id)s'
+        else:
+            scope = f"""m.chat_id IN (
+                SELECT chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants WHERE user_id = %(user_id)s
+            )"""
+        
+        # ts_rank дорогой: OFFSET 0 не даёт планировщику считать его в фильтре курсора до отсечения чужих чатов
+        if sort == 'relevance':
+            order_by, page_order = 'rank DESC, id DESC', 'page.rank DESC, page.id DESC'
+            match_filter, fence = '', 'OFFSET 0'
+            page_filter = '%(cursor_id)s::bigint IS NULL OR (rank, id) < (%(cursor_rank)s::real, %(cursor_id)s::bigint)'
+        else:
+            order_by, page_order = 'id DESC', 'page.id DESC'
+            match_filter, fence = 'AND (%(cursor_id)s::bigint IS NULL OR m.id < %(cursor_id)s::bigint)', ''
+            page_filter = 'TRUE'
+        
+        # NOT MATERIALIZED: планировщик видит tsquery константой и выбирает между GIN и индексом (chat_id, id)
+        cur.execute(
+            f"""WITH q AS NOT MATERIALIZED (
+                    SELECT websearch_to_tsquery('russian', %(query)s) || websearch_to_tsquery('english', %(query)s) AS query
+                )
+                SELECT page.id, page.chat_id, page.sender_id, page.created_at, page.rank, u.username,
+                    ts_headline('russian', page.content, q.query, %(headline)s)
+                FROM (
+                    SELECT * FROM (
+                        SELECT m.id, m.chat_id, m.sender_id, m.content, m.created_at,
+                            ts_rank(m.search_vector, q.query) AS rank
+                        FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                        CROSS JOIN q
+                        WHERE m.search_vector @@ q.query AND {scope} {match_filter}
+                        {fence}
+                    ) matched
+                    WHERE {page_filter}
+                    ORDER BY {order_by}
+                    LIMIT %(limit)s
+                ) page
+                CROSS JOIN q
+                JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON u.id = page.sender_id
+                ORDER BY {page_order}""",
+            {
+                'query': query,
+                'headline': SEARCH_HEADLINE_OPTIONS,
+                'chat_id': chat_id,
+                'user_id': user_id,
+                'cursor_rank': cursor_rank,
+                'cursor_id': cursor_id,
+                'limit': limit + 1
+            }
+        )
+        rows = cur.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        results = []
+        for msg_id, msg_chat_id, sender_id, created_at, rank, sender_username, snippet in rows:
+            results.append({
+                'id': msg_id,
+                'chat_id': msg_chat_id,
+                'sender_id': sender_id,
+                'sender_username': sender_username,
+                'created_at': created_at.isoformat(),
+                'snippet': snippet,
+                'rank': rank,
                 'is_mine': sender_id == user_id
             })
         
-        return {
-            'statusCode': 200,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'messages': messages}),
-            'isBase64Encoded': False
-        }
+        return json_response({
+            'results': results,
+            'next_cursor': encode_search_cursor(rows[-1][4], rows[-1][0]) if has_more else None,
+            'has_more': has_more
+        })
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('POST', 'send_batch')
+def send_messages_batch(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    items = body.get('messages')
+    
+    if not isinstance(items, list) or not items:
+        return error_response(400, 'messages must be a non-empty list')
+    
+    if len(items) > MAX_BATCH_SIZE:
+        return error_response(400, f'At most {MAX_BATCH_SIZE} messages per batch')
+    
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        result = {'index': index, 'client_id': item.get('client_id')}
+        content = str(item.get('content') or '').strip()
+        try:
+            chat_id = int(item.get('chat_id'))
+        except (ValueError, TypeError):
+            chat_id = None
+        results[index] = result
+        if not chat_id or not content:
+            result.update({'success': False, 'error': 'chat_id and content are required'})
+        else:
+            pending.append((index, chat_id, content))
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        allowed = filter_participant_chats(cur, sorted({chat_id for _, chat_id, _ in pending}), user_id)
+        
+        rows = []
+        for index, chat_id, content in pending:
+            if chat_id in allowed:
+                rows.append((index, chat_id, content))
+            else:
+                results[index].update({'success': False, 'error': 'Not a participant of this chat'})
+        
+        if rows:
+            inserted = execute_values(
+                cur,
+                f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.messages (chat_id, sender_id, content) 
+                    VALUES %s RETURNING id, created_at""",
+                [(chat_id, user_id, content) for _, chat_id, content in rows],
+                page_size=len(rows),
+                fetch=True
+            )
+            
+            summaries = {}
+            for (index, chat_id, content), (message_id, created_at) in zip(rows, inserted):
+                last_id, last_at, added = summaries.get(chat_id, (0, None, 0))
+                if message_id > last_id:
+                    last_id, last_at = message_id, created_at
+                summaries[chat_id] = (last_id, last_at, added + 1)
+                results[index].update({
+                    'success': True,
+                    'message': {
+                        'id': message_id,
+                        'chat_id': chat_id,
+                        'sender_id': user_id,
+                        'content': content,
+                        'created_at': created_at.isoformat()
+                    }
+                })
+            
+            update_chat_summaries(cur, user_id, summaries)
+            
+            touch(cur, user_id)
+            
+            for chat_id, (message_id, _, _) in summaries.items():
+                cur.execute(
+                    "SELECT pg_notify(%s, %s)",
+                    (chat_channel(chat_id), json.dumps({'chat_id': chat_id, 'id': message_id, 'sender_id': user_id}))
+                )
+            
+            conn.commit()
+            note_write(cur, user_id)
+        
+        return json_response({
+            'success': all(result['success'] for result in results),
+            'sent': len(rows),
+            'results': results
+        })
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('POST', 'mark_read')
+def mark_read(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    
+    try:
+        chat_id = int(body.get('chat_id'))
+        up_to_message_id = int(body.get('up_to_message_id'))
+    except (ValueError, TypeError):
+        return error_response(400, 'chat_id and up_to_message_id are required')
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            f"""SELECT id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+                WHERE chat_id = %s AND user_id = %s
+                FOR UPDATE""",
+            (chat_id, user_id)
+        )
+        participant = cur.fetchone()
+        
+        if not participant:
+            return error_response(403, 'Not a participant of this chat')
+        
+        # Строка уже заблокирована, и UPDATE берёт свежий снимок: параллельная отправка, закоммиченная,
+        # пока мы ждали блокировку, попадает в пересчёт, а не затирается устаревшим COUNT(*)
+        cur.execute(
+            f"""UPDATE {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+                SET last_read_message_id = target.read_id,
+                    unread_count = (
+                        SELECT COUNT(*) FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                        WHERE m.chat_id = cp.chat_id AND m.id > target.read_id AND m.sender_id <> cp.user_id
+                    )
+                FROM (
+                    SELECT GREATEST(p.last_read_message_id, LEAST(%s, COALESCE(c.last_message_id, 0))) AS read_id
+                    FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants p
+                    JOIN {os.environ['MAIN_DB_SCHEMA']}.chats c ON c.id = p.chat_id
+                    WHERE p.id = %s
+                ) target
+                WHERE cp.id = %s
+                RETURNING cp.last_read_message_id, cp.unread_count""",
+            (up_to_message_id, participant[0], participant[0])
+        )
+        last_read_message_id, unread_count = cur.fetchone()
+        
+        touch(cur, user_id)
+        
+        cur.execute(
+            "SELECT pg_notify(%s, %s)",
+            (chat_channel(chat_id), json.dumps({'chat_id': chat_id, 'read_by': user_id, 'up_to': last_read_message_id}))
+        )
+        
+        conn.commit()
+        note_write(cur, user_id)
+        
+        return json_response({
+            'success': True,
+            'chat_id': chat_id,
+            'last_read_message_id': last_read_message_id,
+            'unread_count': unread_count
+        })
+    finally:
+        cur.close()
+        release_connection(conn)
+
+def update_chat_summaries(cur, sender_id: int, summaries: dict):
+    chat_ids = sorted(summaries)
+    cur.execute(
+        f"""WITH s AS (
+                SELECT * FROM unnest(%s::integer[], %s::bigint[], %s::timestamp[], %s::integer[])
+                    AS s(chat_id, last_id, last_at, added)
+            ), c AS (
+                UPDATE {os.environ['MAIN_DB_SCHEMA']}.chats ch
+                SET last_message_id = s.last_id, last_message_at = s.last_at
+                FROM s
+                WHERE ch.id = s.chat_id AND (ch.last_message_id IS NULL OR ch.last_message_id < s.last_id)
+            )
+            UPDATE {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+            SET unread_count = cp.unread_count + s.added
+            FROM s
+            WHERE cp.chat_id = s.chat_id AND cp.user_id <> %s""",
+        (
+            chat_ids,
+            [summaries[chat_id][0] for chat_id in chat_ids],
+            [summaries[chat_id][1] for chat_id in chat_ids],
+            [summaries[chat_id][2] for chat_id in chat_ids],
+            sender_id
+        )
+    )
+
+@handler.route('POST', 'sync')
+def sync_messages(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    
+    try:
+        known = decode_sync_token(body.get('sync_token')) if body.get('sync_token') else {}
+        cursors = body.get('cursors') or {}
+        if not isinstance(cursors, dict):
+            raise TypeError('cursors must be an object')
+        for chat_id, last_id in cursors.items():
+            known[int(chat_id)] = [int(last_id), None, None]
+        limit = max(1, min(int(body.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        wait = max(0.0, min(float(body.get('wait') or 0), MAX_WAIT_SECONDS))
+    except (ValueError, TypeError):
+        return error_response(400, 'Invalid sync_token, cursors, limit or wait')
+    
+    chat_ids = sorted(known) if body.get('cursors') and not body.get('sync_token') else None
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        touch(cur, user_id)
+        conn.commit()
+        
+        server_state = fetch_sync_state(cur, user_id, chat_ids)
+        
+        if wait and server_state and not has_sync_changes(known, server_state):
+            conn.rollback()
+            conn.autocommit = True
+            try:
+                cur.execute('; '.join(f'LISTEN {chat_channel(chat_id)}' for chat_id in server_state))
+                server_state = fetch_sync_state(cur, user_id, chat_ids)
+                if not has_sync_changes(known, server_state):
+                    with phase('wait'):
+                        wait_for_notify(conn, wait)
+                    server_state = fetch_sync_state(cur, user_id, chat_ids)
+            finally:
+                # Сбой UNLISTEN не должен подменять исходную ошибку, а соединение с оставшимися подписками — вернуться в пул:
+                # закрытое соединение release() не возьмёт в простой, а учтёт как сброс и освободит слот
+                try:
+                    cur.execute('UNLISTEN *')
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    conn.close()
+                conn.notifies.clear()
+        
+        etag = '"' + hashlib.sha1(
+            json.dumps([sorted(known.items()), sorted(server_state.items())]).encode()
+        ).hexdigest() + '"'
+        if request.headers.get('if-none-match') == etag:
+            return empty_response(304, {'Access-Control-Allow-Origin': '*', 'ETag': etag})
+        
+        since = {}
+        for chat_id, (last_id, _, _) in server_state.items():
+            known_last_id = known.get(chat_id, [0, None, None])[0]
+            if last_id > known_last_id:
+                since[chat_id] = known_last_id
+        
+        new_messages = {}
+        if since:
+            cur.execute(
+                f"""SELECT c.chat_id, m.id, m.sender_id, m.content, m.created_at, u.username
+                    FROM unnest(%s::integer[], %s::bigint[]) AS c(chat_id, since_id)
+                    CROSS JOIN LATERAL (
+                        SELECT id, sender_id, content, created_at
+                        FROM {os.environ['MAIN_DB_SCHEMA']}.messages
+                        WHERE chat_id = c.chat_id AND id > c.since_id
+                        ORDER BY id ASC
+                        LIMIT %s
+                    ) m
+                    JOIN {os.environ['MAIN_DB_SCHEMA']}.users u ON m.sender_id = u.id
+                    ORDER BY c.chat_id, m.id""",
+                (list(since), list(since.values()), limit + 1)
+            )
+            rows = cur.fetchall()
+            attachments = fetch_message_attachments(cur, [row[1] for row in rows])
+            for row in rows:
+                chat_id, msg_id, sender_id, content, created_at, sender_username = row
+                _, read_up_to, my_read_up_to = server_state[chat_id]
+                new_messages.setdefault(chat_id, []).append({
+                    'id': msg_id,
+                    'sender_id': sender_id,
+                    'sender_username': sender_username,
+                    'content': content,
+                    'created_at': created_at.isoformat(),
+                    'is_read': msg_id <= (read_up_to if sender_id == user_id else my_read_up_to),
+                    'is_mine': sender_id == user_id,
+                    'attachments': attachments.get(msg_id, [])
+                })
+        
+        chats = []
+        next_state = {}
+        for chat_id, (last_id, read_up_to, my_read_up_to) in sorted(server_state.items()):
+            known_last_id, known_read_up_to, known_my_read_up_to = known.get(chat_id, [0, None, None])
+            messages = new_messages.get(chat_id, [])
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            delivered_id = messages[-1]['id'] if messages else known_last_id
+            next_state[chat_id] = [
+                delivered_id if has_more else max(last_id, known_last_id), read_up_to, my_read_up_to
+            ]
+            
+            if messages or read_up_to != known_read_up_to or my_read_up_to != known_my_read_up_to:
+                chats.append({
+                    'chat_id': chat_id,
+                    'messages': messages,
+                    'has_more': has_more,
+                    'last_id': next_state[chat_id][0],
+                    'read_up_to': read_up_to,
+                    'my_read_up_to': my_read_up_to
+                })
+        
+        return json_response({
+            'changed': bool(chats),
+            'chats': chats,
+            'sync_token': encode_sync_token(next_state)
+        }, headers={'ETag': etag})
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+@handler.route('POST', 'start_upload')
+def start_attachment_upload(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    filename = str(body.get('filename') or '').strip()
+    content_type = str(body.get('content_type') or 'application/octet-stream').strip().lower()
+    sha256 = str(body['sha256']).lower() if body.get('sha256') else None
+    
+    try:
+        size = int(body.get('size'))
+    except (ValueError, TypeError):
+        return error_response(400, 'size must be an integer')
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        result = start_upload(cur, user_id, filename, content_type, size, sha256)
+        conn.commit()
+        note_write(cur, user_id)
+        return json_response(result)
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('POST', 'upload_chunk')
+def upload_attachment_chunk(request: Request) -> dict:
+    user_id, body = request.user_id, request.body
+    upload_id = str(body.get('upload_id') or '')
+    
+    try:
+        index = int(body.get('index'))
+        data = base64.b64decode(body.get('data') or '', validate=True)
+    except (ValueError, TypeError):
+        return error_response(400, 'index must be an integer and data must be base64')
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        result = store_chunk(cur, user_id, upload_id, index, data)
+        conn.commit()
+        return json_response(result)
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('POST', 'complete_upload')
+def complete_attachment_upload(request: Request) -> dict:
+    user_id = request.user_id
+    upload_id = str(request.body.get('upload_id') or '')
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        attachment = complete_upload(conn, user_id, upload_id)
+        note_write(cur, user_id)
+        return json_response({'upload_id': upload_id, 'attachment': attachment})
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('GET', 'upload')
+def get_upload(request: Request) -> dict:
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        return json_response(upload_status(cur, request.user_id, str(request.query.get('upload_id') or '')))
+    finally:
+        cur.close()
+        release_connection(conn)
+
+@handler.route('GET', 'attachment')
+def get_attachment(request: Request) -> dict:
+    user_id, query_params = request.user_id, request.query
+    thumbnail = query_params.get('thumbnail') in ('1', 'true')
+    
+    try:
+        attachment_id = int(query_params.get('id') or '')
+    except ValueError:
+        return error_response(400, 'id must be an integer')
+    
+    conn = get_read_connection(user_id)
+    cur = conn.cursor()
+    
+    try:
+        try:
+            blob = find_attachment_blob(cur, user_id, attachment_id, thumbnail)
+        except ApiError as e:
+            if e.status != 404 or not conn.replica:
+                raise
+            # Вложение из только что пришедшего сообщения могло ещё не доехать до реплики
+            conn, cur = switch_to_primary(conn, cur)
+            blob = find_attachment_blob(cur, user_id, attachment_id, thumbnail)
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    # Содержимое адресуется хешем и не меняется: ETag — это сам SHA-256, кэшировать можно бессрочно
+    headers = {
+        'ETag': f'"{blob["sha256"]}"',
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+        'Access-Control-Expose-Headers': 'ETag, Content-Range, Accept-Ranges',
+        'X-Content-Type-Options': 'nosniff'
+    }
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return empty_response(304, {'Access-Control-Allow-Origin': '*', **headers})
+    
+    start, end, partial = parse_range(request.headers.get('range'), blob['size'])
+    with phase('blob'):
+        data = read_blob(blob['sha256'], start, end)
+    
+    # Тип задаёт загрузивший клиент: в браузере открываются только медиа, остальное скачивается файлом
+    if inline_content_type(blob['content_type']):
+        headers['Content-Type'] = blob['content_type']
+        headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(blob['filename'])}"
+    else:
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(blob['filename'])}"
+    if partial:
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{blob["size"]}'
+        return binary_response(data, 206, headers)
+    return binary_response(data, 200, headers)
+
+def fetch_sync_state(cur, user_id: int, chat_ids) -> dict:
+    cur.execute(
+        f"""SELECT cp.chat_id,
+                COALESCE(c.last_message_id, 0),
+                COALESCE((SELECT MAX(o.last_read_message_id) FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants o
+                          WHERE o.chat_id = cp.chat_id AND o.user_id <> cp.user_id), 0),
+                cp.last_read_message_id
+            FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+            JOIN {os.environ['MAIN_DB_SCHEMA']}.chats c ON c.id = cp.chat_id
+            WHERE cp.user_id = %s AND (%s::integer[] IS NULL OR cp.chat_id = ANY(%s::integer[]))""",
+        (user_id, chat_ids, chat_ids)
+    )
+    return {chat_id: [last_id, read_up_to, my_read_up_to] for chat_id, last_id, read_up_to, my_read_up_to in cur.fetchall()}
+
+def has_sync_changes(known: dict, server_state: dict) -> bool:
+    for chat_id, (last_id, read_up_to, my_read_up_to) in server_state.items():
+        if chat_id not in known:
+            return True
+        known_last_id, known_read_up_to, known_my_read_up_to = known[chat_id]
+        if last_id > known_last_id:
+            return True
+        # Курсор из cursors не знает состояния прочтения: сравниваем его, только когда оно пришло в sync_token
+        if known_read_up_to is not None and read_up_to != known_read_up_to:
+            return True
+        if known_my_read_up_to is not None and my_read_up_to != known_my_read_up_to:
+            return True
+    return False
+
+def chat_channel(chat_id) -> str:
+    return f'chat_{int(chat_id)}'
+
+def wait_for_notify(conn, timeout: float) -> list:
+    deadline = time.monotonic() + timeout
+    while True:
+        conn.poll()
+        if conn.notifies:
+            notifies = list(conn.notifies)
+            conn.notifies.clear()
+            return notifies
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return []
+        select.select([conn], [], [], remaining)
+
+def encode_sync_token(state: dict) -> str:
+    raw = json.dumps({str(chat_id): value for chat_id, value in state.items()}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_sync_token(token: str) -> dict:
+    raw = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    if not isinstance(raw, dict):
+        raise ValueError('sync_token must encode an object')
+    state = {}
+    for chat_id, value in raw.items():
+        value = list(value) + [None] * (3 - len(value))
+        state[int(chat_id)] = [int(value[0]), value[1], value[2]]
+    return state
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    raw = json.dumps([rank, message_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_search_cursor(token: str) -> tuple:
+    rank, message_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    return float(rank), int(message_id)
@@ -0,0 +1,183 @@
+"""
+Кэш членства в чатах (chat_id, user_id) с LRU-вытеснением, TTL и инвалидацией через NOTIFY
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+MEMBERSHIP_CHANNEL = 'chat_membership'
+RECONNECT_BACKOFF_MIN = 1.0
+RECONNECT_BACKOFF_MAX = 30.0
+
+
+class MembershipCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0, negative_ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._by_chat = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, chat_id: int, user_id: int, is_member: bool):
+        key = (chat_id, user_id)
+        expires_at = time.monotonic() + (self.ttl if is_member else self.negative_ttl)
+        with self._lock:
+            self._entries[key] = (is_member, expires_at)
+            self._entries.move_to_end(key)
+            self._by_chat.setdefault(chat_id, set()).add(user_id)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, chat_id: int, user_ids=None):
+        with self._lock:
+            cached = self._by_chat.get(chat_id, set())
+            targets = list(cached) if user_ids is None else [u for u in user_ids if u in cached]
+            for user_id in targets:
+                self._remove((chat_id, user_id))
+            self._stats['invalidations'] += len(targets)
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._by_chat.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['max_size'] = self.max_size
+        return stats
+
+    def _remove(self, key: tuple):
+        self._entries.pop(key, None)
+        chat_id, user_id = key
+        users = self._by_chat.get(chat_id)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._by_chat[chat_id]
+
+
+class InvalidationListener:
+    def __init__(self, dsn: str, cache: MembershipCache):
+        self.dsn = dsn
+        self.cache = cache
+        self._conn = None
+        self._lock = threading.Lock()
+        self._retry_at = 0.0
+        self._backoff = RECONNECT_BACKOFF_MIN
+
+    def drain(self) -> bool:
+        # poll() лишь читает уже пришедшие в сокет уведомления, запроса к базе здесь нет.
+        # False — подписки нет, и кэшу нельзя верить: инвалидации могут теряться
+        with self._lock:
+            if self._conn is None and time.monotonic() < self._retry_at:
+                return False
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._connect()
+                self._conn.poll()
+                notifies = list(self._conn.notifies)
+                self._conn.notifies.clear()
+            except psycopg2.Error:
+                self._drop()
+                self.cache.clear()
+                # Пока LISTEN недоступен, не переподключаемся на каждом запросе: пауза растёт вдвое до потолка
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, RECONNECT_BACKOFF_MAX)
+                return False
+            self._backoff = RECONNECT_BACKOFF_MIN
+        for notify in notifies:
+            try:
+                payload = json.loads(notify.payload)
+                self.cache.invalidate(int(payload['chat_id']), payload.get('user_ids'))
+            except (ValueError, KeyError, TypeError):
+                self.cache.clear()
+        return True
+
+    def _connect(self):
+        self._conn = psycopg2.connect(self.dsn)
+        self._conn.autocommit = True
+        cur = self._conn.cursor()
+        try:
+            cur.execute(f'LISTEN {MEMBERSHIP_CHANNEL}')
+        finally:
+            cur.close()
+        # Пока соединения не было, инвалидации могли потеряться
+        self.cache.clear()
+
+    def _drop(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+
+_cache = MembershipCache(
+    max_size=int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('MEMBERSHIP_CACHE_TTL', '300')),
+    negative_ttl=float(os.environ.get('MEMBERSHIP_CACHE_NEGATIVE_TTL', '5'))
+)
+_listener = None
+
+def _get_listener() -> InvalidationListener:
+    global _listener
+    if _listener is None:
+        _listener = InvalidationListener(os.environ['DATABASE_URL'], _cache)
+    return _listener
+
+def filter_participant_chats(cur, chat_ids, user_id: int, cache_negative: bool = True) -> set:
+    trusted = _get_listener().drain()
+
+    allowed = set()
+    missing = []
+    for chat_id in chat_ids:
+        cached = _cache.get(chat_id, user_id) if trusted else None
+        if cached is None:
+            missing.append(chat_id)
+        elif cached:
+            allowed.add(chat_id)
+
+    if missing:
+        cur.execute(
+            f"""SELECT chat_id FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+                WHERE user_id = %s AND chat_id = ANY(%s::integer[])""",
+            (user_id, missing)
+        )
+        found = {row[0] for row in cur.fetchall()}
+        for chat_id in missing:
+            if trusted and (cache_negative or chat_id in found):
+                _cache.put(chat_id, user_id, chat_id in found)
+        allowed |= found
+
+    return allowed
+
+def is_participant(cur, chat_id: int, user_id: int, cache_negative: bool = True) -> bool:
+    return chat_id in filter_participant_chats(cur, [chat_id], user_id, cache_negative)
+
+def membership_stats() -> dict:
+    return _cache.stats()
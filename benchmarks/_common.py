@@ -0,0 +1,89 @@
+"""
+Общие помощники бенчмарков: загрузка функций, события, токены и тестовые данные.
+Требуются DATABASE_URL, MAIN_DB_SCHEMA и JWT_SECRET, как у задеплоенных функций.
+"""
+import importlib.util
+import json
+import math
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+
+# Строка лога на каждый вызов смешалась бы с JSON-отчётом бенчмарка
+os.environ.setdefault('INSTRUMENT_LOG', 'off')
+
+def load_function(name: str):
+    path = os.path.join(BACKEND, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(f'{name}_index', os.path.join(path, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def schema() -> str:
+    return os.environ['MAIN_DB_SCHEMA']
+
+def make_token(user_id: int, phone: str = '') -> str:
+    return jwt.encode(
+        {'user_id': user_id, 'phone': phone, 'exp': datetime.utcnow() + timedelta(days=1)},
+        os.environ.get('JWT_SECRET', 'default-secret-key'),
+        algorithm='HS256'
+    )
+
+def make_event(method: str, token: str = None, body: dict = None, query: dict = None) -> dict:
+    return {
+        'httpMethod': method,
+        'headers': {'authorization': f'Bearer {token}'} if token else {},
+        'queryStringParameters': query or {},
+        'body': json.dumps(body) if body is not None else ''
+    }
+
+def seed_users(cur, count: int) -> list:
+    prefix = uuid.uuid4().hex[:6]
+    cur.execute(
+        f"""INSERT INTO {schema()}.users (phone, username)
+            SELECT '+7' || %s || lpad(g::text, 8, '0'), 'bench_' || %s || '_' || g
+            FROM generate_series(1, %s) g
+            RETURNING id""",
+        (str(int(prefix, 16)), prefix, count)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def seed_chat(cur, user_ids: list) -> int:
+    cur.execute(f"INSERT INTO {schema()}.chats DEFAULT VALUES RETURNING id")
+    chat_id = cur.fetchone()[0]
+    for user_id in user_ids:
+        cur.execute(
+            f"INSERT INTO {schema()}.chat_participants (chat_id, user_id) VALUES (%s, %s)",
+            (chat_id, user_id)
+        )
+    return chat_id
+
+def timed(fn, *args) -> tuple:
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def latency_summary(seconds: list) -> dict:
+    return {
+        'count': len(seconds),
+        'p50_ms': round(percentile(seconds, 50) * 1000, 3),
+        'p95_ms': round(percentile(seconds, 95) * 1000, 3),
+        'p99_ms': round(percentile(seconds, 99) * 1000, 3),
+        'max_ms': round(max(seconds) * 1000, 3) if seconds else 0.0
+    }
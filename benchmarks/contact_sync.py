@@ -0,0 +1,64 @@
+"""
+Сравнение синхронизации адресной книги: N вызовов add_contact против одного sync_contacts.
+Каждый режим работает со своим набором пользователей, поэтому оба создают одинаковое число чатов.
+
+    python benchmarks/contact_sync.py --count 2000
+"""
+import argparse
+import json
+
+from _common import load_function, make_event, make_token, schema, seed_users, timed
+
+def seed_phones(cur, count: int) -> list:
+    ids = seed_users(cur, count)
+    cur.execute(f'SELECT phone FROM {schema()}.users WHERE id = ANY(%s) ORDER BY id', (ids,))
+    return [row[0] for row in cur.fetchall()]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    contacts = load_function('contacts')
+    import db
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+    owner_id = seed_users(cur, 1)[0]
+    single_phones = seed_phones(cur, args.count)
+    bulk_phones = seed_phones(cur, args.count)
+    conn.commit()
+    cur.close()
+    db.release_connection(conn)
+
+    token = make_token(owner_id)
+
+    def single_adds():
+        for phone in single_phones:
+            response = contacts.handler(make_event('POST', token, {'phone': phone}), None)
+            assert response['statusCode'] == 200, response
+
+    def bulk_sync():
+        for start in range(0, args.count, contacts.MAX_SYNC_CONTACTS):
+            response = contacts.handler(make_event('POST', token, {
+                'action': 'sync_contacts',
+                'phones': bulk_phones[start:start + contacts.MAX_SYNC_CONTACTS]
+            }), None)
+            assert response['statusCode'] == 200, response
+
+    _, single_s = timed(single_adds)
+    _, bulk_s = timed(bulk_sync)
+
+    print(json.dumps({
+        'benchmark': 'contact_sync',
+        'count': args.count,
+        'single_seconds': round(single_s, 4),
+        'bulk_seconds': round(bulk_s, 4),
+        'single_contacts_per_s': round(args.count / single_s, 1),
+        'bulk_contacts_per_s': round(args.count / bulk_s, 1),
+        'speedup': round(single_s / bulk_s, 2),
+        'pool': db.pool_stats()
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Локальная заглушка SMS-шлюза в формате smsc.ru (fmt=3) для проверки очереди SMS и нагрузочных сценариев.
+
+    python benchmarks/fake_sms_gateway.py --port 8025 --fail-rate 0.2 --delay 0.05
+    SMS_GATEWAY_URL=http://127.0.0.1:8025/sys/send.php
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeGateway(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fail_rate: float = 0.0, delay: float = 0.0):
+        super().__init__(address, GatewayHandler)
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.sent = []
+        self.lock = threading.Lock()
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        time.sleep(self.server.delay)
+
+        if random.random() < self.server.fail_rate:
+            payload = {'error': 'temporary failure', 'error_code': 9}
+        else:
+            with self.server.lock:
+                self.server.sent.append((form.get('phones'), form.get('mes')))
+                payload = {'id': len(self.server.sent), 'cnt': 1}
+
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_gateway(port: int = 0, fail_rate: float = 0.0, delay: float = 0.0) -> FakeGateway:
+    server = FakeGateway(('127.0.0.1', port), fail_rate, delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeGateway(('127.0.0.1', args.port), args.fail_rate, args.delay)
+    print(f'Fake SMS gateway on http://127.0.0.1:{args.port}/sys/send.php')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
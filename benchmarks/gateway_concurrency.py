@@ -0,0 +1,138 @@
+"""
+Сколько одновременных long-poll клиентов держит шлюз и как быстро до них доходят сообщения.
+N клиентов ждут sync с wait, затем собеседник пишет в каждый чат; меряется задержка доставки,
+число соединений из пула и потоков. ASGI-приложение вызывается в процессе, без HTTP-сервера.
+
+    python benchmarks/gateway_concurrency.py --clients 2000 --wait 20
+    python benchmarks/gateway_concurrency.py --clients 200 --mode direct   # sync(wait) в потоке на клиента, как в функции
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import ROOT, latency_summary, make_event, make_token, seed_chat, seed_users
+
+sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+
+
+async def asgi_request(app, method: str, path: str, token: str = None, body: dict = None) -> tuple:
+    headers = [(b'content-type', b'application/json')]
+    if token:
+        headers.append((b'authorization', f'Bearer {token}'.encode()))
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+        'headers': headers, 'client': ('127.0.0.1', 0)
+    }
+    payload = json.dumps(body).encode() if body is not None else b''
+    messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    response = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        else:
+            response['body'] = message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], json.loads(response['body']) if response.get('body') else {}
+
+async def run(args) -> dict:
+    from app import app
+    import db
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+    try:
+        user_ids = seed_users(cur, args.clients * 2)
+        chats = []
+        for index in range(args.clients):
+            reader_id, writer_id = user_ids[index * 2], user_ids[index * 2 + 1]
+            chats.append((reader_id, writer_id, seed_chat(cur, [reader_id, writer_id])))
+        conn.commit()
+    finally:
+        cur.close()
+        db.release_connection(conn)
+
+    loop = asyncio.get_running_loop()
+    direct = ThreadPoolExecutor(max_workers=args.clients) if args.mode == 'direct' else None
+    sent_at, latencies, outcomes = {}, [], {'delivered': 0, 'empty': 0, 'errors': 0}
+    ready = 0
+    peak_threads = threading.active_count()
+
+    async def client(reader_id, chat_id):
+        nonlocal ready, peak_threads
+        token = make_token(reader_id)
+        status, state = await asgi_request(app, 'POST', '/messages', token, {'action': 'sync', 'cursors': {str(chat_id): 0}})
+        body = {'action': 'sync', 'sync_token': state.get('sync_token'), 'wait': args.wait}
+        ready += 1
+        if args.mode == 'gateway':
+            status, result = await asgi_request(app, 'POST', '/messages', token, body)
+        else:
+            response = await loop.run_in_executor(direct, app.functions['messages'].handler, make_event('POST', token, body), None)
+            status, result = response['statusCode'], json.loads(response['body'] or '{}')
+        received = time.perf_counter()
+        peak_threads = max(peak_threads, threading.active_count())
+        if status != 200:
+            outcomes['errors'] += 1
+        elif result.get('changed') and chat_id in sent_at:
+            outcomes['delivered'] += 1
+            latencies.append(received - sent_at[chat_id])
+        else:
+            outcomes['empty'] += 1
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(client(reader_id, chat_id)) for reader_id, _, chat_id in chats]
+    while ready < args.clients:
+        await asyncio.sleep(0.05)
+    # Даём последним клиентам дойти до ожидания, прежде чем писать
+    await asyncio.sleep(args.settle)
+    subscribed_seconds = time.perf_counter() - started
+
+    async def writer(index, writer_id, chat_id):
+        # Сообщения идут с заданной частотой: задержка доставки не должна тонуть в очереди одного залпа
+        await asyncio.sleep(index / args.rate)
+        sent_at[chat_id] = time.perf_counter()
+        await asgi_request(app, 'POST', '/messages', make_token(writer_id), {'chat_id': chat_id, 'content': 'ping'})
+
+    await asyncio.gather(*(writer(index, writer_id, chat_id) for index, (_, writer_id, chat_id) in enumerate(chats)))
+    await asyncio.gather(*tasks)
+    if direct is not None:
+        direct.shutdown(wait=False)
+
+    return {
+        'benchmark': 'gateway_concurrency',
+        'mode': args.mode,
+        'clients': args.clients,
+        'wait_seconds': args.wait,
+        'send_rate': args.rate,
+        'subscribe_seconds': round(subscribed_seconds, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+        'outcomes': outcomes,
+        'delivery': latency_summary(latencies) if latencies else None,
+        'peak_threads': peak_threads,
+        'pool': db.pool_stats(),
+        'notify': app.hub.stats() if app.hub is not None else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--wait', type=float, default=20)
+    parser.add_argument('--settle', type=float, default=1.0)
+    parser.add_argument('--rate', type=float, default=200, help='сообщений в секунду')
+    parser.add_argument('--mode', choices=('gateway', 'direct'), default='gateway')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == '__main__':
+    main()
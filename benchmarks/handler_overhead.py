@@ -0,0 +1,98 @@
+"""
+Накладные расходы обработчика без базы данных: маршрутизация, проверка токена и сериализация
+типичного ответа get_messages на 1000 сообщений, с orjson и со стандартным json.
+
+    python benchmarks/handler_overhead.py --messages 1000 --iterations 300
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from _common import load_function, make_event, make_token
+
+def legacy_response(user_id: int, rows: list) -> dict:
+    messages = []
+    for msg_id, sender_id, content, created_at, sender_username, is_read in rows:
+        messages.append({
+            'id': msg_id,
+            'sender_id': sender_id,
+            'sender_username': sender_username,
+            'content': content,
+            'created_at': created_at.isoformat(),
+            'is_read': is_read,
+            'is_mine': sender_id == user_id
+        })
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': json.dumps({'messages': messages, 'next_cursor': None, 'has_more': False}),
+        'isBase64Encoded': False
+    }
+
+def per_call_us(fn, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=300)
+    args = parser.parse_args()
+
+    os.environ.setdefault('JWT_SECRET', 'benchmark-secret-key-with-32-bytes!')
+    load_function('messages')
+    import api
+
+    base = datetime(2024, 1, 1)
+    rows = [
+        (i, 1 + i % 2, f'Сообщение номер {i}: привет, как дела?', base + timedelta(seconds=i), f'user{1 + i % 2}', i % 3 == 0)
+        for i in range(1, args.messages + 1)
+    ]
+
+    router = api.Router('bench')
+
+    @router.route('GET')
+    def history(request):
+        messages = []
+        for msg_id, sender_id, content, created_at, sender_username, is_read in rows:
+            messages.append({
+                'id': msg_id,
+                'sender_id': sender_id,
+                'sender_username': sender_username,
+                'content': content,
+                'created_at': created_at.isoformat(),
+                'is_read': is_read,
+                'is_mine': sender_id == request.user_id
+            })
+        return api.json_response({'messages': messages, 'next_cursor': None, 'has_more': False})
+
+    token = make_token(1)
+    event = make_event('GET', token, query={'chat_id': '1'})
+
+    def legacy():
+        payload = api.verify_token(token)
+        return legacy_response(payload['user_id'], rows)
+
+    results = {'legacy_stdlib_us': per_call_us(legacy, args.iterations)}
+
+    results['router_' + api.JSON_BACKEND + '_us'] = per_call_us(lambda: router(event, None), args.iterations)
+    if api.JSON_BACKEND != 'json':
+        fast_dumps = api.dumps
+        api.dumps = json.dumps
+        results['router_json_us'] = per_call_us(lambda: router(event, None), args.iterations)
+        api.dumps = fast_dumps
+
+    print(json.dumps({
+        'benchmark': 'handler_overhead',
+        'messages': args.messages,
+        'iterations': args.iterations,
+        'json_backend': api.JSON_BACKEND,
+        'per_call_us': {name: round(value, 1) for name, value in results.items()}
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
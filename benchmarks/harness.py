@@ -0,0 +1,348 @@
+"""
+Нагрузочные сценарии для трёх функций: обработчики вызываются напрямую синтетическими событиями
+против локального PostgreSQL. Для каждого шага — p50/p95/p99, пропускная способность и число
+запросов к базе на вызов; результат пишется в JSON, который можно сравнить с прошлым прогоном.
+
+    python benchmarks/harness.py --reset-schema            # пересоздать MAIN_DB_SCHEMA из db_migrations (удаляет данные!)
+    python benchmarks/harness.py --scenarios login_storm,send_burst --concurrency 4 --output after.json
+    python benchmarks/harness.py --output after.json --compare before.json --tolerance 0.2
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+from _common import ROOT, latency_summary, load_function, make_event, make_token, schema, seed_chat, seed_users
+
+_queries = threading.local()
+
+
+def counting_cursor(base):
+    class CountingCursor(base):
+        counting = True
+
+        def execute(self, query, vars=None):
+            _queries.count = getattr(_queries, 'count', 0) + 1
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            _queries.count = getattr(_queries, 'count', 0) + 1
+            return super().executemany(query, vars_list)
+
+    return CountingCursor
+
+
+def install_query_counter(db):
+    pool = db.get_pool()
+    acquire = pool.acquire
+    factories = {}
+
+    def counted_acquire():
+        conn = acquire()
+        # Считающий курсор наследует фабрику соединения, чтобы не отключать инструментирование
+        base = conn.cursor_factory or psycopg2.extensions.cursor
+        if not getattr(base, 'counting', False):
+            if base not in factories:
+                factories[base] = counting_cursor(base)
+            conn.cursor_factory = factories[base]
+        return conn
+
+    pool.acquire = counted_acquire
+
+def reset_schema():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(f'DROP SCHEMA IF EXISTS {schema()} CASCADE')
+        cur.execute(f'CREATE SCHEMA {schema()}')
+        cur.execute(f'SET search_path TO {schema()}, public')
+        for path in sorted(glob.glob(os.path.join(ROOT, 'db_migrations', 'V*.sql'))):
+            with open(path, encoding='utf-8') as f:
+                cur.execute(f.read())
+            print(f'applied {os.path.basename(path)}', file=sys.stderr)
+    finally:
+        cur.close()
+        conn.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def call(self, label: str, function, event: dict, expect=(200,)) -> dict:
+        _queries.count = 0
+        started = time.perf_counter()
+        response = function.handler(event, None)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples[label].append(elapsed)
+            self.queries[label].append(_queries.count)
+            self.statuses[label][response['statusCode']] += 1
+            if response['statusCode'] not in expect and len(self.errors) < 20:
+                self.errors.append({'label': label, 'status': response['statusCode'], 'body': response['body'][:200]})
+        return response
+
+    def report(self, wall_seconds: float) -> dict:
+        total = sum(len(samples) for samples in self.samples.values())
+        steps = {}
+        for label, samples in self.samples.items():
+            queries = self.queries[label]
+            steps[label] = {
+                **latency_summary(samples),
+                'queries_per_request': round(sum(queries) / len(queries), 2),
+                'max_queries': max(queries),
+                'statuses': dict(self.statuses[label])
+            }
+        return {
+            'requests': total,
+            'wall_seconds': round(wall_seconds, 3),
+            'throughput_rps': round(total / wall_seconds, 1) if wall_seconds else 0.0,
+            'steps': steps,
+            'errors': self.errors
+        }
+
+
+def with_source_ip(event: dict, ip: str) -> dict:
+    event['requestContext'] = {'identity': {'sourceIp': ip}}
+    return event
+
+def body_of(response: dict) -> dict:
+    return json.loads(response['body']) if response['body'] else {}
+
+
+def login_storm(functions, cur, size: int) -> list:
+    auth = functions['auth']
+    prefix = str(int(uuid.uuid4().hex[:6], 16))
+
+    def job(index):
+        def run(recorder):
+            phone = f'+7{prefix}{index:06d}'
+            ip = f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'
+            sent = recorder.call('auth.send_code', auth, with_source_ip(
+                make_event('POST', body={'action': 'send_code', 'phone': phone}), ip
+            ))
+            code = body_of(sent).get('debug_code')
+            if code:
+                recorder.call('auth.verify_code', auth, with_source_ip(
+                    make_event('POST', body={'action': 'verify_code', 'phone': phone, 'code': code, 'username': f'storm{index}'}), ip
+                ))
+        return run
+
+    return [job(index) for index in range(size)]
+
+def chat_history(functions, cur, size: int, messages_per_chat: int = 500) -> list:
+    messages, contacts = functions['messages'], functions['contacts']
+    user_ids = seed_users(cur, size * 2)
+    chats = []
+    for index in range(size):
+        owner_id, peer_id = user_ids[index * 2], user_ids[index * 2 + 1]
+        chats.append((owner_id, seed_chat(cur, [owner_id, peer_id]), peer_id))
+    cur.execute(
+        f"""INSERT INTO {schema()}.messages (chat_id, sender_id, content)
+            SELECT c.chat_id, CASE WHEN g %% 2 = 0 THEN c.owner_id ELSE c.peer_id END,
+                'Сообщение ' || g || ': как дела, что нового?'
+            FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS c(owner_id, chat_id, peer_id)
+            CROSS JOIN generate_series(1, %s) g""",
+        ([c[0] for c in chats], [c[1] for c in chats], [c[2] for c in chats], messages_per_chat)
+    )
+    cur.execute(
+        f"""UPDATE {schema()}.chats ch
+            SET last_message_id = m.last_id, last_message_at = m.last_at
+            FROM (
+                SELECT chat_id, MAX(id) AS last_id, MAX(created_at) AS last_at
+                FROM {schema()}.messages WHERE chat_id = ANY(%s::integer[])
+                GROUP BY chat_id
+            ) m
+            WHERE ch.id = m.chat_id""",
+        ([c[1] for c in chats],)
+    )
+
+    def job(owner_id, chat_id):
+        def run(recorder):
+            token = make_token(owner_id)
+            recorder.call('contacts.chat_list', contacts, make_event('GET', token, query={'view': 'chats'}))
+            page = body_of(recorder.call('messages.history_first_page', messages, make_event(
+                'GET', token, query={'chat_id': str(chat_id)}
+            )))
+            for _ in range(2):
+                if not page.get('next_cursor'):
+                    break
+                page = body_of(recorder.call('messages.history_older_page', messages, make_event(
+                    'GET', token, query={'chat_id': str(chat_id), 'before_id': str(page['next_cursor'])}
+                )))
+        return run
+
+    return [job(owner_id, chat_id) for owner_id, chat_id, _ in chats]
+
+def send_burst(functions, cur, size: int, burst: int = 10) -> list:
+    messages = functions['messages']
+    user_ids = seed_users(cur, size * 2)
+    pairs = []
+    for index in range(size):
+        sender_id, peer_id = user_ids[index * 2], user_ids[index * 2 + 1]
+        pairs.append((sender_id, peer_id, seed_chat(cur, [sender_id, peer_id])))
+
+    def job(sender_id, peer_id, chat_id):
+        def run(recorder):
+            token = make_token(sender_id)
+            last_id = None
+            for number in range(burst):
+                sent = body_of(recorder.call('messages.send_message', messages, make_event(
+                    'POST', token, {'chat_id': chat_id, 'content': f'burst {number}'}
+                )))
+                last_id = (sent.get('message') or {}).get('id', last_id)
+            peer_token = make_token(peer_id)
+            recorder.call('messages.sync', messages, make_event(
+                'POST', peer_token, {'action': 'sync', 'cursors': {str(chat_id): 0}}
+            ))
+            if last_id:
+                recorder.call('messages.mark_read', messages, make_event(
+                    'POST', peer_token, {'action': 'mark_read', 'chat_id': chat_id, 'up_to_message_id': last_id}
+                ))
+        return run
+
+    return [job(*pair) for pair in pairs]
+
+def contact_sync(functions, cur, size: int, book_size: int = 1000) -> list:
+    contacts = functions['contacts']
+    directory = seed_users(cur, max(book_size * 2, 2000))
+    cur.execute(f'SELECT phone FROM {schema()}.users WHERE id = ANY(%s) ORDER BY id', (directory,))
+    phones = [row[0] for row in cur.fetchall()]
+    owners = seed_users(cur, size)
+
+    def job(index, owner_id):
+        def run(recorder):
+            token = make_token(owner_id)
+            # Половина книги — зарегистрированные пользователи, половина — чужие номера
+            start = index * 37 % (len(phones) - book_size // 2)
+            book = phones[start:start + book_size // 2] + [f'+7000{index:04d}{n:04d}' for n in range(book_size // 2)]
+            recorder.call('contacts.sync_contacts', contacts, make_event(
+                'POST', token, {'action': 'sync_contacts', 'phones': book}
+            ))
+            recorder.call('contacts.get_contacts', contacts, make_event('GET', token))
+        return run
+
+    return [job(index, owner_id) for index, owner_id in enumerate(owners)]
+
+
+SCENARIOS = {
+    'login_storm': login_storm,
+    'chat_history': chat_history,
+    'send_burst': send_burst,
+    'contact_sync': contact_sync
+}
+
+def run_scenario(name: str, functions, db, size: int, concurrency: int, warmup: int) -> dict:
+    conn = db.get_connection()
+    cur = conn.cursor()
+    try:
+        jobs = SCENARIOS[name](functions, cur, size + warmup)
+        conn.commit()
+    finally:
+        cur.close()
+        db.release_connection(conn)
+
+    for job in jobs[:warmup]:
+        job(Recorder())
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(job, recorder) for job in jobs[warmup:]]:
+            future.result()
+    return recorder.report(time.perf_counter() - started)
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, scenario in current['scenarios'].items():
+        for label, step in scenario['steps'].items():
+            before = baseline.get('scenarios', {}).get(name, {}).get('steps', {}).get(label)
+            if before is None:
+                continue
+            # Порог в 1 мс отсекает шум на быстрых шагах
+            if step['p95_ms'] > before['p95_ms'] * (1 + tolerance) and step['p95_ms'] - before['p95_ms'] > 1:
+                regressions.append(f"{name}/{label}: p95 {before['p95_ms']} -> {step['p95_ms']} ms")
+            if step['queries_per_request'] > before['queries_per_request']:
+                regressions.append(
+                    f"{name}/{label}: queries/request {before['queries_per_request']} -> {step['queries_per_request']}"
+                )
+    return regressions
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--size', type=int, default=100, help='число пользовательских сессий на сценарий')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--reset-schema', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    if args.reset_schema:
+        reset_schema()
+
+    # Пул делится между функциями, поэтому даём ему столько соединений, сколько потоков
+    os.environ.setdefault('DB_POOL_MAX', str(max(5, args.concurrency + 2)))
+    functions = {name: load_function(name) for name in ('auth', 'contacts', 'messages')}
+    import db
+    install_query_counter(db)
+
+    results = {
+        'benchmark': 'harness',
+        'revision': git_revision(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': {'size': args.size, 'concurrency': args.concurrency, 'warmup': args.warmup},
+        'scenarios': {}
+    }
+    for name in names:
+        results['scenarios'][name] = run_scenario(name, functions, db, args.size, args.concurrency, args.warmup)
+        print(f'{name}: done', file=sys.stderr)
+    results['pool'] = db.pool_stats()
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
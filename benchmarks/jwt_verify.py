@@ -0,0 +1,54 @@
+"""
+Микробенчмарк проверки JWT на одном ядре: jwt.decode на каждый запрос против tokens.verify_token.
+База данных не нужна.
+
+    python benchmarks/jwt_verify.py --seconds 2 --tokens 100
+"""
+import argparse
+import json
+import os
+import time
+
+import jwt
+
+from _common import load_function, make_token
+
+def rate(fn, tokens: list, seconds: float) -> float:
+    calls = 0
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for token in tokens:
+            fn(token)
+        calls += len(tokens)
+    return calls / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--tokens', type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ.setdefault('JWT_SECRET', 'benchmark-secret-key-with-32-bytes!')
+    load_function('messages')
+    import tokens
+
+    sample = [make_token(user_id) for user_id in range(1, args.tokens + 1)]
+
+    def baseline(token):
+        return jwt.decode(token, os.environ.get('JWT_SECRET', 'default-secret-key'), algorithms=['HS256'])
+
+    before = rate(baseline, sample, args.seconds)
+    after = rate(tokens.verify_token, sample, args.seconds)
+
+    print(json.dumps({
+        'benchmark': 'jwt_verify',
+        'distinct_tokens': args.tokens,
+        'jwt_decode_per_s': round(before),
+        'verify_token_per_s': round(after),
+        'speedup': round(after / before, 2),
+        'cache': tokens.token_cache_stats()
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Бенчмарк полнотекстового поиска по сообщениям на синтетическом корпусе.
+
+    python benchmarks/message_search.py --messages 2000000 --chats 20000 --queries 200
+    python benchmarks/message_search.py --skip-seed --queries 200   # повторный прогон на тех же данных
+"""
+import argparse
+import json
+import random
+import time
+
+from _common import latency_summary, load_function, make_event, make_token, schema, seed_users
+
+WORDS = [
+    'привет', 'проект', 'встреча', 'завтра', 'сегодня', 'отчёт', 'документ', 'задача', 'срок', 'клиент',
+    'договор', 'оплата', 'счёт', 'релиз', 'сервер', 'ошибка', 'тест', 'обед', 'дом', 'машина',
+    'поездка', 'билет', 'погода', 'звонок', 'письмо', 'фото', 'видео', 'музыка', 'книга', 'фильм',
+    'meeting', 'deploy', 'review', 'deadline', 'invoice', 'release', 'server', 'bug', 'ticket', 'design'
+]
+RARE_WORDS = ['гиперкуб', 'квазар', 'palimpsest', 'zeitgeist']
+
+def seed(cur, messages: int, chats: int, my_chats: int) -> int:
+    owner_id, *others = seed_users(cur, 200)
+    cur.execute(
+        f"INSERT INTO {schema()}.chats (created_at) SELECT CURRENT_TIMESTAMP FROM generate_series(1, %s) RETURNING id",
+        (chats,)
+    )
+    chat_ids = [row[0] for row in cur.fetchall()]
+    participants = []
+    for index, chat_id in enumerate(chat_ids):
+        first = owner_id if index < my_chats else others[index % len(others)]
+        participants += [(chat_id, first), (chat_id, others[(index * 7 + 1) % len(others)])]
+    cur.execute(
+        f"""INSERT INTO {schema()}.chat_participants (chat_id, user_id)
+            SELECT * FROM unnest(%s::integer[], %s::integer[]) ON CONFLICT DO NOTHING""",
+        ([p[0] for p in participants], [p[1] for p in participants])
+    )
+    cur.execute(
+        f"""INSERT INTO {schema()}.messages (chat_id, sender_id, content)
+            SELECT c.chat_id, c.sender_id, (
+                SELECT string_agg(
+                    CASE WHEN random() < 0.0005 THEN (%(rare)s::text[])[1 + floor(random() * %(rare_count)s)::int]
+                         ELSE (%(words)s::text[])[1 + floor(random() * %(word_count)s)::int] END, ' ')
+                FROM generate_series(1, 4 + g %% 12)
+            )
+            FROM generate_series(1, %(messages)s) g
+            CROSS JOIN LATERAL (
+                SELECT cp.chat_id, cp.user_id AS sender_id
+                FROM {schema()}.chat_participants cp
+                WHERE cp.chat_id = (%(chat_ids)s::integer[])[1 + g %% %(chats)s]
+                ORDER BY cp.user_id
+                OFFSET g %% 2
+                LIMIT 1
+            ) c""",
+        {
+            'words': WORDS, 'word_count': len(WORDS),
+            'rare': RARE_WORDS, 'rare_count': len(RARE_WORDS),
+            'messages': messages, 'chat_ids': chat_ids, 'chats': len(chat_ids)
+        }
+    )
+    cur.execute(f'ANALYZE {schema()}.messages')
+    return owner_id
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000000)
+    parser.add_argument('--chats', type=int, default=20000)
+    parser.add_argument('--my-chats', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--user-id', type=int, help='чей корпус искать при --skip-seed')
+    args = parser.parse_args()
+
+    messages = load_function('messages')
+    import db
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+    if args.skip_seed:
+        owner_id = args.user_id
+    else:
+        started = time.perf_counter()
+        owner_id = seed(cur, args.messages, args.chats, args.my_chats)
+        conn.commit()
+        print(f'seeded {args.messages} messages in {time.perf_counter() - started:.1f}s')
+    cur.execute(
+        f"SELECT chat_id FROM {schema()}.chat_participants WHERE user_id = %s ORDER BY chat_id",
+        (owner_id,)
+    )
+    my_chat_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    db.release_connection(conn)
+
+    token = make_token(owner_id)
+    rng = random.Random(42)
+    scenarios = {
+        'all_chats_common_word': lambda: {'q': rng.choice(WORDS)},
+        'all_chats_two_words': lambda: {'q': f'{rng.choice(WORDS)} {rng.choice(WORDS)}'},
+        'all_chats_rare_word': lambda: {'q': rng.choice(RARE_WORDS)},
+        'all_chats_recent': lambda: {'q': rng.choice(WORDS), 'sort': 'recent'},
+        'one_chat_common_word': lambda: {'q': rng.choice(WORDS), 'chat_id': str(rng.choice(my_chat_ids))}
+    }
+
+    results = {}
+    for name, make_query in scenarios.items():
+        timings = []
+        for _ in range(args.queries):
+            event = make_event('GET', token, query={'view': 'search', **make_query()})
+            started = time.perf_counter()
+            response = messages.handler(event, None)
+            timings.append(time.perf_counter() - started)
+            assert response['statusCode'] == 200, response
+        results[name] = latency_summary(timings)
+
+    timings = []
+    for _ in range(args.queries):
+        query = {'view': 'search', 'q': rng.choice(WORDS)}
+        first = json.loads(messages.handler(make_event('GET', token, query=query), None)['body'])
+        if not first['next_cursor']:
+            continue
+        event = make_event('GET', token, query={**query, 'cursor': first['next_cursor']})
+        started = time.perf_counter()
+        response = messages.handler(event, None)
+        timings.append(time.perf_counter() - started)
+        assert response['statusCode'] == 200, response
+    results['next_page'] = latency_summary(timings)
+
+    print(json.dumps({
+        'benchmark': 'message_search',
+        'messages': args.messages,
+        'chats': args.chats,
+        'my_chats': len(my_chat_ids),
+        'results': results
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Сравнение пропускной способности: N одиночных send_message против одного send_batch.
+
+    python benchmarks/send_batch.py --count 500
+"""
+import argparse
+import json
+
+from _common import load_function, make_event, make_token, seed_chat, seed_users, timed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args()
+
+    messages = load_function('messages')
+    import db
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+    sender_id, peer_id = seed_users(cur, 2)
+    chat_id = seed_chat(cur, [sender_id, peer_id])
+    conn.commit()
+    cur.close()
+    db.release_connection(conn)
+
+    token = make_token(sender_id)
+
+    def single_sends():
+        for i in range(args.count):
+            response = messages.handler(
+                make_event('POST', token, {'chat_id': chat_id, 'content': f'single {i}'}), None
+            )
+            assert response['statusCode'] == 200, response
+
+    def batch_send():
+        for start in range(0, args.count, messages.MAX_BATCH_SIZE):
+            end = min(args.count, start + messages.MAX_BATCH_SIZE)
+            response = messages.handler(make_event('POST', token, {
+                'action': 'send_batch',
+                'messages': [{'chat_id': chat_id, 'content': f'batch {i}'} for i in range(start, end)]
+            }), None)
+            assert response['statusCode'] == 200, response
+
+    _, single_s = timed(single_sends)
+    _, batch_s = timed(batch_send)
+
+    print(json.dumps({
+        'benchmark': 'send_batch',
+        'count': args.count,
+        'single_seconds': round(single_s, 4),
+        'batch_seconds': round(batch_s, 4),
+        'single_msgs_per_s': round(args.count / single_s, 1),
+        'batch_msgs_per_s': round(args.count / batch_s, 1),
+        'speedup': round(single_s / batch_s, 2),
+        'pool': db.pool_stats()
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Бенчмарк поиска пользователей в contacts на синтетической таблице users.
+
+    python benchmarks/user_search.py --users 1000000 --queries 500
+    python benchmarks/user_search.py --skip-seed --queries 500   # повторный прогон на тех же данных
+"""
+import argparse
+import json
+import random
+import time
+
+from _common import latency_summary, load_function, make_event, make_token, schema
+
+NAME_PARTS = ['alex', 'ivan', 'maria', 'olga', 'dmitry', 'anna', 'sergey', 'elena', 'pavel', 'irina',
+              'nikita', 'daria', 'artem', 'sofia', 'maxim', 'polina', 'roman', 'vera', 'egor', 'kira']
+
+def seed(cur, count: int):
+    cur.execute(
+        f"""INSERT INTO {schema()}.users (phone, username)
+            SELECT '+7' || (9000000000 + g)::text,
+                   (%s::text[])[1 + (g * 7) %% %s] || '_' || (%s::text[])[1 + (g * 13) %% %s] || (g %% 10000)::text
+            FROM generate_series(1, %s) g
+            ON CONFLICT (phone) DO NOTHING""",
+        (NAME_PARTS, len(NAME_PARTS), NAME_PARTS, len(NAME_PARTS), count)
+    )
+    cur.execute(f'ANALYZE {schema()}.users')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    contacts = load_function('contacts')
+    import db
+
+    if not args.skip_seed:
+        conn = db.get_connection()
+        cur = conn.cursor()
+        started = time.perf_counter()
+        seed(cur, args.users)
+        conn.commit()
+        cur.close()
+        db.release_connection(conn)
+        print(f'seeded {args.users} users in {time.perf_counter() - started:.1f}s')
+
+    token = make_token(1)
+    rng = random.Random(42)
+    modes = {
+        'username_prefix': lambda: rng.choice(NAME_PARTS)[:rng.randint(3, 5)],
+        'username_fuzzy': lambda: rng.choice(NAME_PARTS) + '_' + rng.choice(NAME_PARTS)[:3] + 'x',
+        'phone_prefix': lambda: '+7900' + str(rng.randint(100, 999))
+    }
+
+    results = {}
+    for mode, make_query in modes.items():
+        timings = []
+        for _ in range(args.queries):
+            event = make_event('GET', token, query={'view': 'search', 'q': make_query()})
+            started = time.perf_counter()
+            response = contacts.handler(event, None)
+            timings.append(time.perf_counter() - started)
+            assert response['statusCode'] == 200, response
+        results[mode] = latency_summary(timings)
+
+    print(json.dumps({'benchmark': 'user_search', 'users': args.users, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
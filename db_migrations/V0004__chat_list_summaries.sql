@@ -0,0 +1,23 @@
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+
+ALTER TABLE chat_participants ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chats c
+SET last_message_id = m.id, last_message_at = m.created_at
+FROM (
+    SELECT DISTINCT ON (chat_id) chat_id, id, created_at
+    FROM messages
+    ORDER BY chat_id, id DESC
+) m
+WHERE m.chat_id = c.id;
+
+UPDATE chat_participants cp
+SET unread_count = u.unread
+FROM (
+    SELECT p.id, COUNT(m.id) AS unread
+    FROM chat_participants p
+    JOIN messages m ON m.chat_id = p.chat_id AND m.sender_id <> p.user_id AND NOT m.is_read
+    GROUP BY p.id
+) u
+WHERE u.id = cp.id;
@@ -0,0 +1,11 @@
+ALTER TABLE chat_participants ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chat_participants cp
+SET last_read_message_id = r.read_id
+FROM (
+    SELECT p.id, MAX(m.id) AS read_id
+    FROM chat_participants p
+    JOIN messages m ON m.chat_id = p.chat_id AND m.sender_id <> p.user_id AND m.is_read
+    GROUP BY p.id
+) r
+WHERE r.id = cp.id;
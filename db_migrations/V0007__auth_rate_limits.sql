@@ -0,0 +1,10 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+    key VARCHAR(100) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_auth_codes_verify ON auth_codes(phone, code, created_at DESC) INCLUDE (id, expires_at, is_used);
+
+DROP INDEX IF EXISTS idx_auth_codes_phone;
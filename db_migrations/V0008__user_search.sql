@@ -0,0 +1,15 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_digits VARCHAR(20) GENERATED ALWAYS AS (
+    CASE
+        WHEN regexp_replace(phone, '\D', '', 'g') ~ '^8[0-9]{10}$'
+            THEN '7' || substr(regexp_replace(phone, '\D', '', 'g'), 2)
+        ELSE regexp_replace(phone, '\D', '', 'g')
+    END
+) STORED;
+
+-- Не уникальный: разные записи одного номера ('8...' и '+7...') могли накопиться до нормализации,
+-- их сведение — отдельная ручная задача, а поиск по номеру берёт самую раннюю запись
+CREATE INDEX IF NOT EXISTS idx_users_phone_digits ON users(phone_digits);
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users(lower(username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING GIN (lower(username) gin_trgm_ops);
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_users_phone_hash ON users(encode(sha256(phone_digits::bytea), 'hex'));
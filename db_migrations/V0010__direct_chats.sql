@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS direct_chats (
+    user_low INTEGER NOT NULL REFERENCES users(id),
+    user_high INTEGER NOT NULL REFERENCES users(id),
+    chat_id INTEGER NOT NULL UNIQUE REFERENCES chats(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_low, user_high),
+    CHECK (user_low < user_high)
+);
+
+CREATE INDEX IF NOT EXISTS idx_direct_chats_high ON direct_chats(user_high, user_low);
+
+-- Если у пары уже несколько чатов, берём тот, где была последняя переписка
+INSERT INTO direct_chats (user_low, user_high, chat_id)
+SELECT DISTINCT ON (p.user_low, p.user_high) p.user_low, p.user_high, p.chat_id
+FROM (
+    SELECT chat_id, MIN(user_id) AS user_low, MAX(user_id) AS user_high
+    FROM chat_participants
+    GROUP BY chat_id
+    HAVING COUNT(*) = 2 AND MIN(user_id) < MAX(user_id)
+) p
+JOIN chats c ON c.id = p.chat_id
+ORDER BY p.user_low, p.user_high, c.last_message_at DESC NULLS LAST, p.chat_id
+ON CONFLICT DO NOTHING;
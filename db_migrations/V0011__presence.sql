@@ -0,0 +1,4 @@
+CREATE UNLOGGED TABLE IF NOT EXISTS presence (
+    user_id INTEGER PRIMARY KEY,
+    last_seen TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,59 @@
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER SEQUENCE messages_id_seq RENAME TO messages_unpartitioned_id_seq;
+ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey;
+ALTER TABLE messages_unpartitioned DROP CONSTRAINT IF EXISTS messages_chat_id_fkey, DROP CONSTRAINT IF EXISTS messages_sender_id_fkey;
+DROP INDEX IF EXISTS idx_messages_chat_id_id;
+DROP INDEX IF EXISTS idx_messages_sender;
+DROP INDEX IF EXISTS idx_messages_created;
+
+-- Ключ секционирования обязан входить в первичный ключ, поэтому PK составной
+CREATE TABLE messages (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+    chat_id INTEGER REFERENCES chats(id),
+    sender_id INTEGER REFERENCES users(id),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX idx_messages_chat_id_id ON messages(chat_id, id);
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+DO $$
+DECLARE
+    month DATE := date_trunc('month', COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), CURRENT_TIMESTAMP))::date;
+BEGIN
+    WHILE month <= date_trunc('month', CURRENT_TIMESTAMP + INTERVAL '3 months') LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            'messages_' || to_char(month, 'YYYY_MM'), month, (month + INTERVAL '1 month')::date
+        );
+        month := (month + INTERVAL '1 month')::date;
+    END LOOP;
+END $$;
+
+INSERT INTO messages (id, chat_id, sender_id, content, created_at)
+SELECT id, chat_id, sender_id, content, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM messages_unpartitioned;
+
+SELECT setval(pg_get_serial_sequence('messages', 'id'), GREATEST((SELECT MAX(id) FROM messages), 1));
+
+DROP TABLE messages_unpartitioned;
+
+ALTER TABLE chats ALTER COLUMN last_message_id TYPE BIGINT;
+ALTER TABLE chat_participants ALTER COLUMN last_read_message_id TYPE BIGINT;
+
+-- Архив отсоединённых секций: сжатые gzip сегменты по чатам, уже сжатое хранится без TOAST-компрессии
+CREATE TABLE IF NOT EXISTS message_archive (
+    chat_id INTEGER NOT NULL,
+    min_id BIGINT NOT NULL,
+    max_id BIGINT NOT NULL,
+    partition_name VARCHAR(63) NOT NULL,
+    message_count INTEGER NOT NULL,
+    payload BYTEA NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, max_id)
+);
+
+ALTER TABLE message_archive ALTER COLUMN payload SET STORAGE EXTERNAL;
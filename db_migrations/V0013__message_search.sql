@@ -0,0 +1,6 @@
+-- Русская и английская конфигурации вместе: переписка в основном на русском, но с английскими словами
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    to_tsvector('russian', content) || to_tsvector('english', content)
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
@@ -0,0 +1,53 @@
+-- Содержимое хранится в blob store по SHA-256: один и тот же файл в разных чатах лежит один раз
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    id BIGSERIAL PRIMARY KEY,
+    uploader_id INTEGER NOT NULL REFERENCES users(id),
+    sha256 CHAR(64) NOT NULL REFERENCES blobs(sha256),
+    filename VARCHAR(255) NOT NULL,
+    content_type VARCHAR(127) NOT NULL,
+    size BIGINT NOT NULL,
+    thumbnail_sha256 CHAR(64) REFERENCES blobs(sha256),
+    thumbnail_status VARCHAR(10) NOT NULL DEFAULT 'none',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_attachments_sha256 ON attachments(sha256);
+CREATE INDEX idx_attachments_thumbnail_pending ON attachments(id) WHERE thumbnail_status = 'pending';
+
+CREATE TABLE IF NOT EXISTS uploads (
+    id VARCHAR(32) PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    filename VARCHAR(255) NOT NULL,
+    content_type VARCHAR(127) NOT NULL,
+    size BIGINT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    sha256 CHAR(64),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_uploads_expires ON uploads(expires_at);
+
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id VARCHAR(32) NOT NULL REFERENCES uploads(id) ON DELETE CASCADE,
+    chunk_index INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, chunk_index)
+);
+
+-- messages секционирована с ключом (id, created_at), поэтому ссылка на сообщение без внешнего ключа
+CREATE TABLE IF NOT EXISTS message_attachments (
+    message_id BIGINT NOT NULL,
+    position SMALLINT NOT NULL,
+    chat_id INTEGER NOT NULL REFERENCES chats(id),
+    attachment_id BIGINT NOT NULL REFERENCES attachments(id),
+    PRIMARY KEY (message_id, position)
+);
+
+CREATE INDEX idx_message_attachments_attachment ON message_attachments(attachment_id, chat_id);
@@ -0,0 +1,388 @@
+"""
+Единый asyncio-шлюз для self-hosted развёртывания: ASGI-приложение монтирует auth, contacts и messages в одном процессе.
+HTTP-запрос переводится в событие той же формы, что у облачных функций, обработчики работают в пуле потоков
+поверх общего пула соединений, а ожидание long-poll в sync обслуживается одним асинхронным LISTEN-соединением.
+
+    uvicorn --app-dir gateway app:app --host 0.0.0.0 --port 8000
+    python gateway/app.py --port 8000
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+import psycopg2
+import psycopg2.extensions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+FUNCTIONS = ('auth', 'contacts', 'messages')
+
+GATEWAY_WORKERS = int(os.environ.get('GATEWAY_WORKERS', '16'))
+GATEWAY_TRUST_PROXY = os.environ.get('GATEWAY_TRUST_PROXY', '0') == '1'
+UNLISTEN_AFTER = float(os.environ.get('GATEWAY_UNLISTEN_AFTER', '60'))
+
+# Потоки обработчиков делят один пул соединений: больше потоков, чем соединений, держать незачем
+os.environ.setdefault('DB_POOL_MAX', str(GATEWAY_WORKERS))
+# SMS отправляет воркер, запущенный вместе со шлюзом, а не send_code в рамках запроса
+os.environ.setdefault('SMS_INLINE_DELIVERY', '0')
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+
+
+def load_function(name: str):
+    # Общие модули (api, db, tokens, instrument, presence) во всех функциях — одинаковые копии,
+    # поэтому импорт из первой же папки в sys.path годится для всех трёх
+    path = os.path.join(BACKEND, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(f'{name}_index', os.path.join(path, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class NotifyHub:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.conn = None
+        self.waiters = {}
+        self.listening = set()
+        self._to_listen = set()
+        self._lock = asyncio.Lock()
+        self._wakeup = None
+        self._swept_at = time.monotonic()
+        self._stats = {'notifies': 0, 'wakeups': 0, 'listens': 0, 'unlistens': 0, 'reconnects': 0}
+
+    async def subscribe(self, channels: list) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        for channel in channels:
+            self.waiters.setdefault(channel, set()).add(future)
+        self._to_listen.update(channels)
+        try:
+            async with self._lock:
+                # Кто первым взял блокировку, тот подписывает всю очередь одним запросом
+                batch = (self._to_listen | set(channels)) - self.listening
+                self._to_listen.clear()
+                if batch:
+                    await self._execute('; '.join(f'LISTEN {channel}' for channel in sorted(batch)))
+                    self.listening |= batch
+                    self._stats['listens'] += len(batch)
+                if time.monotonic() - self._swept_at >= UNLISTEN_AFTER:
+                    await self._sweep()
+        except psycopg2.Error:
+            self.unsubscribe(future, channels)
+            self._reset()
+            raise
+        return future
+
+    def unsubscribe(self, future: asyncio.Future, channels: list):
+        for channel in channels:
+            futures = self.waiters.get(channel)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self.waiters[channel]
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            'listening': len(self.listening),
+            'waiting_channels': len(self.waiters),
+            'connected': self.conn is not None and not self.conn.closed
+        }
+
+    def close(self):
+        self._reset()
+
+    async def _sweep(self):
+        idle = sorted(self.listening - set(self.waiters))
+        self._swept_at = time.monotonic()
+        if idle:
+            await self._execute('; '.join(f'UNLISTEN {channel}' for channel in idle))
+            self.listening -= set(idle)
+            self._stats['unlistens'] += len(idle)
+
+    async def _execute(self, sql: str):
+        if self.conn is None or self.conn.closed:
+            await self._connect()
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql)
+            await self._complete()
+        finally:
+            cur.close()
+        self._dispatch()
+
+    async def _connect(self):
+        self._reset()
+        self.conn = psycopg2.connect(self.dsn, async_=True)
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._on_readable)
+        await self._complete()
+        self._stats['reconnects'] += 1
+
+    async def _complete(self):
+        loop = asyncio.get_running_loop()
+        fd = self.conn.fileno()
+        while True:
+            state = self.conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            self._wakeup = loop.create_future()
+            if state == psycopg2.extensions.POLL_WRITE:
+                loop.add_writer(fd, self._on_writable)
+            try:
+                await self._wakeup
+            finally:
+                self._wakeup = None
+                if state == psycopg2.extensions.POLL_WRITE:
+                    loop.remove_writer(fd)
+
+    def _on_readable(self):
+        # Пока выполняется команда, poll() вызывает она сама — здесь только будим её
+        if self._wakeup is not None:
+            if not self._wakeup.done():
+                self._wakeup.set_result(None)
+            return
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            self._reset()
+            return
+        self._dispatch()
+
+    def _on_writable(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _dispatch(self):
+        if not self.conn.notifies:
+            return
+        for notify in self.conn.notifies:
+            self._stats['notifies'] += 1
+            for future in self.waiters.get(notify.channel, ()):
+                if not future.done():
+                    future.set_result(notify.channel)
+                    self._stats['wakeups'] += 1
+        self.conn.notifies.clear()
+
+    def _reset(self):
+        conn, self.conn = self.conn, None
+        self.listening = set()
+        if conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+        except (RuntimeError, ValueError, psycopg2.Error):
+            pass
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        # Ждущие клиенты перепроверят состояние и вернутся с ответом, а не повиснут до таймаута
+        for futures in self.waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+
+class Gateway:
+    def __init__(self, functions=FUNCTIONS, workers: int = GATEWAY_WORKERS):
+        self.functions = {name: load_function(name) for name in functions}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gateway')
+        self.hub = None
+        self.flusher = None
+        self.sms_worker = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        name = scope['path'].strip('/').split('/')[0]
+        if name == 'healthz':
+            await self.respond(send, self.health())
+            return
+        if name not in self.functions:
+            await self.respond(send, {
+                'statusCode': 404, 'headers': CORS_HEADERS, 'body': json.dumps({'error': 'Not found'})
+            })
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        event = build_event(scope, body)
+        context = SimpleNamespace(request_id=uuid.uuid4().hex, function_name=name)
+        if name == 'messages' and event['httpMethod'] == 'POST':
+            response = await self.sync_or_call(event, context)
+        else:
+            response = await self.call(name, event, context)
+        await self.respond(send, response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if 'messages' in self.functions:
+                    self.flusher = asyncio.create_task(self.flush_presence())
+                if 'auth' in self.functions and os.environ.get('SMS_API_KEY'):
+                    self.sms_worker = self.start_sms_worker()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.flusher is not None:
+                    self.flusher.cancel()
+                if self.sms_worker is not None:
+                    self.sms_worker.stop()
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def flush_presence(self):
+        # Процесс живёт постоянно, поэтому сброс last_seen, который в облаке выполняет задача по расписанию, идёт здесь
+        import presence
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(presence.PRESENCE_FLUSH_INTERVAL)
+            await loop.run_in_executor(self.executor, presence.flush)
+
+    def start_sms_worker(self):
+        # Воркер большую часть времени ждёт NOTIFY в select: отдельный поток, чтобы не занимать пул обработчиков
+        import sms
+        worker = sms.SmsWorker(os.environ['SMS_API_KEY'])
+        threading.Thread(target=worker.run, name='sms-worker', daemon=True).start()
+        return worker
+
+    async def call(self, name: str, event: dict, context) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.functions[name].handler, event, context)
+
+    async def sync_or_call(self, event: dict, context) -> dict:
+        messages = self.functions['messages']
+        try:
+            body = json.loads(event['body'] or '{}')
+            wait = min(float(body.get('wait') or 0), messages.MAX_WAIT_SECONDS) if body.get('action') == 'sync' else 0
+        except (ValueError, TypeError, AttributeError):
+            wait = 0
+        if wait <= 0:
+            return await self.call('messages', event, context)
+
+        # Обработчик вызывается без ожидания, а ждём здесь: ожидающий клиент не держит ни поток, ни соединение из пула
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        inner = {
+            **event,
+            'headers': {key: value for key, value in event['headers'].items() if key != 'if-none-match'},
+            'body': json.dumps({**body, 'wait': 0})
+        }
+        response = await self.call('messages', inner, context)
+        channels = idle_channels(messages, response)
+        if channels:
+            if self.hub is None:
+                self.hub = NotifyHub(os.environ['DATABASE_URL'])
+            future = await self.hub.subscribe(channels)
+            try:
+                # Повторная проверка после LISTEN: сообщение могло прийти между первым ответом и подпиской
+                response = await self.call('messages', inner, context)
+                if idle_channels(messages, response):
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - loop.time()))
+                        response = await self.call('messages', inner, context)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.hub.unsubscribe(future, channels)
+
+        etag = response['headers'].get('ETag')
+        if etag and event['headers'].get('if-none-match') == etag:
+            return {'statusCode': 304, 'headers': {'Access-Control-Allow-Origin': '*', 'ETag': etag}, 'body': ''}
+        return response
+
+    async def respond(self, send, response: dict):
+        body = response.get('body') or ''
+        payload = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode()
+        headers = [(key.lower().encode(), str(value).encode()) for key, value in (response.get('headers') or {}).items()]
+        headers.append((b'content-length', str(len(payload)).encode()))
+        await send({'type': 'http.response.start', 'status': response['statusCode'], 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    def health(self) -> dict:
+        import db
+        return {
+            'statusCode': 200,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({
+                'status': 'ok',
+                'functions': sorted(self.functions),
+                'pool': db.pool_stats(),
+                'replicas': db.replica_stats(),
+                'notify': self.hub.stats() if self.hub is not None else None
+            })
+        }
+
+    def close(self):
+        if self.hub is not None:
+            self.hub.close()
+        self.executor.shutdown(wait=False)
+
+
+def build_event(scope, body: bytes) -> dict:
+    headers = {}
+    for key, value in scope.get('headers') or []:
+        headers[key.decode('latin-1').lower()] = value.decode('latin-1')
+    query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+    client = scope.get('client') or ('', 0)
+    source_ip = client[0]
+    if GATEWAY_TRUST_PROXY and headers.get('x-forwarded-for'):
+        source_ip = headers['x-forwarded-for'].split(',')[0].strip()
+
+    try:
+        text, is_base64 = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text, is_base64 = base64.b64encode(body).decode(), True
+
+    return {
+        'httpMethod': scope['method'],
+        'path': scope['path'],
+        'headers': headers,
+        'queryStringParameters': query,
+        'body': text,
+        'isBase64Encoded': is_base64,
+        'requestContext': {'identity': {'sourceIp': source_ip}}
+    }
+
+def idle_channels(messages, response: dict) -> list:
+    if response['statusCode'] != 200:
+        return []
+    payload = json.loads(response['body'])
+    if payload.get('changed') or not payload.get('sync_token'):
+        return []
+    return [messages.chat_channel(chat_id) for chat_id in messages.decode_sync_token(payload['sync_token'])]
+
+
+app = Gateway()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, lifespan='on')
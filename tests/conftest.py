@@ -0,0 +1,34 @@
+"""
+Поведенческие тесты функций на живом PostgreSQL. Нужна база с применёнными db_migrations и те же переменные,
+что у задеплоенных функций: DATABASE_URL, MAIN_DB_SCHEMA, JWT_SECRET. Без доступной базы тесты пропускаются.
+
+    python -m pytest
+    python -m pytest tests/test_sync.py -k long_poll
+"""
+import os
+import sys
+
+import psycopg2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ('benchmarks', 'gateway'):
+    if os.path.join(ROOT, path) not in sys.path:
+        sys.path.insert(0, os.path.join(ROOT, path))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def postgres():
+    if not os.environ.get('DATABASE_URL') or not os.environ.get('MAIN_DB_SCHEMA'):
+        pytest.skip('DATABASE_URL and MAIN_DB_SCHEMA are required')
+    try:
+        conn = psycopg2.connect(os.environ['DATABASE_URL'], connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'PostgreSQL is not reachable: {e}')
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT to_regclass(%s)', (f"{os.environ['MAIN_DB_SCHEMA']}.messages",))
+        if cur.fetchone()[0] is None:
+            pytest.skip(f"schema {os.environ['MAIN_DB_SCHEMA']} has no migrations applied")
+    finally:
+        conn.close()
@@ -0,0 +1,129 @@
+"""
+Помощники тестов: обработчики вызываются напрямую, как в harness.py, а каждый тест сам заводит пользователей и чаты
+"""
+import base64
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+from _common import load_function, make_event, make_token, seed_chat, seed_users
+
+_functions = {}
+
+
+def function(name: str):
+    if name not in _functions:
+        _functions[name] = load_function(name)
+    return _functions[name]
+
+def call(name: str, method: str, user_id: int = None, body: dict = None, query: dict = None,
+         headers: dict = None) -> tuple:
+    event = make_event(method, make_token(user_id) if user_id else None, body, query)
+    event['headers'].update(headers or {})
+    response = function(name).handler(event, None)
+    payload = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        payload = base64.b64decode(payload)
+    elif payload:
+        payload = json.loads(payload)
+    return response['statusCode'], payload, response.get('headers') or {}
+
+@contextmanager
+def database():
+    function('messages')
+    import db
+    conn = db.get_connection()
+    cur = conn.cursor()
+    try:
+        yield cur
+        conn.commit()
+    finally:
+        cur.close()
+        db.release_connection(conn)
+
+@contextmanager
+def captured_log():
+    # Вместо печати строки лога собираются вместе с текстами запросов: по ним видно, куда ходил обработчик
+    function('messages')
+    import instrument
+    records, finish, emit = [], instrument.finish, instrument.emit
+
+    def capture(trace):
+        records.append({
+            **trace.summary(),
+            'sql': [' '.join(instrument.statement_text(statement[0]).split()) for statement in trace.statements]
+        })
+
+    instrument.finish, instrument.emit = capture, records.append
+    try:
+        yield records
+    finally:
+        instrument.finish, instrument.emit = finish, emit
+
+def seed(users: int, chats: list = ()) -> tuple:
+    # chats — списки индексов пользователей: [(0, 1)] создаёт чат первого со вторым
+    with database() as cur:
+        user_ids = seed_users(cur, users)
+        chat_ids = [seed_chat(cur, [user_ids[index] for index in members]) for members in chats]
+    return user_ids, chat_ids
+
+def seed_messages(chat_id: int, sender_ids: list, count: int) -> list:
+    with database() as cur:
+        cur.execute(
+            f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.messages (chat_id, sender_id, content)
+                SELECT %s, (%s::integer[])[1 + g %% %s], 'message ' || g
+                FROM generate_series(1, %s) g
+                ORDER BY g
+                RETURNING id""",
+            (chat_id, sender_ids, len(sender_ids), count)
+        )
+        ids = sorted(row[0] for row in cur.fetchall())
+        # Сводки чата обработчики ведут сами: вставка в обход send_message обновляет их так же
+        cur.execute(
+            f"""WITH c AS (
+                    UPDATE {os.environ['MAIN_DB_SCHEMA']}.chats
+                    SET last_message_id = m.id, last_message_at = m.created_at
+                    FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                    WHERE chats.id = %(chat_id)s AND m.id = %(last_id)s
+                )
+                UPDATE {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp
+                SET unread_count = cp.unread_count + (
+                    SELECT COUNT(*) FROM {os.environ['MAIN_DB_SCHEMA']}.messages m
+                    WHERE m.chat_id = cp.chat_id AND m.id = ANY(%(ids)s) AND m.sender_id <> cp.user_id
+                )
+                WHERE cp.chat_id = %(chat_id)s""",
+            {'chat_id': chat_id, 'last_id': ids[-1], 'ids': ids}
+        )
+        return ids
+
+def page_back(user_id: int, chat_id: int, limit: int = 3) -> list:
+    # Листает историю назад по before_id до конца и возвращает id в хронологическом порядке
+    seen, cursor = [], None
+    while True:
+        query = {'chat_id': str(chat_id), 'limit': str(limit), **({'before_id': str(cursor)} if cursor else {})}
+        status, page, _ = call('messages', 'GET', user_id, query=query)
+        assert status == 200
+        seen = [message['id'] for message in page['messages']] + seen
+        if not page['has_more']:
+            return seen
+        cursor = page['next_cursor']
+        assert cursor == page['messages'][0]['id']
+
+def random_phone() -> str:
+    return '+7999' + str(uuid.uuid4().int)[:7]
+
+def random_ip() -> str:
+    # Корзины лимитов живут между запусками: каждый запуск берёт свежий адрес из документационной сети
+    return '2001:db8::' + ':'.join(uuid.uuid4().hex[i:i + 4] for i in range(0, 16, 4))
+
+def seed_phone_users(count: int) -> list:
+    # Пользователи с настоящими 11-значными номерами: по ним работают нормализация и хэши контактов
+    with database() as cur:
+        cur.execute(
+            f"""INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.users (phone, username)
+                SELECT phone, 'phone_' || substr(phone, 2) FROM unnest(%s::text[]) AS phone
+                RETURNING id, phone""",
+            ([random_phone() for _ in range(count)],)
+        )
+        return cur.fetchall()
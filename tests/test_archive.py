@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import threading
+from datetime import date
+
+import psycopg2
+import pytest
+
+from support import call, database, function, page_back, seed, seed_messages
+
+# Давние месяцы, которых нет среди живых секций: 2001-01 создаём сами, 2002-03 «забыт» и его строки уходят в DEFAULT
+OLD_MONTH, STRANDED_MONTH = date(2001, 1, 1), date(2002, 3, 1)
+
+
+@pytest.fixture
+def archive():
+    function('messages')
+    import archive
+    return archive
+
+@pytest.fixture
+def history(archive):
+    schema = os.environ['MAIN_DB_SCHEMA']
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    with database() as cur:
+        partitions = archive.list_partitions(cur)
+        for month in (OLD_MONTH, STRANDED_MONTH):
+            if archive.partition_name(month) in partitions:
+                cur.execute(f'DROP TABLE {schema}.{archive.partition_name(month)}')
+        cur.execute(
+            f"""CREATE TABLE {schema}.{archive.partition_name(OLD_MONTH)} PARTITION OF {schema}.messages
+                FOR VALUES FROM (%s) TO (%s)""",
+            (OLD_MONTH, archive.add_months(OLD_MONTH, 1))
+        )
+        cur.execute(
+            f"""INSERT INTO {schema}.messages (chat_id, sender_id, content, created_at)
+                SELECT %s, %s, 'archived ' || g, %s::timestamp + g * INTERVAL '1 minute'
+                FROM generate_series(1, 5) g ORDER BY g
+                RETURNING id""",
+            (chat_id, bob, OLD_MONTH)
+        )
+        archived = sorted(row[0] for row in cur.fetchall())
+        cur.execute(
+            f"""INSERT INTO {schema}.messages (chat_id, sender_id, content, created_at)
+                VALUES (%s, %s, 'stranded', %s) RETURNING id""",
+            (chat_id, alice, STRANDED_MONTH)
+        )
+        stranded = [cur.fetchone()[0]]
+    live = seed_messages(chat_id, [alice, bob], 3)
+    return alice, chat_id, archived, stranded, live
+
+def test_archive_partitions_and_page_through_the_archive(archive, history):
+    import db
+
+    schema = os.environ['MAIN_DB_SCHEMA']
+    alice, chat_id, archived, stranded, live = history
+
+    # ensure_partitions не падает на строках в DEFAULT, а переносит их в новую секцию
+    with database() as cur:
+        assert archive.partition_name(STRANDED_MONTH) in archive.ensure_partitions(cur)
+        cur.execute(f"SELECT COUNT(*) FROM {schema}.messages_default WHERE created_at >= %s AND created_at < %s",
+                    (STRANDED_MONTH, archive.add_months(STRANDED_MONTH, 1)))
+        assert cur.fetchone()[0] == 0
+
+    # Долгий читатель messages не даёт DETACH взять блокировку: архивация ждёт недолго и повторяет, а не висит в очереди
+    reader = psycopg2.connect(os.environ['DATABASE_URL'])
+    reader.cursor().execute(f'SELECT COUNT(*) FROM {schema}.messages WHERE chat_id = %s', (chat_id,))
+    releaser = threading.Timer(0.5, reader.rollback)
+    releaser.start()
+    conn = db.get_connection()
+    lock_timeout, archive.DETACH_LOCK_TIMEOUT = archive.DETACH_LOCK_TIMEOUT, '200ms'
+    try:
+        stats = {}
+        for month in (OLD_MONTH, STRANDED_MONTH):
+            stats[month] = archive.archive_partition(conn, archive.partition_name(month))
+            conn.commit()
+        assert (stats[OLD_MONTH]['messages'], stats[OLD_MONTH]['segments']) == (5, 1)
+    finally:
+        archive.DETACH_LOCK_TIMEOUT = lock_timeout
+        db.release_connection(conn)
+        releaser.join()
+        reader.close()
+    with database() as cur:
+        assert not set(archive.list_partitions(cur)) & {archive.partition_name(OLD_MONTH), archive.partition_name(STRANDED_MONTH)}
+
+    # Листание назад переходит из живых секций в архив без пропусков и дублей
+    everything = sorted(archived + stranded + live)
+    assert page_back(alice, chat_id) == everything
+    _, page, _ = call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'after_id': str(archived[1]), 'limit': '4'})
+    assert [message['id'] for message in page['messages']] == everything[2:6]
+
+def test_dry_run_leaves_partitions_alone(archive, history, monkeypatch, capsys):
+    schema = os.environ['MAIN_DB_SCHEMA']
+    monkeypatch.setattr(sys, 'argv', ['archive.py', '--dry-run', '--keep-months', '1200'])
+    archive.main()
+    plan = json.loads(capsys.readouterr().out)
+    assert archive.partition_name(STRANDED_MONTH) in plan['would_create']
+    with database() as cur:
+        assert archive.partition_name(STRANDED_MONTH) not in archive.list_partitions(cur)
+        cur.execute(f"SELECT COUNT(*) FROM {schema}.messages_default WHERE created_at >= %s AND created_at < %s",
+                    (STRANDED_MONTH, archive.add_months(STRANDED_MONTH, 1)))
+        assert cur.fetchone()[0] == 1
@@ -0,0 +1,151 @@
+import base64
+import hashlib
+import io
+import os
+
+import pytest
+
+from support import call, captured_log, function, seed
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    function('messages')
+    import attachments
+
+    # Настоящее хранилище по умолчанию — S3; тесты пишут blob-ы во временный каталог
+    monkeypatch.setattr(attachments, '_store', attachments.LocalBlobStore(str(tmp_path)))
+    monkeypatch.setattr(attachments, 'ATTACHMENT_CHUNK_SIZE', 1000)
+    monkeypatch.setattr(attachments, 'MAX_RANGE_BYTES', 4000)
+    return attachments
+
+def start_upload(user_id: int, data: bytes, filename: str, content_type: str = 'application/octet-stream') -> dict:
+    return call('messages', 'POST', user_id, body={
+        'action': 'start_upload', 'filename': filename, 'content_type': content_type,
+        'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()
+    })[1]
+
+def upload(user_id: int, data: bytes, filename: str, content_type: str = 'application/octet-stream') -> dict:
+    started = start_upload(user_id, data, filename, content_type)
+    if started['upload_id'] is None:
+        return started['attachment']
+    for index in range(started['chunks']):
+        chunk = data[index * started['chunk_size']:(index + 1) * started['chunk_size']]
+        status, _, _ = call('messages', 'POST', user_id, body={
+            'action': 'upload_chunk', 'upload_id': started['upload_id'], 'index': index,
+            'data': base64.b64encode(chunk).decode()
+        })
+        assert status == 200
+    status, completed, _ = call('messages', 'POST', user_id, body={'action': 'complete_upload', 'upload_id': started['upload_id']})
+    assert status == 200
+    return completed['attachment']
+
+def download(user_id: int, attachment_id: int, range: str = None, **query) -> tuple:
+    return call('messages', 'GET', user_id, query={'view': 'attachment', 'id': str(attachment_id), **query},
+                headers={'range': range} if range else {})
+
+def test_known_hash_needs_access_to_the_blob(store):
+    (alice, bob, mallory), (chat_id,) = seed(3, [(0, 1)])
+    secret = os.urandom(2500)
+    attachment = upload(alice, secret, 'secret.bin')
+    assert attachment['sha256'] == hashlib.sha256(secret).hexdigest()
+
+    # Хеш чужого файла не даёт вложения: без общего чата придётся загрузить содержимое самому
+    started = start_upload(mallory, secret, 'guess.bin')
+    assert started['attachment'] is None and started['upload_id'] is not None
+    assert download(mallory, attachment['id'])[0] == 404
+
+    call('messages', 'POST', alice, body={'chat_id': chat_id, 'attachment_ids': [attachment['id']]})
+    started = start_upload(bob, secret, 'forward.bin')
+    assert (started['upload_id'], started['attachment']['sha256']) == (None, attachment['sha256'])
+
+def test_whole_and_ranged_downloads(store):
+    (alice,), _ = seed(1)
+    small = os.urandom(2500)
+    attachment = upload(alice, small, 'small.bin')
+    status, body, headers = download(alice, attachment['id'])
+    assert (status, body, 'Content-Range' in headers) == (200, small, False)
+    status, body, headers = download(alice, attachment['id'], range='bytes=100-199')
+    assert (status, body, headers.get('Content-Range')) == (206, small[100:200], 'bytes 100-199/2500')
+
+    # Большой файл одним ответом функции не отдать: без Range — 400, длинный диапазон урезается
+    large = upload(alice, os.urandom(5000), 'large.bin')
+    assert download(alice, large['id'])[0] == 400
+    status, body, headers = download(alice, large['id'], range='bytes=0-')
+    assert (status, len(body), headers.get('Content-Range')) == (206, 4000, 'bytes 0-3999/5000')
+
+def test_thumbnails(store):
+    from PIL import Image
+    import db
+
+    (alice,), _ = seed(1)
+    image = io.BytesIO()
+    # Цвет случайный: превью одинакового содержимого из прошлого запуска ссылалось бы на удалённый каталог
+    Image.new('RGB', (640, 480), tuple(os.urandom(3))).save(image, format='PNG')
+    picture = upload(alice, image.getvalue(), 'photo.png', 'image/png')
+    broken = upload(alice, b'not an image ' + os.urandom(16), 'broken.png', 'image/png')
+    conn = db.get_connection()
+    try:
+        with captured_log() as records:
+            while store.generate_thumbnails(conn) == store.THUMBNAIL_BATCH_SIZE:
+                pass
+    finally:
+        db.release_connection(conn)
+
+    status, body, headers = download(alice, picture['id'], thumbnail='1')
+    assert (status, headers.get('Content-Type')) == (200, 'image/jpeg')
+    assert max(Image.open(io.BytesIO(body)).size) <= max(store.THUMBNAIL_SIZE)
+    assert len([record for record in records if record.get('source') == 'thumbnail' and record.get('attachment') == broken['id']]) == 1
+    assert download(alice, broken['id'], thumbnail='1')[0] == 404
+
+def test_only_media_is_shown_inline(store):
+    (alice,), _ = seed(1)
+    for filename, content_type, inline in [('photo.png', 'image/png', True), ('clip.mp4', 'video/mp4', True),
+                                           ('logo.svg', 'image/svg+xml', False), ('page.html', 'text/html', False)]:
+        attachment = upload(alice, os.urandom(100), filename, content_type)
+        status, _, headers = download(alice, attachment['id'])
+        assert (status, headers['X-Content-Type-Options']) == (200, 'nosniff')
+        if inline:
+            assert (headers['Content-Type'], headers['Content-Disposition'].split(';')[0]) == (content_type, 'inline')
+        else:
+            assert (headers['Content-Type'], headers['Content-Disposition'].split(';')[0]) == ('application/octet-stream', 'attachment')
+
+def test_unconfigured_storage_is_503(store, monkeypatch):
+    (alice,), _ = seed(1)
+    monkeypatch.setattr(store, '_store', None)
+    monkeypatch.delenv('BLOB_STORE', raising=False)
+    monkeypatch.delenv('BLOB_STORE_BUCKET', raising=False)
+    started = start_upload(alice, b'data', 'note.txt')
+    status, payload, _ = call('messages', 'POST', alice, body={
+        'action': 'upload_chunk', 'upload_id': started['upload_id'], 'index': 0, 'data': base64.b64encode(b'data').decode()
+    })
+    assert (status, payload) == (503, {'error': 'Attachment storage is not configured'})
+
+def test_blob_file_appears_only_after_commit(store, monkeypatch):
+    (alice, bob), _ = seed(2)
+    data = os.urandom(1500)
+    key = store.blob_key(hashlib.sha256(data).hexdigest())
+    started = start_upload(alice, data, 'late.bin')
+    for index in range(started['chunks']):
+        call('messages', 'POST', alice, body={
+            'action': 'upload_chunk', 'upload_id': started['upload_id'], 'index': index,
+            'data': base64.b64encode(data[index * 1000:(index + 1) * 1000]).decode()
+        })
+
+    # Откат завершения не оставляет в хранилище файла, на который не ссылается ни одна строка
+    def fail(*args):
+        raise RuntimeError('insert failed')
+
+    complete = {'action': 'complete_upload', 'upload_id': started['upload_id']}
+    with monkeypatch.context() as patch:
+        patch.setattr(store, 'create_attachment', fail)
+        assert call('messages', 'POST', alice, body=complete)[0] == 500
+    assert store.get_blob_store().size(key) is None
+    status, completed, _ = call('messages', 'POST', alice, body=complete)
+    assert (status, download(alice, completed['attachment']['id'])[1]) == (200, data)
+
+    # Строка без файла (перенос после коммита сорвался) восполняется следующей загрузкой того же содержимого
+    store.get_blob_store().delete(key)
+    attachment = upload(bob, data, 'again.bin')
+    assert download(alice, completed['attachment']['id'])[1] == data
+    assert download(bob, attachment['id'])[1] == data
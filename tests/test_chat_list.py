@@ -0,0 +1,23 @@
+from support import call, seed
+
+
+def test_chat_list_with_last_message_and_unread_counts():
+    (alice, bob, carol), (quiet_id, busy_id) = seed(3, [(0, 1), (0, 2)])
+    call('messages', 'POST', bob, body={'chat_id': quiet_id, 'content': 'older'})
+    for content in ('one', 'two'):
+        _, sent, _ = call('messages', 'POST', carol, body={'chat_id': busy_id, 'content': content})
+
+    status, payload, _ = call('contacts', 'GET', alice, query={'view': 'chats'})
+    assert status == 200
+    chats = {chat['chat_id']: chat for chat in payload['chats']}
+    assert [chat['chat_id'] for chat in payload['chats']] == [busy_id, quiet_id]
+    assert chats[busy_id]['last_message']['id'] == sent['message']['id']
+    assert chats[busy_id]['last_message']['is_mine'] is False
+    assert (chats[busy_id]['unread_count'], chats[quiet_id]['unread_count']) == (2, 1)
+    assert chats[busy_id]['contact']['id'] == carol
+
+def test_own_messages_are_not_unread():
+    (alice, carol), (chat_id,) = seed(2, [(0, 1)])
+    call('messages', 'POST', carol, body={'chat_id': chat_id, 'content': 'mine'})
+    _, payload, _ = call('contacts', 'GET', carol, query={'view': 'chats'})
+    assert [(chat['chat_id'], chat['unread_count']) for chat in payload['chats']] == [(chat_id, 0)]
@@ -0,0 +1,59 @@
+import hashlib
+import threading
+
+from support import call, function, random_phone, seed, seed_phone_users
+
+
+def test_sync_matches_phones_and_hashes():
+    (alice,), _ = seed(1)
+    (bob, bob_phone), (carol, carol_phone) = seed_phone_users(2)
+    local = '8' + bob_phone[2:]
+    carol_hash = hashlib.sha256(carol_phone[1:].encode()).hexdigest()
+    body = {'action': 'sync_contacts', 'phones': [local, random_phone(), 'not a phone'], 'phone_hashes': [carol_hash.upper()]}
+
+    status, payload, _ = call('contacts', 'POST', alice, body=body)
+    assert status == 200
+    matches = {match['contact']['id']: match for match in payload['matches']}
+    assert sorted(matches) == sorted([bob, carol])
+    assert (matches[bob]['query'], matches[carol]['query']) == (local, carol_hash.upper())
+    assert payload['created_chats'] == 2
+    assert all(match['created'] for match in payload['matches'])
+
+    # Повтор ничего не создаёт и отдаёт те же чаты
+    _, again, _ = call('contacts', 'POST', alice, body=body)
+    assert again['created_chats'] == 0
+    assert {match['contact']['id']: match['chat_id'] for match in again['matches']} == \
+        {contact_id: match['chat_id'] for contact_id, match in matches.items()}
+
+def test_phones_must_be_an_array():
+    (alice,), _ = seed(1)
+    assert call('contacts', 'POST', alice, body={'action': 'sync_contacts', 'phones': 'x'})[0] == 400
+
+def test_sync_is_rate_limited_per_number(monkeypatch):
+    # Лимит считает номера, а не запросы: мелкие синхронизации подряд упираются в тот же бюджет
+    monkeypatch.setattr(function('contacts'), 'SYNC_CONTACTS_LIMIT', (3, 3 / 86400))
+    (alice,), _ = seed(1)
+
+    def sync(count: int) -> tuple:
+        return call('contacts', 'POST', alice, body={'action': 'sync_contacts', 'phones': [random_phone() for _ in range(count)]})
+    assert sync(2)[0] == 200
+    status, payload, headers = sync(2)
+    assert (status, payload['error']) == (429, 'Too many requests')
+    assert int(headers['Retry-After']) > 0
+    assert sync(1)[0] == 200
+
+def test_concurrent_syncs_of_one_book():
+    (alice,), _ = seed(1)
+    contacts = seed_phone_users(6)
+    phones = [phone for _, phone in contacts]
+    results = []
+    def sync(order):
+        results.append(call('contacts', 'POST', alice, body={'action': 'sync_contacts', 'phones': order}))
+    threads = [threading.Thread(target=sync, args=(order,)) for order in (phones, phones[::-1])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [status for status, _, _ in results] == [200, 200]
+    chats = [{match['contact']['id']: match['chat_id'] for match in payload['matches']} for _, payload, _ in results]
+    assert chats[0] == chats[1] and len(chats[0]) == 6
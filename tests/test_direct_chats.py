@@ -0,0 +1,39 @@
+import os
+import threading
+
+from support import call, database, random_phone, seed_phone_users
+
+
+def add_contact(user_id: int, phone: str) -> tuple:
+    return call('contacts', 'POST', user_id, body={'phone': phone})
+
+def test_both_directions_share_one_chat():
+    (alice, alice_phone), (bob, bob_phone) = seed_phone_users(2)
+    status, first, _ = add_contact(alice, bob_phone)
+    assert status == 200
+    assert add_contact(bob, alice_phone)[1]['chat_id'] == first['chat_id']
+
+def test_concurrent_mutual_adds_create_one_chat():
+    # Встречные добавления одновременно: ON CONFLICT сводит их к одному чату, лишний удаляется
+    (carol, carol_phone), (dave, dave_phone) = seed_phone_users(2)
+    results = {}
+    def add(user_id, phone):
+        results[user_id] = add_contact(user_id, phone)[1]
+    threads = [threading.Thread(target=add, args=pair) for pair in ((carol, dave_phone), (dave, carol_phone))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results[carol]['chat_id'] == results[dave]['chat_id']
+    with database() as cur:
+        cur.execute(
+            f"""SELECT COUNT(*) FROM {os.environ['MAIN_DB_SCHEMA']}.chat_participants
+                WHERE user_id = ANY(%s::integer[])""",
+            ([carol, dave],)
+        )
+        assert cur.fetchone()[0] == 2
+
+def test_invalid_contacts():
+    ((alice, alice_phone),) = seed_phone_users(1)
+    assert add_contact(alice, alice_phone)[0] == 400
+    assert add_contact(alice, random_phone())[0] == 404
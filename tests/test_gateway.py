@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+from _common import make_token
+from support import function, seed
+
+
+def test_gateway_routes_and_long_poll():
+    function('messages')
+    from gateway_concurrency import asgi_request
+    from app import app
+
+    (reader, writer), (chat_id,) = seed(2, [(0, 1)])
+
+    async def scenario():
+        status, health = await asgi_request(app, 'GET', '/healthz')
+        assert (status, health['status'], health['functions']) == (200, 'ok', ['auth', 'contacts', 'messages'])
+        assert (await asgi_request(app, 'GET', '/unknown'))[0] == 404
+
+        _, state = await asgi_request(app, 'POST', '/messages', make_token(reader), {'action': 'sync'})
+        started = time.perf_counter()
+        waiting = asyncio.ensure_future(asgi_request(app, 'POST', '/messages', make_token(reader),
+                                                     {'action': 'sync', 'sync_token': state['sync_token'], 'wait': 10}))
+        await asyncio.sleep(0.3)
+        status, sent = await asgi_request(app, 'POST', '/messages', make_token(writer), {'chat_id': chat_id, 'content': 'ping'})
+        assert status == 200
+        status, woken = await asyncio.wait_for(waiting, 15)
+        return status, woken, sent, time.perf_counter() - started
+
+    # Ожидание sync держит шлюз, а не поток с соединением: клиент просыпается по общему LISTEN
+    status, woken, sent, elapsed = asyncio.run(scenario())
+    assert status == 200
+    assert [message['id'] for message in woken['chats'][0]['messages']] == [sent['message']['id']]
+    assert elapsed < 5
+    assert app.hub is not None and app.hub.stats()['wakeups'] >= 1
@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+
+HARNESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'harness.py')
+
+
+def harness(*args) -> subprocess.CompletedProcess:
+    # Отдельный процесс: harness подменяет курсоры пула счётчиком запросов, остальным тестам это ни к чему
+    return subprocess.run([sys.executable, HARNESS, '--size', '3', '--warmup', '1', *args],
+                          capture_output=True, text=True, timeout=300)
+
+def test_harness_reports_and_detects_regressions(tmp_path):
+    current, baseline = tmp_path / 'current.json', tmp_path / 'baseline.json'
+    run = harness('--output', str(current))
+    assert run.returncode == 0, run.stderr[-500:]
+    report = json.loads(current.read_text(encoding='utf-8'))
+    assert sorted(report['scenarios']) == ['chat_history', 'contact_sync', 'login_storm', 'send_burst']
+    steps = [step for scenario in report['scenarios'].values() for step in scenario['steps'].values()]
+    assert all(step['count'] > 0 and step['queries_per_request'] > 0 for step in steps)
+
+    # Базовый прогон с меньшим числом запросов на вызов: сравнение обязано поймать регрессию и завершиться с кодом 1
+    for step in steps:
+        step['queries_per_request'] -= 1
+    baseline.write_text(json.dumps(report), encoding='utf-8')
+    run = harness('--scenarios', 'send_burst', '--compare', str(baseline))
+    assert run.returncode == 1
+    assert 'REGRESSION send_burst/' in run.stderr and 'queries/request' in run.stderr
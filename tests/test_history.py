@@ -0,0 +1,28 @@
+from support import call, captured_log, page_back, seed, seed_messages
+
+
+def test_before_id_pages_cover_history_once():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    ids = seed_messages(chat_id, [alice, bob], 7)
+    assert page_back(alice, chat_id) == ids
+
+def test_after_id_page_continues_forward():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    ids = seed_messages(chat_id, [alice, bob], 7)
+    _, page, _ = call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'after_id': str(ids[2]), 'limit': '3'})
+    assert [message['id'] for message in page['messages']] == ids[3:6]
+    assert page['next_cursor'] == ids[5]
+
+def test_archive_boundary_comes_with_the_page():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    ids = seed_messages(chat_id, [alice, bob], 7)
+    # Чат без архива: граница архива приходит в том же запросе истории, отдельного похода в message_archive нет
+    with captured_log() as records:
+        call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'after_id': str(ids[0]), 'limit': '3'})
+        call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'before_id': str(ids[2]), 'limit': '5'})
+    assert [sum('message_archive' in sql for sql in record['sql']) for record in records] == [1, 1]
+
+def test_invalid_cursors():
+    (alice, _), (chat_id,) = seed(2, [(0, 1)])
+    assert call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'before_id': 'x'})[0] == 400
+    assert call('messages', 'GET', alice, query={'chat_id': str(chat_id), 'before_id': '9', 'after_id': '1'})[0] == 400
@@ -0,0 +1,36 @@
+import pytest
+
+from support import call, function, seed, seed_messages
+
+
+@pytest.fixture
+def instrument():
+    function('messages')
+    import instrument
+    return instrument
+
+@pytest.fixture
+def log_lines(instrument, monkeypatch):
+    records = []
+    # Порог 0: каждый вызов «медленный», так видно, что EXPLAIN по умолчанию не выполняется
+    monkeypatch.setattr(instrument, 'emit', records.append)
+    monkeypatch.setattr(instrument, 'SLOW_REQUEST_MS', 0)
+    return records
+
+def test_request_log_line(log_lines):
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    seed_messages(chat_id, [bob], 3)
+    call('messages', 'GET', alice, query={'chat_id': str(chat_id)})
+
+    (record,) = log_lines
+    assert (record['function'], record['user_id'], record['method'], record['action']) == ('messages', alice, 'GET', None)
+    assert record['queries'] >= 1 and record['rows'] >= 3 and 'membership' in record['phases']
+    assert record['slow'] is True and len(record['statements']) >= 1
+    assert 'plan' not in record
+
+def test_explain_when_sampling_is_enabled(instrument, log_lines, monkeypatch):
+    (alice, _), (chat_id,) = seed(2, [(0, 1)])
+    monkeypatch.setattr(instrument, 'SLOW_EXPLAIN_RATE', 1)
+    call('messages', 'GET', alice, query={'chat_id': str(chat_id)})
+    (record,) = log_lines
+    assert isinstance(record.get('plan'), list) and 'Plan' in record['plan'][0]
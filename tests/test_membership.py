@@ -0,0 +1,39 @@
+import json
+import os
+import time
+
+from support import call, database, function, seed
+
+
+def test_non_integer_chat_id():
+    (alice,), _ = seed(1)
+    assert call('messages', 'POST', alice, body={'chat_id': 'abc', 'content': 'hi'})[:2] == (400, {'error': 'chat_id must be an integer'})
+
+def test_cached_denial_is_invalidated_by_notify():
+    function('messages')
+    import membership
+
+    (_, _, carol), (chat_id,) = seed(3, [(0, 1)])
+    assert call('messages', 'POST', carol, body={'chat_id': chat_id, 'content': 'hi'})[0] == 403
+
+    # Отказ закэширован, но NOTIFY о новом участнике сбрасывает его до истечения TTL
+    with database() as cur:
+        cur.execute(f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.chat_participants (chat_id, user_id) VALUES (%s, %s)", (chat_id, carol))
+        cur.execute('SELECT pg_notify(%s, %s)', (membership.MEMBERSHIP_CHANNEL, json.dumps({'chat_id': chat_id, 'user_ids': [carol]})))
+    time.sleep(0.1)
+    assert call('messages', 'POST', carol, body={'chat_id': chat_id, 'content': 'hi'})[0] == 200
+
+def test_reconnect_backs_off_without_listen():
+    function('messages')
+    import membership
+
+    # Без LISTEN кэшу не верим, а переподключение откладывается, а не повторяется на каждом запросе
+    listener = membership.InvalidationListener('postgresql://postgres@127.0.0.1:1/none?connect_timeout=1', membership.MembershipCache())
+    attempts = []
+    connect = listener._connect
+    listener._connect = lambda: attempts.append(1) or connect()
+    assert [listener.drain() for _ in range(5)] == [False] * 5
+    assert len(attempts) == 1
+    listener._retry_at = 0.0
+    listener.drain()
+    assert (len(attempts), listener._backoff) == (2, membership.RECONNECT_BACKOFF_MIN * 4)
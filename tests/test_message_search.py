@@ -0,0 +1,47 @@
+import uuid
+
+import pytest
+
+from support import call, seed
+
+
+@pytest.fixture
+def corpus():
+    (alice, bob, _), (chat_id, foreign_id) = seed(3, [(0, 1), (1, 2)])
+    word = 'zebra' + uuid.uuid4().hex[:6]
+    sent = []
+    for content in (f'{word} once', f'{word} {word} {word} many times', 'unrelated words', f'again {word}', f'last {word} here'):
+        sent.append(call('messages', 'POST', bob, body={'chat_id': chat_id, 'content': content})[1]['message']['id'])
+    call('messages', 'POST', bob, body={'chat_id': foreign_id, 'content': f'{word} in a chat alice is not in'})
+    return alice, chat_id, foreign_id, word, sent[:2] + sent[3:]
+
+def search(user_id: int, **query) -> tuple:
+    return call('messages', 'GET', user_id, query={'view': 'search', **query})
+
+def test_ranked_results_from_own_chats(corpus):
+    alice, _, _, word, matching = corpus
+    _, page, _ = search(alice, q=word, limit='10')
+    ids = [result['id'] for result in page['results']]
+    assert sorted(ids) == sorted(matching)
+    assert ids[0] == matching[1]
+    assert f'**{word}**' in page['results'][0]['snippet']
+
+    # Курсор по (rank, id): страницы по одному результату складываются в тот же порядок без повторов
+    paged, cursor = [], None
+    while True:
+        _, page, _ = search(alice, q=word, limit='1', **({'cursor': cursor} if cursor else {}))
+        paged += [result['id'] for result in page['results']]
+        if not page['has_more']:
+            break
+        cursor = page['next_cursor']
+    assert paged == ids
+
+def test_recent_sort_within_a_chat(corpus):
+    alice, chat_id, _, word, matching = corpus
+    _, page, _ = search(alice, q=word, sort='recent', chat_id=str(chat_id))
+    assert [result['id'] for result in page['results']] == sorted(matching, reverse=True)
+
+def test_invalid_search(corpus):
+    alice, _, foreign_id, word, _ = corpus
+    assert search(alice, q=word, chat_id=str(foreign_id))[0] == 403
+    assert search(alice, q=word, cursor='!!')[0] == 400
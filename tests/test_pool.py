@@ -0,0 +1,48 @@
+import os
+import time
+
+import psycopg2
+import pytest
+
+from support import database, function
+
+
+@pytest.fixture
+def db():
+    function('messages')
+    import db
+    return db
+
+def test_warm_acquires_reuse_idle_connection(db):
+    pool = db.ConnectionPool(os.environ['DATABASE_URL'], min_size=1, max_size=2, timeout=1, check_after=0)
+    try:
+        pool.warm_up()
+        for _ in range(3):
+            pool.release(pool.acquire())
+        assert pool.stats()['hits'] == 3
+    finally:
+        pool.close()
+
+def test_dead_idle_connection_is_discarded_once(db):
+    pool = db.ConnectionPool(os.environ['DATABASE_URL'], min_size=1, max_size=2, timeout=1, check_after=0)
+    try:
+        # Соединение, убитое на сервере, отсеивается проверкой здоровья, а слот не теряется
+        conn = pool.acquire()
+        pid = conn.get_backend_pid()
+        pool.release(conn)
+        with database() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s)', (pid,))
+        time.sleep(0.1)
+        for _ in range(4):
+            pool.release(pool.acquire())
+        assert pool.stats()['resets'] == 1
+    finally:
+        pool.close()
+
+def test_failed_connects_do_not_leak_slots(db):
+    # Сервер недоступен: каждая попытка — ошибка соединения, а не PoolTimeout из-за потерянных слотов
+    dead = db.ConnectionPool('postgresql://postgres@127.0.0.1:1/none?connect_timeout=1', min_size=0, max_size=2,
+                             timeout=0.5)
+    for _ in range(5):
+        with pytest.raises(psycopg2.OperationalError):
+            dead.release(dead.acquire())
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from support import call, captured_log, database, function, seed
+
+
+@pytest.fixture
+def presence():
+    function('messages')
+    import presence
+    return presence
+
+def last_seen(user_id: int):
+    with database() as cur:
+        cur.execute(f"SELECT last_seen FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE id = %s", (user_id,))
+        return cur.fetchone()[0]
+
+def test_request_writes_only_the_heartbeat(presence):
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    with database() as cur:
+        cur.execute(
+            f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.users SET last_seen = NOW() - INTERVAL '2 hours' WHERE id = %s RETURNING last_seen",
+            (alice,)
+        )
+        stale = cur.fetchone()[0]
+
+    # Запрос пишет только пульс, users не трогает
+    with captured_log() as records:
+        call('messages', 'POST', alice, body={'chat_id': chat_id, 'content': 'hi'})
+    assert not any('.users u' in sql and sql.startswith('UPDATE') for sql in records[0]['sql'])
+    assert last_seen(alice) == stale
+    _, payload, _ = call('contacts', 'GET', bob, query={'view': 'presence', 'ids': str(alice)})
+    assert payload['presence'][0]['online'] is True
+
+    presence.flush()
+    assert last_seen(alice) > stale
+
+def test_flush_errors_go_to_the_log(presence, monkeypatch):
+    monkeypatch.setattr(presence, 'flush_presence', lambda cur: 1 / 0)
+    with captured_log() as records:
+        presence.flush()
+    assert [(record['source'], record['error']['type']) for record in records] == [('presence-flush', 'ZeroDivisionError')]
@@ -0,0 +1,22 @@
+from _common import make_event
+from support import function, random_ip, random_phone
+
+
+def send_code(phone: str, source_ip: str, forwarded_for: str = None) -> dict:
+    event = make_event('POST', body={'action': 'send_code', 'phone': phone})
+    event['requestContext'] = {'identity': {'sourceIp': source_ip}}
+    if forwarded_for:
+        event['headers']['x-forwarded-for'] = forwarded_for
+    return function('auth').handler(event, None)
+
+def test_send_code_per_phone():
+    phone = random_phone()
+    assert [send_code(phone, random_ip())['statusCode'] for _ in range(4)] == [200, 200, 200, 429]
+    assert int(send_code(phone, random_ip())['headers']['Retry-After']) > 0
+
+def test_send_code_per_source_ip_ignores_forwarded_for():
+    # Подмена X-Forwarded-For не уводит запросы в новые корзины: ключ — адрес от платформы
+    source_ip = random_ip()
+    statuses = [send_code(random_phone(), source_ip, f'10.0.0.{n}')['statusCode'] for n in range(21)]
+    assert statuses.count(429) == 1
+    assert function('auth').Request({'headers': {'x-forwarded-for': '10.0.0.1'}}).source_ip == ''
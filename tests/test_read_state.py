@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+import psycopg2
+
+from support import call, seed
+
+
+def mark_read(user_id: int, chat_id: int, up_to: int) -> tuple:
+    return call('messages', 'POST', user_id, body={'action': 'mark_read', 'chat_id': chat_id, 'up_to_message_id': up_to})
+
+def send(user_id: int, chat_id: int, count: int) -> list:
+    return [call('messages', 'POST', user_id, body={'chat_id': chat_id, 'content': str(n)})[1]['message']['id'] for n in range(count)]
+
+def test_mark_read_moves_watermark_forward_only():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    sent = send(bob, chat_id, 4)
+
+    status, payload, _ = mark_read(alice, chat_id, sent[1])
+    assert status == 200
+    assert (payload['last_read_message_id'], payload['unread_count']) == (sent[1], 2)
+
+    # Водяной знак не откатывается назад и не уходит дальше последнего сообщения чата
+    assert mark_read(alice, chat_id, sent[0])[1]['last_read_message_id'] == sent[1]
+    _, payload, _ = mark_read(alice, chat_id, sent[-1] + 1000)
+    assert (payload['last_read_message_id'], payload['unread_count']) == (sent[-1], 0)
+
+    _, history, _ = call('messages', 'GET', bob, query={'chat_id': str(chat_id)})
+    assert all(message['is_read'] for message in history['messages'])
+
+def test_mark_read_outside_the_chat():
+    (_, bob, carol), (chat_id,) = seed(3, [(0, 1)])
+    sent = send(bob, chat_id, 1)
+    assert mark_read(carol, chat_id, sent[0])[0] == 403
+
+def test_send_committed_while_waiting_for_the_row_lock_is_counted():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    sent = send(bob, chat_id, 2)
+    schema = os.environ['MAIN_DB_SCHEMA']
+
+    # Параллельная отправка держит строку участника, пока mark_read ждёт: её сообщение должно остаться непрочитанным
+    sender = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = sender.cursor()
+        cur.execute(
+            f"INSERT INTO {schema}.messages (chat_id, sender_id, content) VALUES (%s, %s, 'late') RETURNING id",
+            (chat_id, bob)
+        )
+        late_id = cur.fetchone()[0]
+        cur.execute(f'UPDATE {schema}.chats SET last_message_id = %s WHERE id = %s', (late_id, chat_id))
+        cur.execute(
+            f'UPDATE {schema}.chat_participants SET unread_count = unread_count + 1 WHERE chat_id = %s AND user_id = %s',
+            (chat_id, alice)
+        )
+        result = {}
+        reader = threading.Thread(target=lambda: result.update(response=mark_read(alice, chat_id, sent[-1])))
+        reader.start()
+        time.sleep(0.3)
+        sender.commit()
+        reader.join(10)
+    finally:
+        sender.close()
+
+    _, payload, _ = result['response']
+    assert (payload['last_read_message_id'], payload['unread_count']) == (sent[-1], 1)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from support import call, function, seed
+
+DEAD_DSN = 'postgresql://postgres@127.0.0.1:1/none?connect_timeout=1'
+
+
+@pytest.fixture
+def db():
+    function('messages')
+    import db
+    return db
+
+@pytest.fixture
+def router(db, monkeypatch):
+    # «Реплика» — тот же сервер: вне recovery её отставание считается нулевым
+    replica = db.ConnectionPool(os.environ['DATABASE_URL'], replica=True, min_size=0, max_size=2, timeout=1)
+    router = db.ReplicaRouter([replica], sticky_seconds=30)
+    monkeypatch.setattr(db, '_replicas', router)
+    yield router
+    replica.close()
+
+def test_reads_go_to_the_replica_except_own_writes(router):
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    call('messages', 'GET', alice, query={'chat_id': str(chat_id)})
+    assert (router.stats()['replica_reads'], router.stats()['primary_reads']) == (1, 0)
+
+    # Свою запись автор читает с primary, пока не истечёт окно липкости; чужие чтения остаются на реплике
+    call('messages', 'POST', alice, body={'chat_id': chat_id, 'content': 'fresh'})
+    _, page, _ = call('messages', 'GET', alice, query={'chat_id': str(chat_id)})
+    assert [message['content'] for message in page['messages']] == ['fresh']
+    call('messages', 'GET', bob, query={'chat_id': str(chat_id)})
+    assert (router.stats()['sticky'], router.stats()['replica_reads']) == (1, 2)
+
+def test_lagging_replica_falls_back_to_primary(db):
+    behind = db.ConnectionPool(os.environ['DATABASE_URL'], replica=True, min_size=0, max_size=1)
+    try:
+        lagging = db.ReplicaRouter([behind], max_lag=-1)
+        assert (lagging.acquire(), lagging.stats()['lagging']) == (None, 1)
+    finally:
+        behind.close()
+
+def test_unreachable_replica_is_retried_later(db):
+    dead = db.ReplicaRouter([db.ConnectionPool(DEAD_DSN, replica=True, min_size=0, max_size=1, timeout=0.5)])
+    assert [dead.acquire() for _ in range(3)] == [None] * 3
+    assert dead.stats()['failures'] == 1
+
+def test_write_marker_keeps_other_instances_off_a_stale_replica(db, router, monkeypatch):
+    # Другой экземпляр функции не видел записи: о ней он знает только по метке, которую вернул клиент
+    router.sticky_seconds = 0
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    _, _, headers = call('messages', 'POST', alice, body={'chat_id': chat_id, 'content': 'fresh'})
+    marker = headers['X-Write-Lsn']
+    assert 'X-Write-Lsn' in headers['Access-Control-Expose-Headers']
+
+    monkeypatch.setattr(db, 'measure_replica', lambda conn: (0.0, db.parse_lsn(marker) - 1))
+    _, page, _ = call('messages', 'GET', alice, query={'chat_id': str(chat_id)}, headers={'x-min-lsn': marker})
+    assert [message['content'] for message in page['messages']] == ['fresh']
+    assert (router.stats()['behind'], router.stats()['primary_reads']) == (1, 1)
+
+    # Без метки и с меткой, до которой реплика уже дошла, чтение остаётся на реплике
+    call('messages', 'GET', bob, query={'chat_id': str(chat_id)})
+    call('messages', 'GET', bob, query={'chat_id': str(chat_id)}, headers={'x-min-lsn': '0/1'})
+    assert router.stats()['replica_reads'] == 2
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from _common import make_event, make_token
+from support import call, captured_log, function, seed
+
+
+def test_preflight():
+    status, payload, headers = call('messages', 'OPTIONS')
+    assert (status, payload) == (200, '')
+    assert headers['Access-Control-Allow-Methods'] == 'GET, POST, OPTIONS'
+    assert 'If-None-Match' in headers['Access-Control-Allow-Headers']
+    assert 'ETag' in headers['Access-Control-Expose-Headers']
+
+def test_unknown_action_and_method():
+    (alice,), _ = seed(1)
+    assert call('auth', 'POST', body={'action': 'nope'})[:2] == (400, {'error': 'Invalid action'})
+    assert call('auth', 'GET')[:2] == (405, {'error': 'Method not allowed'})
+    assert call('messages', 'DELETE', alice)[:2] == (405, {'error': 'Method not allowed'})
+
+@pytest.mark.parametrize('raw, error', [('{"action": ', 'Invalid JSON body'), ('[1, 2]', 'JSON body must be an object')])
+def test_invalid_body(raw, error):
+    (alice,), _ = seed(1)
+    event = make_event('POST', make_token(alice))
+    event['body'] = raw
+    response = function('messages').handler(event, None)
+    assert (response['statusCode'], json.loads(response['body'])) == (400, {'error': error})
+
+def test_unhandled_error_returns_request_id():
+    (alice,), _ = seed(1)
+    messages = function('messages')
+
+    # Необработанное исключение: клиенту только request_id, подробности — в строке лога
+    def failing(*args, **kwargs):
+        raise RuntimeError('membership lookup failed')
+    is_participant, messages.is_participant = messages.is_participant, failing
+    try:
+        with captured_log() as records:
+            status, payload, _ = call('messages', 'GET', alice, query={'chat_id': '1'})
+    finally:
+        messages.is_participant = is_participant
+    assert (status, sorted(payload)) == (500, ['error', 'request_id'])
+    assert payload['request_id'] == records[0]['request_id']
+    assert records[0]['error']['message'] == 'membership lookup failed'
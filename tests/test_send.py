@@ -0,0 +1,33 @@
+import os
+
+from support import call, database, seed
+
+
+def test_send_batch_reports_each_item():
+    (alice, bob, _), (chat_id, foreign_id) = seed(3, [(0, 1), (1, 2)])
+    status, payload, _ = call('messages', 'POST', alice, body={'action': 'send_batch', 'messages': [
+        {'chat_id': chat_id, 'content': 'first', 'client_id': 'a'},
+        {'chat_id': chat_id, 'content': '  '},
+        {'chat_id': foreign_id, 'content': 'not mine'},
+        {'chat_id': 'x', 'content': 'bad chat'},
+        {'chat_id': chat_id, 'content': 'second', 'client_id': 'b'}
+    ]})
+    assert status == 200
+    assert [result['success'] for result in payload['results']] == [True, False, False, False, True]
+    assert payload['results'][2]['error'] == 'Not a participant of this chat'
+    assert [result['client_id'] for result in payload['results']] == ['a', None, None, None, 'b']
+    assert (payload['success'], payload['sent']) == (False, 2)
+
+    # Сводка чата и счётчик непрочитанного получателя обновлены один раз за пакет
+    with database() as cur:
+        cur.execute(
+            f"""SELECT c.last_message_id, cp.unread_count FROM {os.environ['MAIN_DB_SCHEMA']}.chats c
+                JOIN {os.environ['MAIN_DB_SCHEMA']}.chat_participants cp ON cp.chat_id = c.id AND cp.user_id = %s
+                WHERE c.id = %s""",
+            (bob, chat_id)
+        )
+        assert cur.fetchone() == (payload['results'][4]['message']['id'], 2)
+
+def test_empty_batch_is_rejected():
+    (alice,), _ = seed(1)
+    assert call('messages', 'POST', alice, body={'action': 'send_batch', 'messages': []})[0] == 400
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from _common import make_event
+from fake_sms_gateway import start_gateway
+from support import call, captured_log, database, function, random_phone
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    function('auth')
+    import sms
+
+    gateway = start_gateway()
+    worker = sms.SmsWorker('login:password', poll_interval=5)
+    monkeypatch.setenv('SMS_API_KEY', 'login:password')
+    monkeypatch.setattr(sms, 'SMS_GATEWAY_URL', f'http://127.0.0.1:{gateway.server_port}/sys/send.php')
+    monkeypatch.setattr(function('auth'), 'SMS_INLINE_DELIVERY', False)
+    # Очередь могла остаться от прошлых запусков: её отправка в счёт не идёт
+    worker.drain()
+    gateway.sent.clear()
+    worker.gateway = gateway
+    try:
+        yield worker
+    finally:
+        worker._close()
+        gateway.shutdown()
+
+def test_worker_wakes_on_notify_and_delivers(worker):
+    phone = random_phone()
+    worker._listen()
+    status, payload, _ = call('auth', 'POST', body={'action': 'send_code', 'phone': phone})
+    assert (status, payload['debug_code']) == (200, None)
+
+    # Обработчик только ставит SMS в очередь, воркер просыпается по NOTIFY, а не по таймауту опроса
+    started = time.perf_counter()
+    worker.wait()
+    assert time.perf_counter() - started < 2
+    assert worker.drain() == 1
+    assert [sent_phone for sent_phone, _ in worker.gateway.sent] == [phone]
+    with database() as cur:
+        cur.execute(f"SELECT status, attempts FROM {os.environ['MAIN_DB_SCHEMA']}.sms_outbox WHERE phone = %s", (phone,))
+        assert cur.fetchall() == [('sent', 1)]
+
+def outbox_status(phone: str) -> list:
+    with database() as cur:
+        cur.execute(f"SELECT status FROM {os.environ['MAIN_DB_SCHEMA']}.sms_outbox WHERE phone = %s", (phone,))
+        return [row[0] for row in cur.fetchall()]
+
+def test_send_code_delivers_inline_without_a_worker(worker, monkeypatch):
+    # Облачная функция без воркера: код уходит пачкой прямо из send_code
+    monkeypatch.setattr(function('auth'), 'SMS_INLINE_DELIVERY', True)
+    phone = random_phone()
+    assert call('auth', 'POST', body={'action': 'send_code', 'phone': phone})[0] == 200
+    assert phone in [sent_phone for sent_phone, _ in worker.gateway.sent]
+    assert outbox_status(phone) == ['sent']
+
+def test_gateway_runs_the_worker(worker):
+    from app import Gateway
+
+    gateway = Gateway(functions=('auth',), workers=2)
+    gateway.functions['auth'].SMS_INLINE_DELIVERY = False
+    events = asyncio.Queue()
+
+    async def scenario():
+        lifespan = asyncio.ensure_future(gateway.lifespan(events.get, lambda message: asyncio.sleep(0)))
+        await events.put({'type': 'lifespan.startup'})
+        await asyncio.sleep(0.3)
+        phone = random_phone()
+        status = (await gateway.call('auth', make_event('POST', body={'action': 'send_code', 'phone': phone}), None))['statusCode']
+        for _ in range(50):
+            if outbox_status(phone) == ['sent']:
+                break
+            await asyncio.sleep(0.1)
+        await events.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        return phone, status
+
+    # Шлюз живёт постоянно: отправкой из outbox занимается воркер, запущенный в lifespan
+    phone, status = asyncio.run(scenario())
+    assert status == 200
+    assert gateway.sms_worker is not None
+    assert outbox_status(phone) == ['sent']
+    assert phone in [sent_phone for sent_phone, _ in worker.gateway.sent]
+
+def test_worker_errors_go_to_the_log(worker, monkeypatch):
+    import sms
+
+    # Сбой обработки очереди уходит в JSON-лог, а не в print
+    monkeypatch.setattr(sms, 'process_outbox', lambda *args: 1 / 0)
+    with captured_log() as records:
+        worker.drain()
+    assert [(record['source'], record['error']['type']) for record in records] == [('sms-worker', 'ZeroDivisionError')]
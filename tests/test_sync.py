@@ -0,0 +1,102 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+
+from support import call, captured_log, database, function, seed, seed_messages
+
+
+def sync(user_id: int, headers: dict = None, **body) -> tuple:
+    return call('messages', 'POST', user_id, body={'action': 'sync', **body}, headers=headers)
+
+def test_sync_returns_messages_after_cursor():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    ids = seed_messages(chat_id, [alice, bob], 3)
+    status, first, _ = sync(alice, cursors={str(chat_id): ids[0]})
+    assert status == 200
+    assert [message['id'] for message in first['chats'][0]['messages']] == ids[1:]
+
+def test_unchanged_sync_is_not_modified():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    seed_messages(chat_id, [alice, bob], 3)
+    _, first, _ = sync(alice)
+    # Ничего не изменилось: повтор с тем же токеном и ETag отдаёт 304 без тела
+    _, idle, headers = sync(alice, sync_token=first['sync_token'])
+    assert idle['changed'] is False
+    assert sync(alice, {'if-none-match': headers['ETag']}, sync_token=first['sync_token'])[0] == 304
+
+    newer = seed_messages(chat_id, [bob], 1)
+    status, second, _ = sync(alice, {'if-none-match': headers['ETag']}, sync_token=first['sync_token'])
+    assert status == 200
+    assert [message['id'] for message in second['chats'][0]['messages']] == newer
+
+def test_waiting_sync_wakes_on_notify():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    _, state, _ = sync(alice)
+
+    # Ожидающий sync просыпается по NOTIFY от send_message, а не по таймауту
+    result = {}
+    def wait():
+        started = time.perf_counter()
+        result['response'] = sync(alice, sync_token=state['sync_token'], wait=10)
+        result['elapsed'] = time.perf_counter() - started
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.3)
+    status, sent, _ = call('messages', 'POST', bob, body={'chat_id': chat_id, 'content': 'wake up'})
+    assert status == 200
+    waiter.join(15)
+    assert [message['id'] for message in result['response'][1]['chats'][0]['messages']] == [sent['message']['id']]
+    assert result['elapsed'] < 5
+
+def test_terminated_listen_connection_keeps_original_error():
+    messages = function('messages')
+    import db
+
+    (alice, _), _ = seed(2, [(0, 1)])
+
+    # Соединение умирает во время ожидания: UNLISTEN падает следом, но наружу идёт исходная ошибка, а слот не теряется
+    def terminated(conn, timeout):
+        with database() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s)', (conn.get_backend_pid(),))
+        time.sleep(0.1)
+        conn.poll()
+    _, state, _ = sync(alice)
+    resets = db.pool_stats()['resets']
+    wait_for_notify, messages.wait_for_notify = messages.wait_for_notify, terminated
+    try:
+        with captured_log() as records:
+            status, _, _ = sync(alice, sync_token=state['sync_token'], wait=5)
+    finally:
+        messages.wait_for_notify = wait_for_notify
+    assert status == 500
+    assert 'terminat' in records[0]['error']['message']
+    assert db.pool_stats()['resets'] == resets + 1
+    assert sync(alice)[0] == 200
+
+def token(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+@pytest.mark.parametrize('body', [
+    {'cursors': [1]},
+    {'cursors': 'x'},
+    {'sync_token': token([1, 2])},
+    {'sync_token': token(5)},
+    {'sync_token': 'not base64 at all!'},
+    {'limit': 'many'}
+])
+def test_malformed_sync_request(body):
+    (alice,), _ = seed(1)
+    assert sync(alice, **body)[:2] == (400, {'error': 'Invalid sync_token, cursors, limit or wait'})
+
+def test_cursor_client_long_polls():
+    (alice, bob), (chat_id,) = seed(2, [(0, 1)])
+    ids = seed_messages(chat_id, [bob], 2)
+    # У курсора нет состояния прочтения: без новых сообщений sync с wait ждёт, а не отвечает сразу
+    started = time.perf_counter()
+    status, payload, _ = sync(alice, cursors={str(chat_id): ids[-1]}, wait=1)
+    assert status == 200
+    assert [chat['messages'] for chat in payload['chats']] == [[]]
+    assert time.perf_counter() - started >= 0.9
@@ -0,0 +1,43 @@
+import os
+import time
+
+import jwt
+import pytest
+
+from support import call, function, seed
+
+OLD_KEY, NEW_KEY = 'old-key-' + 'o' * 32, 'new-key-' + 'n' * 32
+
+
+@pytest.fixture
+def tokens():
+    function('messages')
+    import tokens
+    return tokens
+
+def test_rejected_tokens():
+    (alice,), _ = seed(1)
+    secret = os.environ.get('JWT_SECRET', 'default-secret-key')
+    expired = jwt.encode({'user_id': alice, 'exp': int(time.time()) - 60}, secret, algorithm='HS256')
+    forged = jwt.encode({'user_id': alice, 'exp': int(time.time()) + 60}, 'not-the-secret-key-with-32-bytes!', algorithm='HS256')
+    for token, error in ((expired, 'Token expired'), (forged, 'Invalid token'), ('test-token', 'Invalid token')):
+        status, payload, _ = call('messages', 'GET', headers={'authorization': f'Bearer {token}'}, query={'chat_id': '1'})
+        assert (status, payload) == (401, {'error': error})
+
+def test_key_rotation(tokens):
+    # Ротация: подписывает первый ключ, старый ещё принимается, после удаления из списка — уже нет
+    old = tokens.TokenVerifier([OLD_KEY])
+    rotated = tokens.TokenVerifier([NEW_KEY, OLD_KEY])
+    issued = old.issue({'user_id': 1})
+    assert rotated.verify(issued)['user_id'] == 1
+    assert tokens.TokenVerifier([NEW_KEY]).verify(rotated.issue({'user_id': 1}))['user_id'] == 1
+    with pytest.raises(jwt.InvalidSignatureError):
+        tokens.TokenVerifier([NEW_KEY]).verify(issued)
+
+def test_verified_token_cache(tokens):
+    verifier = tokens.TokenVerifier([NEW_KEY], max_size=1)
+    first, second = verifier.issue({'user_id': 1}), verifier.issue({'user_id': 2})
+    for token in (first, first, second):
+        verifier.verify(token)
+    stats = verifier.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 2, 1, 1)
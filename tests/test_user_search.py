@@ -0,0 +1,58 @@
+import json
+import os
+import uuid
+
+import pytest
+
+from _common import make_event
+from support import call, database, function, random_ip, random_phone, seed
+
+
+@pytest.fixture
+def bob():
+    username, phone = f'search_{uuid.uuid4().hex[:8]}', random_phone()
+    with database() as cur:
+        cur.execute(f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.users (phone, username) VALUES (%s, %s) RETURNING id", (phone, username))
+        return cur.fetchone()[0], username, phone
+
+def search(user_id: int, q: str) -> list:
+    return call('contacts', 'GET', user_id, query={'view': 'search', 'q': q})[1]['users']
+
+def test_phone_of_user_found_by_name_is_masked(bob):
+    (alice,), _ = seed(1)
+    bob_id, username, phone = bob
+    found = {user['id']: user for user in search(alice, username)}
+    assert found[bob_id]['phone'] == phone[:2] + '*' * (len(phone) - 4) + phone[-2:]
+
+def test_phone_search_is_exact_only(bob):
+    (alice,), _ = seed(1)
+    bob_id, _, phone = bob
+    # По номеру — только точное совпадение, в любом формате записи; префикс ничего не находит
+    assert search(alice, phone[:-3]) == []
+    local = f'8 ({phone[2:5]}) {phone[5:8]}-{phone[8:10]}-{phone[10:]}'
+    assert [(user['id'], user['phone']) for user in search(alice, local)] == [(bob_id, phone)]
+
+def test_duplicate_spellings_resolve_to_the_earliest_account(bob):
+    (alice,), _ = seed(1)
+    bob_id, _, phone = bob
+    # Записи одного номера в разном виде не сливаются миграцией: поиск, добавление и вход берут самую раннюю
+    with database() as cur:
+        cur.execute(f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.users (phone, username) VALUES (%s, 'dup') RETURNING id", ('8' + phone[2:],))
+        duplicate = cur.fetchone()[0]
+    assert duplicate > bob_id
+    assert [user['id'] for user in search(alice, phone)] == [bob_id]
+    assert call('contacts', 'POST', alice, body={'phone': '8' + phone[2:]})[1]['contact']['id'] == bob_id
+
+    def auth(action: str, **body) -> dict:
+        event = make_event('POST', body={'action': action, 'phone': phone, **body})
+        event['requestContext'] = {'identity': {'sourceIp': random_ip()}}
+        return json.loads(function('auth').handler(event, None)['body'])
+
+    code = auth('send_code')['debug_code']
+    assert auth('verify_code', code=code)['user']['id'] == bob_id
+
+def test_phones_without_digits_do_not_collide():
+    letters = str.maketrans('0123456789', 'ghijklmnop')
+    with database() as cur:
+        for phone in (f'none-{uuid.uuid4().hex[:8].translate(letters)}' for _ in range(2)):
+            cur.execute(f"INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.users (phone, username) VALUES (%s, 'nodigits')", (phone,))